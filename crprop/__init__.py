@@ -2,7 +2,27 @@
 
 from .__version__ import __version__
 
+# Physics, initial-condition and I/O layers, depending on NumPy only
 from .extras import *
 from .particle_utils import *
 from .coord_utils import *
+from .injection_utils import *
+from .spectrum_utils import *
+from .field_utils import *
+from .trajectory_utils import *
 from .definitions import *
+
+# Modules needing OpenCL, OpenGL or more physics are imported
+# lazily on first attribute access, e.g. crprop.cl_utils
+_lazy_modules = ('numpy_backend', 'cl_utils', 'headless_utils', 'recorder_utils',
+                 'field_grid_utils', 'cutoff_utils', 'rng_utils', 'opengl_utils',
+                 'capture_utils', 'render_utils', 'offscreen_utils',
+                 'simulation_utils', 'multidevice_utils', 'batch_utils',
+                 'sweep_utils')
+
+
+def __getattr__(name):
+    if name in _lazy_modules:
+        import importlib
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r"%(__name__, name))
@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+
+try:
+    import sys
+    import argparse
+    from particle_utils import check_positive_int
+    from batch_utils import run_shards, merge_shards
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+
+if __name__=="__main__":
+    p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                description=("Run a headless job split into shards, "
+                                             "and merge the shard outputs."))
+    commands = p.add_subparsers(dest="command")
+
+    run = commands.add_parser("run", formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                              help=("Run every shard of a job in a local process pool, "
+                                    "then merge them."),
+                              description=("Run every shard of a job in its own run.py process. "
+                                           "Arguments after -- are passed to run.py, e.g. "
+                                           "-- --headless --num_steps 1000 -n 1000000 --seed 1"))
+    run.add_argument("-k", "--num_shards", dest="num_shards", required=True,
+                     type=check_positive_int, help="Number of shards of the job.")
+    run.add_argument("-j", "--processes", dest="processes", type=check_positive_int,
+                     help="Shards run at once, and merge processes. Default is one per CPU.")
+    run.add_argument("--shard_dir", dest="shard_dir", default="shards",
+                     help="Directory of the shard outputs and logs.")
+    run.add_argument("-o", "--output", dest="output", default="particle_states.npz",
+                     help="Output file of the merged job.")
+    run.add_argument("run_args", nargs=argparse.REMAINDER,
+                     help="run.py arguments of the whole job, after --.")
+
+    merge = commands.add_parser("merge", formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                help="Merge shard outputs, e.g. those of a job array.")
+    merge.add_argument("shard_files", nargs='+',
+                       help="Shard output files of run.py --shard, all shards of the job.")
+    merge.add_argument("-j", "--processes", dest="processes", type=check_positive_int,
+                       help="Merge processes. Default is one per CPU.")
+    merge.add_argument("-o", "--output", dest="output", default="particle_states.npz",
+                       help="Output file of the merged job.")
+
+    args = p.parse_args()
+
+    if args.command == "run":
+        run_args = args.run_args[1:] if args.run_args[:1] == ['--'] else args.run_args
+        # Options may be given as --seed 3 or --seed=3
+        given = set(arg.split('=', 1)[0] for arg in run_args)
+        if '--seed' not in given:
+            p.error("shards derive their seeds from the job seed, pass --seed to run.py")
+        if '--headless' not in given:
+            run_args = ['--headless'] + run_args
+        shard_files = run_shards(run_args, args.num_shards, args.shard_dir,
+                                 processes=args.processes)
+        merge_shards(shard_files, output=args.output, processes=args.processes)
+    elif args.command == "merge":
+        merge_shards(args.shard_files, output=args.output, processes=args.processes)
+    else:
+        p.print_help()
+        sys.exit(1)
@@ -0,0 +1,316 @@
+from __future__ import absolute_import
+
+try:
+    import os
+    import sys
+    import subprocess
+    import numpy as np
+    from multiprocessing import Pool
+    from concurrent.futures import ThreadPoolExecutor
+    from definitions import *
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+# Keys of a shard output that are the same in every shard
+SHARD_CONSTANT_KEYS = ('species_name', 'source_name', 'hist_lat_edges', 'hist_lon_edges',
+                       'num_shards')
+
+
+def shard_seed(seed, shard):
+    """
+    Seed of one shard of a job, derived from the job seed and the shard id.
+
+    Parameters
+    ----------
+    seed  : int
+            seed of the job
+    shard : int
+            shard id
+
+    Returns
+    -------
+    seed : numpy.random.SeedSequence
+           the shard's child of the job seed, as
+           ``SeedSequence(seed).spawn(num_shards)[shard]``
+    """
+    return np.random.SeedSequence(seed, spawn_key=(shard,))
+
+
+def shard_counts(num_particles, num_shards):
+    """
+    Number of particles of each shard, the first shards
+    taking one more particle when the split is uneven.
+    """
+    counts = np.full(num_shards, num_particles//num_shards, dtype=np.int64)
+    counts[:num_particles % num_shards] += 1
+    return counts
+
+
+def shard_energy_range(Emin, Emax, num_particles, num_shards, shard):
+    """
+    Energy range of one shard of a job with evenly log-spaced energies.
+
+    The shard's particles take its slice of the job's grid of
+    ``num_particles`` log-spaced energies, so that the shards together
+    span the energy range of the job, each over its own part of it.
+
+    Parameters
+    ----------
+    Emin          : float
+                    minimum particle energy of the job in eV
+    Emax          : float
+                    maximum particle energy of the job in eV
+    num_particles : int
+                    number of particles of the job
+    num_shards    : int
+                    number of shards
+    shard         : int
+                    shard id
+
+    Returns
+    -------
+    Emin : float
+           lowest energy of the shard in eV
+    Emax : float
+           highest energy of the shard in eV
+    """
+    if num_particles < 2:
+        return Emin, Emax
+    counts = shard_counts(num_particles, num_shards)
+    first = counts[:shard].sum()
+    log_step = (np.log10(Emax) - np.log10(Emin))/(num_particles - 1)
+    return (10**(np.log10(Emin) + first*log_step),
+            10**(np.log10(Emin) + (first + counts[shard] - 1)*log_step))
+
+
+def exit_histograms(lifecycle, lat_bins=36, lon_bins=72):
+    """
+    Maps of the particles leaving a run.
+
+    Parameters
+    ----------
+    lifecycle : dict
+                exit records from ``run_headless``
+    lat_bins  : int, optional
+                number of latitude bins
+    lon_bins  : int, optional
+                number of longitude bins
+
+    Returns
+    -------
+    histograms : dict
+                 ``earth_hist`` counts of particles hitting the Earth by the
+                 geocentric latitude and longitude (degrees) of the impact,
+                 ``escape_hist`` counts of escaping particles by the latitude
+                 and longitude of their direction, and the bin edges
+    """
+    lat_edges = np.linspace(-90., 90., lat_bins+1)
+    lon_edges = np.linspace(-180., 180., lon_bins+1)
+    histograms = {'hist_lat_edges': lat_edges, 'hist_lon_edges': lon_edges}
+    for (name, reason, key) in (('earth_hist', LIFE_EARTH, 'exit_position'),
+                                ('escape_hist', LIFE_ESCAPED, 'exit_direction')):
+        xyz = np.asarray(lifecycle[key], dtype=np.float64)[lifecycle['exit_reason'] == reason]
+        lat = np.degrees(np.arctan2(xyz[:,2], np.hypot(xyz[:,0], xyz[:,1])))
+        lon = np.degrees(np.arctan2(xyz[:,1], xyz[:,0]))
+        histograms[name] = np.histogram2d(lat, lon, bins=(lat_edges, lon_edges))[0].astype(np.int64)
+    return histograms
+
+
+def combine_parts(parts):
+    """
+    Combine merged or shard outputs, in order: slot arrays and exit
+    catalogs are concatenated, histograms summed, and constants kept.
+    """
+    merged = {}
+    for key in parts[0]:
+        if key in SHARD_CONSTANT_KEYS:
+            merged[key] = parts[0][key]
+        elif key.endswith('_hist'):
+            merged[key] = np.sum([part[key] for part in parts], axis=0)
+        else:
+            merged[key] = np.concatenate([part[key] for part in parts])
+    return merged
+
+
+def shard_info(filename):
+    """
+    Shard id, number of starting particles and number
+    of refills of a shard output file.
+    """
+    with np.load(filename) as data:
+        num_particles = int(data['shard_particles'])
+        last_id = max(data['particle_id'].max(initial=-1), data['exit_id'].max(initial=-1))
+        return int(data['shard']), num_particles, max(int(last_id) + 1 - num_particles, 0)
+
+
+def merge_group(group):
+    """
+    Merge shard outputs into one, with global particle ids.
+
+    Parameters
+    ----------
+    group : list
+            (filename, first id, first refill id) of each shard, starting
+            particles of a shard taking ids from its first id and refills
+            from its first refill id
+
+    Returns
+    -------
+    merged : dict
+             slot arrays and exit catalogs concatenated, histograms summed
+    """
+    parts = []
+    for (filename, first, first_refill) in group:
+        with np.load(filename) as data:
+            part = dict((key, data[key]) for key in data.files)
+        num_particles = int(part.pop('shard_particles'))
+        shard = int(part.pop('shard'))
+
+        # Starting particles keep their place, refills follow all starting particles
+        for key in ('particle_id', 'exit_id'):
+            local = part[key].astype(np.int64)
+            part[key] = np.where(local < num_particles, first + local,
+                                 first_refill + local - num_particles)
+        part['shard'] = np.full(part['status'].size, shard, dtype=np.int32)
+        part['exit_shard'] = np.full(part['exit_id'].size, shard, dtype=np.int32)
+        parts.append(part)
+
+    return combine_parts(parts)
+
+
+def merge_shards(filenames, output=None, processes=None):
+    """
+    Merge the outputs of the shards of a job, as a parallel reduction.
+
+    The shards are split into one group per process, each process merges
+    its group, and the group results are merged in turn. Slots and exit
+    catalogs are concatenated in shard order, histograms are summed.
+    Starting particles of shard k take the global ids that follow those of
+    shards 0 to k-1, and refills the ids that follow all starting particles.
+
+    Parameters
+    ----------
+    filenames : list
+                shard output files of ``run.py --shard``, all shards of the job
+    output    : str, optional
+                file to write the merged output to
+    processes : int, optional
+                number of processes, one per CPU by default
+
+    Returns
+    -------
+    merged : dict
+             merged arrays, as written to ``output``
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(min(processes, len(filenames)), 1)
+
+    def run(function, items):
+        if processes == 1:
+            return [function(item) for item in items]
+        pool = Pool(processes)
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    info = run(shard_info, filenames)
+    order = np.argsort([i[0] for i in info])
+    shards = np.array([info[i][0] for i in order])
+    if np.unique(shards).size != shards.size:
+        raise ValueError("Shard outputs hold duplicate shards %s."%shards)
+
+    counts = np.array([info[i][1] for i in order], dtype=np.int64)
+    refills = np.array([info[i][2] for i in order], dtype=np.int64)
+    first = np.cumsum(counts) - counts
+    first_refill = counts.sum() + np.cumsum(refills) - refills
+    items = [(filenames[i], int(f), int(r)) for (i, f, r) in zip(order, first, first_refill)]
+
+    groups = [g.tolist() for g in np.array_split(np.arange(len(items)), processes) if g.size > 0]
+    partials = run(merge_group, [[items[i] for i in g] for g in groups])
+
+    merged = combine_parts(partials)
+
+    num_shards = int(merged.get('num_shards', len(filenames)))
+    if len(filenames) != num_shards:
+        print('Warning: merged %i of %i shards'%(len(filenames), num_shards))
+    if output is not None:
+        out_dir = os.path.dirname(output)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        np.savez(output, **merged)
+        print('Merged %i shards (%i slots, %i exits) into %s'%(
+              len(filenames), merged['status'].size, merged['exit_id'].size, output))
+    return merged
+
+
+def shard_command(run_args, shard, num_shards, output, script=None):
+    """
+    Command line of ``run.py`` running one shard of a job.
+
+    Parameters
+    ----------
+    run_args   : list
+                 ``run.py`` arguments of the whole job, with ``--seed``
+    shard      : int
+                 shard id
+    num_shards : int
+                 number of shards of the job
+    output     : str
+                 output file of the shard
+    script     : str, optional
+                 path of ``run.py``, next to this module by default
+
+    Returns
+    -------
+    command : list
+              the command, run with the current Python interpreter
+    """
+    if script is None:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run.py')
+    return ([sys.executable, script] + list(run_args) +
+            ['--shard', str(shard), '--num_shards', str(num_shards), '-o', output])
+
+
+def run_shards(run_args, num_shards, shard_dir, processes=None, script=None):
+    """
+    Run every shard of a job in its own process, at most ``processes`` at once.
+
+    Parameters
+    ----------
+    run_args   : list
+                 ``run.py`` arguments of the whole job, with ``--seed``
+    num_shards : int
+                 number of shards
+    shard_dir  : str
+                 directory of the shard outputs and logs
+    processes  : int, optional
+                 shards run at once, one per CPU by default
+    script     : str, optional
+                 path of ``run.py``
+
+    Returns
+    -------
+    filenames : list
+                shard output files, in shard order
+    """
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    filenames = [os.path.join(shard_dir, 'shard_%04i.npz'%i) for i in range(num_shards)]
+
+    def run(shard):
+        command = shard_command(run_args, shard, num_shards, filenames[shard], script=script)
+        with open(os.path.join(shard_dir, 'shard_%04i.log'%shard), 'w') as log:
+            return subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+
+    with ThreadPoolExecutor(max_workers=processes or os.cpu_count() or 1) as executor:
+        codes = list(executor.map(run, range(num_shards)))
+
+    failed = [i for (i, code) in enumerate(codes) if code != 0]
+    if failed:
+        raise RuntimeError("Shards %s failed, see their logs in %s."%(failed, shard_dir))
+    return filenames
@@ -0,0 +1,275 @@
+from __future__ import absolute_import
+
+try:
+    import os
+    import sys
+    import ctypes
+    import threading
+    import subprocess
+    from PIL import Image
+    from OpenGL.GL import * # OpenGL - GPU rendering interface
+
+    if sys.version_info[0] < 3:
+        import Queue as queue_module
+    else:
+        import queue as queue_module
+
+    try:
+        from shutil import which
+    except ImportError:
+        from distutils.spawn import find_executable as which
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+
+def write_png(filename, data, width, height):
+    """
+    Encode and save a frame read from the OpenGL framebuffer as a PNG.
+
+    Parameters
+    ----------
+    filename : str
+               output file path
+    data     : bytes
+               RGBA pixels, bottom row first as read by OpenGL
+    width    : int
+               frame width in pixels
+    height   : int
+               frame height in pixels
+    """
+    # Negative orientation flips the rows, OpenGL reads bottom-up
+    im = Image.frombuffer("RGBA", (width, height), data, "raw", "RGBA", 0, -1)
+    im.save(filename)
+
+
+class FrameCapture(object):
+    """
+    Asynchronous capture of rendered frames.
+
+    Each frame is read at the current window size into one of
+    ``num_buffers`` rotating pixel buffer objects, so that ``glReadPixels``
+    returns without waiting for the GPU. A buffer is mapped only when it
+    comes around again, ``num_buffers-1`` frames later, by which time the
+    transfer is done. The pixels are then handed to ``num_writers``
+    background threads encoding and saving them. At most ``max_pending``
+    frames wait for a writer: when encoding falls behind, capture blocks
+    rather than dropping frames or growing memory without bound.
+
+    Parameters
+    ----------
+    prefix      : str
+                  output path prefix, frames are written to prefix%05i.png
+    num_buffers : int, optional
+                  pixel buffer objects in rotation, at least 2
+    num_writers : int, optional
+                  background writer threads
+    max_pending : int, optional
+                  frames waiting for a writer at most
+    write_frame : callable, optional
+                  ``write_frame(number, data, width, height)`` writes a frame
+                  from a writer thread, a PNG under ``prefix`` by default.
+                  Its ``close`` method, if any, is called once all frames are
+                  written. Writers needing the frames in order, such as
+                  ``VideoWriter``, take a single writer thread.
+    read_buffer : int, optional
+                  color buffer frames are read from, the back buffer by
+                  default, or the attachment of a framebuffer object
+    """
+    def __init__(self, prefix, num_buffers=3, num_writers=2, max_pending=8, write_frame=None,
+                 read_buffer=GL_BACK):
+        if num_buffers < 2:
+            raise ValueError("Frame capture needs at least 2 pixel buffers.")
+
+        self.prefix = prefix
+        self.write_frame = write_frame or self._write_png
+        self.read_buffer = read_buffer
+        self.frame = 0
+        self.pbos = [int(b) for b in glGenBuffers(num_buffers)]
+        self.sizes = [0]*num_buffers
+        # (frame number, width, height) read into each buffer and not yet drained
+        self.pending = [None]*num_buffers
+        self._error = None
+
+        out_dir = os.path.dirname(prefix)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+        self._queue = queue_module.Queue(maxsize=max_pending)
+        self._writers = []
+        for i in range(num_writers):
+            writer = threading.Thread(target=self._write_frames)
+            writer.daemon = True
+            writer.start()
+            self._writers.append(writer)
+
+    def capture(self, width, height):
+        """
+        Start reading the current frame, and hand
+        the frame read ``num_buffers-1`` frames ago to the writers.
+        Call after rendering, and before swapping buffers.
+        """
+        if self._error is not None:
+            raise self._error
+
+        width, height = int(width), int(height)
+        slot = self.frame % len(self.pbos)
+        self._drain(slot)
+
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[slot])
+        nbytes = 4*width*height
+        if self.sizes[slot] != nbytes:
+            # The window was resized
+            glBufferData(GL_PIXEL_PACK_BUFFER, nbytes, None, GL_STREAM_READ)
+            self.sizes[slot] = nbytes
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glReadBuffer(self.read_buffer)
+        glReadPixels(0, 0, width, height, GL_RGBA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+        self.pending[slot] = (self.frame, width, height)
+        self.frame += 1
+
+    def flush(self):
+        """
+        Hand every frame still in the pixel buffers to the writers, in order.
+        """
+        for i in range(len(self.pbos)):
+            self._drain((self.frame + i) % len(self.pbos))
+
+    def close(self):
+        """
+        Write all captured frames, stop the writers and free the pixel buffers.
+        """
+        self.flush()
+        for writer in self._writers:
+            self._queue.put(None)
+        for writer in self._writers:
+            writer.join()
+        glDeleteBuffers(len(self.pbos), self.pbos)
+        if self._error is not None:
+            raise self._error
+        if hasattr(self.write_frame, 'close'):
+            self.write_frame.close()
+        print('Captured %i frames to %s*'%(self.frame, self.prefix))
+
+    def _drain(self, slot):
+        if self.pending[slot] is None:
+            return
+        (number, width, height) = self.pending[slot]
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[slot])
+        address = glMapBuffer(GL_PIXEL_PACK_BUFFER, GL_READ_ONLY)
+        data = ctypes.string_at(address, 4*width*height)
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.pending[slot] = None
+        # Blocks while max_pending frames wait for a writer
+        self._queue.put((number, data, width, height))
+
+    def _write_frames(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                if self._error is None:
+                    self.write_frame(*item)
+            except Exception as e:
+                self._error = e
+
+    def _write_png(self, number, data, width, height):
+        write_png('%s%05i.png'%(self.prefix, number), data, width, height)
+
+
+class VideoWriter(object):
+    """
+    Stream captured frames into a movie through an ffmpeg subprocess.
+
+    Raw RGBA frames are piped to ffmpeg's standard input and encoded in
+    one pass, without intermediate image files. Writes block while ffmpeg
+    is busy, which holds back frame capture in turn. When ffmpeg is not
+    installed, frames are appended to a raw RGBA stream next to the movie
+    instead, and the command encoding it is printed on close. Resizing the
+    window starts a new movie, numbered after the first one.
+
+    Use as the ``write_frame`` of a ``FrameCapture`` with one writer thread.
+
+    Parameters
+    ----------
+    filename : str
+               output movie file
+    fps      : float, optional
+               frame rate of the movie
+    codec    : str, optional
+               ffmpeg video codec
+    ffmpeg   : str, optional
+               ffmpeg executable, found on the PATH by default
+    """
+    def __init__(self, filename, fps=60, codec='libx264', ffmpeg=None):
+        self.filename = filename
+        self.fps = fps
+        self.codec = codec
+        self.ffmpeg = ffmpeg or which('ffmpeg')
+        self.size = None
+        self.outputs = []
+        self._stream = None
+        self._process = None
+
+        if self.ffmpeg is None:
+            print('ffmpeg not found, writing raw frames for a later encode')
+
+    def __call__(self, number, data, width, height):
+        if (width, height) != self.size:
+            self._open(width, height)
+        self._stream.write(data)
+
+    def command(self, width, height, source='-', output=None):
+        """
+        ffmpeg command encoding raw frames of the given size from source.
+        """
+        # OpenGL rows are bottom-up, and yuv420p needs even sizes
+        return [self.ffmpeg or 'ffmpeg', '-y', '-loglevel', 'error',
+                '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', '%ix%i'%(width, height),
+                '-framerate', str(self.fps), '-i', source,
+                '-vf', 'vflip,pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                '-c:v', self.codec, '-pix_fmt', 'yuv420p', output or self.filename]
+
+    def close(self):
+        """
+        Finish the current movie, or raw stream.
+        """
+        if self._stream is None:
+            return
+        self._stream.close()
+        self._stream = None
+        (output, width, height) = self.outputs[-1]
+        if self._process is not None:
+            if self._process.wait() != 0:
+                raise IOError('ffmpeg failed to encode %s'%output)
+            self._process = None
+            print('Wrote movie %s'%output)
+        else:
+            movie = os.path.splitext(output)[0] + os.path.splitext(self.filename)[1]
+            print('Wrote raw frames to %s, encode them with'%output)
+            print('    ' + ' '.join(self.command(width, height, source=output, output=movie)))
+
+    def _open(self, width, height):
+        self.close()
+        self.size = (width, height)
+        output = self.filename
+        if len(self.outputs) > 0:
+            (root, ext) = os.path.splitext(self.filename)
+            output = '%s_%02i%s'%(root, len(self.outputs), ext)
+        out_dir = os.path.dirname(output)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+        if self.ffmpeg is not None:
+            self._process = subprocess.Popen(self.command(width, height, output=output),
+                                             stdin=subprocess.PIPE)
+            self._stream = self._process.stdin
+        else:
+            output = os.path.splitext(output)[0] + '.rgba'
+            self._stream = open(output, 'wb')
+        self.outputs.append((output, width, height))
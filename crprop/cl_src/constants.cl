@@ -12,7 +12,11 @@
 __constant float speed_of_light = 299792458.; // m/s
 __constant float c2 = 299792458. * 299792458.;
 __constant float E_r = 6371.2; // Earth Radius (km)
-__constant float E_r_m = 6378137; // Earth Radius (m)
+// Earth radius (m), defined by build_program from definitions.py
+#ifndef EARTH_RADIUS_M
+#define EARTH_RADIUS_M 6378137.0f
+#endif
+__constant float E_r_m = EARTH_RADIUS_M; // Earth Radius (m)
 __constant float inv_E_r = 0.000156956303365143; // Earth Radius (km)
 __constant float BMAG = 0.000033; // Tesla
 
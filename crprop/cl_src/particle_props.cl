@@ -20,23 +20,55 @@ struct particle_struct
 
 
 
-static float4 AccelFunc(float4 pos, float4 vel)
+// Field models, matching field_model_dict in field_utils.py
+#define FIELD_DIPOLE  1
+#define FIELD_IGRF    2
+#define FIELD_UNIFORM 3
+
+
+// Magnetic field at pos
+// The model is fixed at build time: the gridded field with -D FIELD_GRID,
+// else -D FIELD_MODEL=<model>, else the stepper's default_model.
+// Build with -D IGRF_DIRECT to use the direct IGRF evaluation.
+static float4 GetField(float4 pos, struct field_struct *field, int default_model)
+{
+#ifdef FIELD_GRID
+    return GetGridField(pos, field);
+#else
+#ifdef FIELD_MODEL
+    int model = FIELD_MODEL;
+#else
+    int model = default_model;
+#endif
+    if (model == FIELD_UNIFORM)
+        return GetUniformField();
+    else if (model == FIELD_IGRF)
+#ifdef IGRF_DIRECT
+        return igrf(pos, field);
+#else
+        return igrf_recurrence(pos, field);
+#endif
+    return GetDipoleField(pos);
+#endif
+}
+
+
+static float4 AccelFunc(float4 pos, float4 vel, struct field_struct *field)
 {
     // Get Magnetic field at pos & calc acceleration
-    //float4 B = GetUniformField();
-    float4 B = GetDipoleField(pos);
+    float4 B = GetField(pos, field, FIELD_DIPOLE);
     float4 accel = vec_three_cross(vel, B);
     
     return accel;
 }
 
 // Euler method
-static void PropStepEuler(float dt, struct particle_struct *particle)
+static void PropStepEuler(float dt, struct particle_struct *particle, struct field_struct *field)
 {
     float4 pos = particle->pos;
     float4 vel = particle->vel;
     // Get acceleration at p
-    float4 accel = AccelFunc(pos, vel);
+    float4 accel = AccelFunc(pos, vel, field);
 
     float Z = particle->ZMEL.x;
     float mass = particle->ZMEL.y;
@@ -57,7 +89,7 @@ static void PropStepEuler(float dt, struct particle_struct *particle)
 }
 
 // Currently not correct units...
-static void PropStepRK4(float dt, struct particle_struct *particle)
+static void PropStepRK4(float dt, struct particle_struct *particle, struct field_struct *field)
 {
     // http://www.mare.ee/indrek/ephi/nystrom.pdf
     float4 K1, K2, K3, K4;
@@ -69,7 +101,7 @@ static void PropStepRK4(float dt, struct particle_struct *particle)
     float mass = particle->ZMEL.y;
     float inv_gamman = 1./particle->ZMEL.w;
 
-    K1 = AccelFunc(pos, vel);
+    K1 = AccelFunc(pos, vel, field);
 
     float4 v_hs = vec_scale(0.5*dt, vel);
     float4 x_hs = vec_sum(pos, v_hs);
@@ -79,14 +111,14 @@ static void PropStepRK4(float dt, struct particle_struct *particle)
     k2_x = vec_sum(k2_x, x_hs);
     float4 k2_v = vec_scale(0.5*dt, K1);
     k2_v = vec_sum(vel, k2_v);
-    K2 = AccelFunc(k2_x, k2_v);
+    K2 = AccelFunc(k2_x, k2_v, field);
 
     // K3
     float4 k3_x = vec_scale(0.125*dt*dt, K2);
     k3_x = vec_sum(k3_x, x_hs);
     float4 k3_v = vec_scale(0.5*dt, K2);
     k3_v = vec_sum(vel, k3_v);
-    K3 = AccelFunc(k3_x, k3_v);
+    K3 = AccelFunc(k3_x, k3_v, field);
 
     // K4
     float4 k4_x = vec_scale(0.5*dt*dt, K3);
@@ -94,7 +126,7 @@ static void PropStepRK4(float dt, struct particle_struct *particle)
     k4_x = vec_sum(k4_x, v_hs);
     float4 k4_v = vec_scale(dt, K3);
     k4_v = vec_sum(vel, k4_v);
-    K4 = AccelFunc(k4_x, k4_v);
+    K4 = AccelFunc(k4_x, k4_v, field);
 
     // Update position
     float4 p_upd = vec_sum(K1, K2);
@@ -119,7 +151,7 @@ static void PropStepRK4(float dt, struct particle_struct *particle)
 }
 
 // Boris-Buneman Integrator
-static void PropStepBoris(float dt, struct particle_struct *particle, struct igrf_struct *coeff_struct)
+static void PropStepBoris(float dt, struct particle_struct *particle, struct field_struct *field)
 {
 // https://en.wikipedia.org/wiki/Particle-in-cell
 // http://e-collection.library.ethz.ch/eserv/eth:5175/eth-5175-01.pdf
@@ -132,9 +164,7 @@ static void PropStepBoris(float dt, struct particle_struct *particle, struct igr
     float mass = particle->ZMEL.y;
     float inv_gamman = 1./particle->ZMEL.w;
 
-    //float4 B = igrf(pos, coeff_struct);
-    float4 B = GetDipoleField(pos);
-    //float4 B = GetUniformField();
+    float4 B = GetField(pos, field, FIELD_DIPOLE);
 
     float q = 0.5*Z*dt*inv_gamman/mass;
     //float q = 0.5*Z*dt/mass;
@@ -164,7 +194,7 @@ static void PropStepBoris(float dt, struct particle_struct *particle, struct igr
 }
 
 // Adaptive Boris-Buneman Integrator
-static void PropStepAdaptBoris(float dt, struct particle_struct *particle, struct igrf_struct *coeff_struct)
+static void PropStepAdaptBoris(float dt, struct particle_struct *particle, struct field_struct *field)
 {
 // https://en.wikipedia.org/wiki/Particle-in-cell
 // http://e-collection.library.ethz.ch/eserv/eth:5175/eth-5175-01.pdf
@@ -177,13 +207,11 @@ static void PropStepAdaptBoris(float dt, struct particle_struct *particle, struc
     float mass = particle->ZMEL.y;
     float inv_gamman = 1./particle->ZMEL.w;
 
-    float4 B = igrf(pos, coeff_struct);
-    //float4 B = GetDipoleField(pos);
-    //float4 B = GetUniformField();
+    float4 B = GetField(pos, field, FIELD_IGRF);
     float Bmag = B.w;
 
     float tan_arg = 0.5 * THETA_MIN;
-    float dt_theta = 2.*mass*tan(tan_arg)/(Z*Bmag*inv_gamman);
+    float dt_theta = 2.*mass*tan(tan_arg)/(fabs(Z)*Bmag*inv_gamman);
     //float dt_theta = 2.*mass*tan(tan_arg)/(Z*Bmag);
     dt = MIN(dt_theta,dt); 
 
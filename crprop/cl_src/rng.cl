@@ -0,0 +1,39 @@
+#ifndef RNG_CL
+#define RNG_CL
+
+// Counter-based random numbers (Philox4x32-10, Salmon et al. 2011).
+// Each call maps a 128 bit counter and a 64 bit key to four
+// independent 32 bit words, so any particle's random numbers follow
+// from (seed, particle id) alone, with no generator state to carry.
+// philox4x32 in rng_utils.py is the matching host implementation.
+
+#define PHILOX_M0 0xD2511F53u
+#define PHILOX_M1 0xCD9E8D57u
+#define PHILOX_W0 0x9E3779B9u
+#define PHILOX_W1 0xBB67AE85u
+#define PHILOX_ROUNDS 10
+
+
+static uint4 Philox4x32(uint4 ctr, uint2 key)
+{
+    for (int i = 0; i < PHILOX_ROUNDS; i++)
+    {
+        uint hi0 = mul_hi(PHILOX_M0, ctr.x);
+        uint lo0 = PHILOX_M0*ctr.x;
+        uint hi1 = mul_hi(PHILOX_M1, ctr.z);
+        uint lo1 = PHILOX_M1*ctr.z;
+        ctr = (uint4)(hi1^ctr.y^key.x, lo1, hi0^ctr.w^key.y, lo0);
+        key.x += PHILOX_W0;
+        key.y += PHILOX_W1;
+    }
+    return ctr;
+}
+
+
+// Uniform float in [0, 1) from the top 24 bits of a random word
+static float UniformFloat(uint x)
+{
+    return (float)(x >> 8)*(1.0f/16777216.0f);
+}
+
+#endif // RNG_CL
@@ -5,61 +5,63 @@
 #include <vector_funcs.cl>
 #include <particle_props.cl>
 #include <bfield.cl>
+#include <rng.cl>
 
 
 
+// Single integration step with the stepper function of choice
+// Building with -D EOM_INTEGRATOR=<index> fixes the stepper at
+// compile time, ignoring the runtime integrator option
+static void Step(float time_step,
+                 int integrator,
+                 struct particle_struct *particle,
+                 struct field_struct *field)
+{
+#ifdef EOM_INTEGRATOR
+    integrator = EOM_INTEGRATOR;
+#endif
+    if (integrator == 1)
+        PropStepEuler(time_step, particle, field);
+    else if (integrator == 2)
+        PropStepRK4(time_step, particle, field);
+    else if (integrator == 3)
+        PropStepBoris(time_step, particle, field);
+    else if (integrator == 4)
+        PropStepAdaptBoris(time_step, particle, field);
+}
+
+
 // Propagation Step function
 static void Propagate(float time_step,
                       int integrator,
                       struct particle_struct *particle, 
-                      float4 startp, float4 startv, 
-                      struct igrf_struct *coeff_struct)
+                      struct field_struct *field)
 {
 
     float life = vec_three_Mag(particle->pos);
 
-    // If particle hits Earth or get too far away, respawn
+    // If particle hits Earth or get too far away, park it
     bool death = (life<=E_r_m || life>10.f*E_r_m);
     if (death)
     {
-        float speed = vec_three_Mag(particle->vel);
-        particle->pos = 1e10;//vec_scale(E_r_m,startp);
-        particle->vel = 0;//vec_scale(speed,startv);
-        life = vec_three_Mag(startp); 
+        particle->pos = 1e10;
+        particle->vel = 0;
+        // Parked particles are no longer integrated
+        return;
     }
 
-    if (integrator == 1)
-        PropStepEuler(time_step, particle);
-    else if (integrator == 2)
-        PropStepRK4(time_step, particle);
-    else if (integrator == 3)
-        PropStepBoris(time_step, particle, coeff_struct);
-    else if (integrator == 4)
-        PropStepAdaptBoris(time_step, particle, coeff_struct);
+    Step(time_step, integrator, particle, field);
 }
 
 
-// Main kernel function
-__kernel void particle_prop(__global float4* position, 
-                            __global float4* color,
-                            __global float4* velocity,
-                            __global float4* zmel,
-                            __global float4* start_position,
-                            __global float4* start_velocity,
-                            float4 options)
-                            //float maxE,
-                            //float range,
-                            //float time_step)
+// Load a particle from global memory into private memory,
+// scaling position to meters and direction to speed
+static void LoadParticle(unsigned int gid,
+                         __global float4* position,
+                         __global float4* velocity,
+                         __global float4* zmel,
+                         struct particle_struct *particle)
 {
-    // Get this particles address on GPU
-    unsigned int gid = get_global_id(0);
-
-    // Global runtime options
-    float time_step = options.x;
-    float maxE = options.y;
-    float range = options.z;
-    int eom_integrator = int(options.w);
-
     // Grab position and direction vectors
     float4 p = vec_scale(E_r_m,position[gid]);
     float4 v = velocity[gid];
@@ -74,37 +76,446 @@ __kernel void particle_prop(__global float4* position,
     v = vec_scale(speed,v);
 
     // Put gid particle's properties in struct
-    struct particle_struct particle;
-    particle.pos = p;
-    particle.vel = v;
-    particle.ZMEL = zmel[gid];
-    particle.alive = true;
-    particle.time = velocity[gid].w;
-
-    // Allocate igrf coefficients with current days since 2000
-    struct igrf_struct coeff_struct;
-    coeff_struct.days = 0.f;
-    SetCoeffIndexScheme(&coeff_struct);
+    particle->pos = p;
+    particle->vel = v;
+    particle->ZMEL = zmel[gid];
+    particle->alive = true;
+    particle->time = velocity[gid].w;
+}
 
-    // Propagate in time via stepper function of choice
-    Propagate(time_step, eom_integrator, &particle, start_position[gid], start_velocity[gid], &coeff_struct);
 
+// Write a particle back to global memory,
+// ensuring to scale properly for viewing
+static void StoreParticle(unsigned int gid,
+                          __global float4* position,
+                          __global float4* velocity,
+                          __global float4* zmel,
+                          struct particle_struct *particle)
+{
     // Grab position and velocity, ensuring to scale properly for viewing
-    p = particle.pos;
+    float4 p = particle->pos;
     p = vec_scale(1./E_r_m,p);
     p.w = 1.;
     position[gid] = p;
 
-    v = particle.vel;
-    v.w = particle.time;
+    float4 v = particle->vel;
+    v.w = particle->time;
     velocity[gid] = v;
     
-    zmel[gid].w = particle.ZMEL.w;
-    
-    float energy = log10(particle.ZMEL.z);
+    zmel[gid].w = particle->ZMEL.w;
+}
+
+
+// Write a particle's display color, mapping its energy onto the visible spectrum
+static void StoreColor(unsigned int gid,
+                       __global float4* color,
+                       struct particle_struct *particle,
+                       float maxE, float range)
+{
+    float energy = log10(particle->ZMEL.z);
     float lambda = (780.-380.)*(maxE-energy)/range+380.;
     if (range == 0.)
         lambda = 580.;
     color[gid] = Colors(lambda);
     color[gid].w = 1.0f; /* Fade points as life decreases */
 }
+
+
+// Initialization kernel: work-item gid draws particle first_id+gid from
+// the Philox stream keyed by the run seed, into slot slots[gid], or gid
+// if not indexed. Particles start at site (Earth radii) and time t0, with
+// directions as in initial_buffers: reversed unit vectors of polar angle
+// theta, cos(theta) uniform in [cos_theta_min, 1], and uniform azimuth
+// (isotropic for cos_theta_min = -1). Each particle is of species s with
+// probability species[s].w - species[s-1].w (cumulative fractions), of
+// charge species[s].x (C), mass species[s].y (kg) and rest energy
+// species[s].z (eV), and its kinetic energy follows E^-spectra[s].z between
+// spectra[s].x and spectra[s].y (eV), so all species of a composition are
+// drawn in a single launch.
+// init_states in rng_utils.py is the matching host implementation.
+__kernel void particle_init(__global const int* slots,
+                            __global float4* position,
+                            __global float4* velocity,
+                            __global float4* zmel,
+                            uint2 key,
+                            ulong first_id,
+                            int indexed,
+                            float4 site,
+                            __constant float4* species,
+                            __constant float4* spectra,
+                            int num_species,
+                            float cos_theta_min,
+                            float t0)
+{
+    unsigned int gid = get_global_id(0);
+    unsigned int slot = indexed ? slots[gid] : gid;
+    ulong id = first_id + gid;
+
+    uint4 r = Philox4x32((uint4)((uint)id, (uint)(id >> 32), 0u, 0u), key);
+
+    // Direction, as sph2cart(-1, phi, theta) in initial_buffers
+    float phi = 2.f*PI*UniformFloat(r.x);
+    float cos_theta = cos_theta_min + (1.f-cos_theta_min)*UniformFloat(r.y);
+    float sin_theta = sqrt(max(1.f-cos_theta*cos_theta, 0.f));
+    velocity[slot] = (float4)(-sin_theta*cos(phi), -sin_theta*sin(phi), -cos_theta, t0);
+
+    // Species from the cumulative fractions
+    float u_species = UniformFloat(r.w);
+    int s = 0;
+    while (s < num_species-1 && u_species >= species[s].w)
+        s++;
+    float4 spectrum = spectra[s];
+
+    // Power law energy by inverse transform sampling
+    float log_ratio = log(spectrum.y/spectrum.x);
+    float g = 1.f - spectrum.z;
+    float u = UniformFloat(r.z);
+    float log_E = (fabs(g*log_ratio) < 1e-6f) ? u*log_ratio : log1p(u*expm1(g*log_ratio))/g;
+    float energy = spectrum.x*exp(log_E);
+    zmel[slot] = (float4)(species[s].x, species[s].y, energy, energy/species[s].z + 1.f);
+
+    position[slot] = (float4)(site.x, site.y, site.z, 1.f);
+}
+
+
+// Main kernel function
+__kernel void particle_prop(__global float4* position, 
+                            __global float4* color,
+                            __global float4* velocity,
+                            __global float4* zmel,
+                            __constant float* igrf_coeffs,
+                            __global const float4* field_grid,
+                            float4 options)
+                            //float maxE,
+                            //float range,
+                            //float time_step)
+{
+    // Get this particles address on GPU
+    unsigned int gid = get_global_id(0);
+
+    // Global runtime options
+    float time_step = options.x;
+    float maxE = options.y;
+    float range = options.z;
+    int eom_integrator = (int)options.w;
+
+    struct particle_struct particle;
+    LoadParticle(gid, position, velocity, zmel, &particle);
+
+    // Field model data, shared by all particles
+    struct field_struct field;
+    field.igrf_coeffs = igrf_coeffs;
+    field.grid = field_grid;
+
+    // Propagate in time via stepper function of choice
+    Propagate(time_step, eom_integrator, &particle, &field);
+
+    StoreParticle(gid, position, velocity, zmel, &particle);
+    StoreColor(gid, color, &particle, maxE, range);
+}
+
+
+// Multi-step kernel function: the particle stays in private
+// memory for num_substeps integrator steps and is written back once
+__kernel void particle_prop_multistep(__global float4* position, 
+                                      __global float4* color,
+                                      __global float4* velocity,
+                                      __global float4* zmel,
+                                      __constant float* igrf_coeffs,
+                                      __global const float4* field_grid,
+                                      float4 options,
+                                      int num_substeps)
+{
+    // Get this particles address on GPU
+    unsigned int gid = get_global_id(0);
+
+    // Global runtime options
+    float time_step = options.x;
+    float maxE = options.y;
+    float range = options.z;
+    int eom_integrator = (int)options.w;
+
+    struct particle_struct particle;
+    LoadParticle(gid, position, velocity, zmel, &particle);
+
+    // Field model data, shared by all particles
+    struct field_struct field;
+    field.igrf_coeffs = igrf_coeffs;
+    field.grid = field_grid;
+
+    // Propagate in time via stepper function of choice
+    for (int i = 0; i < num_substeps; i++)
+        Propagate(time_step, eom_integrator, &particle, &field);
+
+    StoreParticle(gid, position, velocity, zmel, &particle);
+    StoreColor(gid, color, &particle, maxE, range);
+}
+
+
+// Particle lifecycle states for batch runs
+#define LIFE_ALIVE   0 // still being propagated
+#define LIFE_EARTH   1 // hit the Earth
+#define LIFE_ESCAPED 2 // got past the outer radius
+
+
+// Batch propagation shared by the headless kernels: advances
+// particle idx by up to num_substeps steps of time_step with the
+// given integrator. A particle hitting the Earth or passing 10 Earth
+// radii is marked dead in status, with its exit position (Earth radii,
+// time in w) and direction (reason in w) in exit_record, and is no
+// longer propagated. The particle state is optionally recorded every
+// record_opts.x steps (0 disables recording) into a device-side ring buffer.
+// record_opts.y is the number of steps taken before this launch,
+// record_opts.z the number of samples held by the ring buffer,
+// and record_opts.w the total number of particles.
+// Each sample holds the position (Earth radii) and velocity (m/s)
+// of every particle, both with the time (s) in the last component.
+// Particles stop at the simulated time stop_time, the last step
+// being shortened to land on it.
+static void BatchSteps(unsigned int idx,
+                       float time_step,
+                       int eom_integrator,
+                       __global float4* position,
+                       __global float4* velocity,
+                       __global float4* zmel,
+                       __global int* status,
+                       __global float4* exit_record,
+                       __constant float* igrf_coeffs,
+                       __global const float4* field_grid,
+                       __global float4* record,
+                       int num_substeps,
+                       int4 record_opts,
+                       float stop_time)
+{
+    int record_every = record_opts.x;
+    int step = record_opts.y;
+    int ring_samples = record_opts.z;
+    size_t num_particles = record_opts.w;
+
+    // Dead particles stay in the active list until the next compaction,
+    // and are no longer integrated, keeping their exit record
+    if (status[idx] != LIFE_ALIVE)
+        return;
+
+    struct particle_struct particle;
+    LoadParticle(idx, position, velocity, zmel, &particle);
+
+    // Field model data, shared by all particles
+    struct field_struct field;
+    field.igrf_coeffs = igrf_coeffs;
+    field.grid = field_grid;
+
+    int life = LIFE_ALIVE;
+    for (int i = 0; i < num_substeps; i++)
+    {
+        // Within rounding of the stop time, the particle is done
+        float remaining = stop_time - particle.time;
+        if (remaining <= 1e-3f*time_step)
+            break;
+        Step(fmin(time_step, remaining), eom_integrator, &particle, &field);
+        step++;
+
+        // On-device decimation: only every record_every'th step leaves private memory
+        if (record_every > 0 && step % record_every == 0)
+        {
+            int slot = (step/record_every - 1) % ring_samples;
+            size_t offset = 2*(slot*num_particles + idx);
+            float4 p = vec_scale(1./E_r_m,particle.pos);
+            float4 v = particle.vel;
+            p.w = particle.time;
+            v.w = particle.time;
+            record[offset] = p;
+            record[offset+1] = v;
+        }
+
+        float r = vec_three_Mag(particle.pos);
+        if (r <= E_r_m)
+            life = LIFE_EARTH;
+        else if (r > 10.f*E_r_m)
+            life = LIFE_ESCAPED;
+
+        if (life != LIFE_ALIVE)
+        {
+            float4 p = vec_scale(1./E_r_m,particle.pos);
+            float4 d = vec_normalize(particle.vel);
+            p.w = particle.time;
+            d.w = life;
+            exit_record[2*idx] = p;
+            exit_record[2*idx+1] = d;
+            status[idx] = life;
+            break;
+        }
+    }
+
+    StoreParticle(idx, position, velocity, zmel, &particle);
+}
+
+
+// Batch kernel function for headless runs: each work-item advances
+// the live particle active[gid] by up to num_substeps steps, with the
+// time step and integrator of the run options, at most up to the
+// simulated time stop_time (see BatchSteps).
+__kernel void particle_prop_batch(__global const int* active,
+                                  __global float4* position,
+                                  __global float4* velocity,
+                                  __global float4* zmel,
+                                  __global int* status,
+                                  __global float4* exit_record,
+                                  __constant float* igrf_coeffs,
+                                  __global const float4* field_grid,
+                                  __global float4* record,
+                                  float4 options,
+                                  int num_substeps,
+                                  int4 record_opts,
+                                  float stop_time)
+{
+    // Get this particles address on GPU
+    unsigned int idx = active[get_global_id(0)];
+
+    // Global runtime options
+    float time_step = options.x;
+    int eom_integrator = (int)options.w;
+
+    BatchSteps(idx, time_step, eom_integrator, position, velocity, zmel, status, exit_record,
+               igrf_coeffs, field_grid, record, num_substeps, record_opts, stop_time);
+}
+
+
+// Sweep kernel function: as particle_prop_batch, but every particle
+// takes the time step (x) and integrator (y) of its configuration,
+// configs[config_id[idx]], so that many configurations share a launch.
+// The arguments common to particle_prop_batch keep their positions.
+__kernel void particle_prop_sweep(__global const int* active,
+                                  __global float4* position,
+                                  __global float4* velocity,
+                                  __global float4* zmel,
+                                  __global int* status,
+                                  __global float4* exit_record,
+                                  __constant float* igrf_coeffs,
+                                  __global const float4* field_grid,
+                                  __global float4* record,
+                                  float4 options,
+                                  int num_substeps,
+                                  int4 record_opts,
+                                  float stop_time,
+                                  __global const int* config_id,
+                                  __global const float4* configs)
+{
+    // Get this particles address on GPU
+    unsigned int idx = active[get_global_id(0)];
+
+    // Runtime options of the particle's configuration
+    float4 config = configs[config_id[idx]];
+
+    BatchSteps(idx, config.x, (int)config.y, position, velocity, zmel, status, exit_record,
+               igrf_coeffs, field_grid, record, num_substeps, record_opts, stop_time);
+}
+
+
+// Trajectory classes for cutoff rigidity computations
+#define TRAJ_RUNNING   0 // still being propagated
+#define TRAJ_ALLOWED   1 // escaped past the outer radius
+#define TRAJ_FORBIDDEN 2 // returned to the Earth
+#define TRAJ_BUDGET    3 // exceeded the step budget (forbidden)
+
+
+// Trajectory classification kernel function
+// Each work-item advances the unfinished trajectory active[gid]
+// by up to num_substeps steps, stopping as soon as it is classified.
+// options: time step, inner radius, outer radius (Earth radii), integrator
+__kernel void particle_classify(__global const int* active,
+                                __global float4* position,
+                                __global float4* velocity,
+                                __global float4* zmel,
+                                __global int* status,
+                                __global int* steps,
+                                __constant float* igrf_coeffs,
+                                __global const float4* field_grid,
+                                float4 options,
+                                int num_substeps,
+                                int max_steps)
+{
+    unsigned int idx = active[get_global_id(0)];
+
+    // Global runtime options
+    float time_step = options.x;
+    float rmin = options.y*E_r_m;
+    float rmax = options.z*E_r_m;
+    int eom_integrator = (int)options.w;
+
+    struct particle_struct particle;
+    LoadParticle(idx, position, velocity, zmel, &particle);
+
+    struct field_struct field;
+    field.igrf_coeffs = igrf_coeffs;
+    field.grid = field_grid;
+
+    int nsteps = steps[idx];
+    int traj_status = TRAJ_RUNNING;
+    for (int i = 0; i < num_substeps; i++)
+    {
+        Step(time_step, eom_integrator, &particle, &field);
+        nsteps++;
+
+        float r = vec_three_Mag(particle.pos);
+        if (r <= rmin)
+            traj_status = TRAJ_FORBIDDEN;
+        else if (r > rmax)
+            traj_status = TRAJ_ALLOWED;
+        else if (nsteps >= max_steps)
+            traj_status = TRAJ_BUDGET;
+
+        if (traj_status != TRAJ_RUNNING)
+            break;
+    }
+
+    float4 p = vec_scale(1./E_r_m, particle.pos);
+    p.w = 1.;
+    position[idx] = p;
+    float4 v = particle.vel;
+    v.w = particle.time;
+    velocity[idx] = v;
+    status[idx] = traj_status;
+    steps[idx] = nsteps;
+}
+
+
+// Evaluate an analytic field model at the given positions (m)
+// model: 1 = dipole, 2 = IGRF, 3 = uniform
+// Used to fill the field grid on the host side
+__kernel void sample_field(__global const float4* position,
+                           __global float4* bfield,
+                           __constant float* igrf_coeffs,
+                           int model)
+{
+    unsigned int gid = get_global_id(0);
+
+    struct field_struct field;
+    field.igrf_coeffs = igrf_coeffs;
+
+    float4 p = position[gid];
+    float4 B;
+    if (model == 1)
+        B = GetDipoleField(p);
+    else if (model == 2)
+        B = igrf_recurrence(p, &field);
+    else
+        B = GetUniformField();
+    bfield[gid] = B;
+}
+
+
+#ifdef FIELD_GRID
+// Evaluate the gridded field at the given positions (m)
+__kernel void sample_grid_field(__global const float4* position,
+                                __global float4* bfield,
+                                __global const float4* field_grid)
+{
+    unsigned int gid = get_global_id(0);
+
+    struct field_struct field;
+    field.grid = field_grid;
+
+    bfield[gid] = GetGridField(position[gid], &field);
+}
+#endif
@@ -0,0 +1,356 @@
+from __future__ import absolute_import
+
+try:
+    import os
+    import re
+    import sys
+    import hashlib
+    import pyopencl as cl # OpenCL - GPU computing interface
+    from definitions import *
+    from field_utils import field_model_dict
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+# PyOpenCL memory flags
+mf = cl.mem_flags
+
+# Compiled program binaries, keyed by source, options and device
+PROGRAM_CACHE_DIR = os.path.join(CACHE_DIR, 'kernels')
+
+# Size bound (bytes) of the program cache, least recently used binaries are evicted first
+PROGRAM_CACHE_MAX_BYTES = 256*1024**2
+
+# Compiler options for each arithmetic precision mode
+precision_dict = {'strict' : '',
+                  'fast'   : ' -cl-fast-relaxed-math'}
+
+# Dictionary for grabbing available devices
+deviceDict = {'gpu' : cl.device_type.GPU,
+              'cpu' : cl.device_type.CPU,
+              'all' : cl.device_type.ALL}
+
+
+def find_device(device_type_name='gpu', fallback=False):
+    """
+    Find the first OpenCL device of a given type
+    across all available platforms.
+
+    Parameters
+    ----------
+    device_type_name : str
+                       device type, one of 'gpu', 'cpu' or 'all'
+    fallback         : bool, optional
+                       if no device of the requested type exists,
+                       return the first device of any type
+
+    Returns
+    -------
+    platform : pyopencl.Platform
+               platform hosting the device
+    device   : list
+               single element list holding the device
+    """
+    device_type = deviceDict[device_type_name]
+    for platform in cl.get_platforms():
+        try:
+            device = platform.get_devices(device_type=device_type)
+        except cl.Error:
+            device = []
+        if len(device) > 0:
+            return platform, device[:1]
+
+    if fallback and device_type_name != 'all':
+        return find_device('all')
+
+    raise RuntimeError("No OpenCL device of type '%s' found."%device_type_name)
+
+
+def find_devices(device_type_name='all', fission=0):
+    """
+    Find every OpenCL device of a given type across all available platforms.
+
+    Parameters
+    ----------
+    device_type_name : str, optional
+                       device type, one of 'gpu', 'cpu' or 'all'
+    fission          : int, optional
+                       split CPU devices into sub-devices of this many
+                       compute units each, where the device supports it
+
+    Returns
+    -------
+    devices : list
+              the devices, or sub-devices, in platform order
+    """
+    device_type = deviceDict[device_type_name]
+    devices = []
+    for platform in cl.get_platforms():
+        try:
+            platform_devices = platform.get_devices(device_type=device_type)
+        except cl.Error:
+            platform_devices = []
+        for device in platform_devices:
+            if (fission > 0 and device.type & cl.device_type.CPU
+                    and device.max_compute_units > fission):
+                try:
+                    devices += device.create_sub_devices(
+                        [cl.device_partition_property.EQUALLY, fission])
+                    continue
+                except cl.Error:
+                    pass
+            devices.append(device)
+
+    if not devices:
+        raise RuntimeError("No OpenCL device of type '%s' found."%device_type_name)
+    return devices
+
+
+# Define pyopencl context and queue based on available hardware
+def init_device(cpu_device=False, gl_sharing=True):
+    """
+    Grab an OpenCL device and build a context on it.
+
+    Parameters
+    ----------
+    cpu_device : bool, optional
+                 run on a CPU device instead of the default GPU
+    gl_sharing : bool, optional
+                 request OpenGL sharing context properties.
+                 Without sharing (headless runs), any device
+                 is accepted if the requested type is missing.
+
+    Returns
+    -------
+    device  : list
+              list holding the selected device
+    context : pyopencl.Context
+              context built on the device
+    """
+    # Find a device... default is for GPU
+    device_type_name = 'gpu'
+    if cpu_device:
+        device_type_name = 'cpu'
+
+    print('\n============== Grabbing Compute Resources =============\n')
+    platform, device = find_device(device_type_name, fallback=not gl_sharing)
+    print('\t\tPlatform: %s'%platform)
+    print('\t\tDevice: %s'%device[0])
+    print('\n=======================================================\n')
+
+    properties = [(cl.context_properties.PLATFORM, platform)]
+    if gl_sharing:
+        from pyopencl.tools import get_gl_sharing_context_properties
+        properties += get_gl_sharing_context_properties()
+
+    context = cl.Context(devices=device, properties=properties)
+    return device, context
+
+
+def kernel_source(filename='run_prop.cl'):
+    """
+    Read an OpenCL source file and every file it includes from ``CL_SRC_PATH``.
+
+    Parameters
+    ----------
+    filename : str, optional
+               top level source file
+
+    Returns
+    -------
+    source   : str
+               contents of the top level file
+    included : str
+               concatenated contents of the whole include tree, in
+               inclusion order, which determine the compiled program
+    """
+    included = []
+    seen = set()
+
+    def read(name):
+        if name in seen:
+            return
+        seen.add(name)
+        with open(os.path.join(CL_SRC_PATH, name), 'r') as f:
+            text = f.read()
+        included.append(text)
+        for include in re.findall(r'^\s*#include\s*[<"](.+?)[>"]', text, flags=re.M):
+            read(include)
+
+    read(filename)
+    return included[0], "".join(included)
+
+
+def device_identity(device):
+    """
+    Identity of a device and its driver, which
+    determines whether a program binary can be reused.
+    """
+    return "|".join([device.platform.name, device.platform.version, device.name,
+                     device.vendor, device.version, device.driver_version,
+                     cl.VERSION_TEXT])
+
+
+def program_cache_file(included, options, device):
+    """
+    Cache file path of the program binary built from a source
+    include tree with the given options for a device.
+    """
+    key = hashlib.sha256()
+    for part in (included, options, device_identity(device)):
+        key.update(part.encode('utf-8'))
+        key.update(b'\0')
+    return os.path.join(PROGRAM_CACHE_DIR, key.hexdigest() + '.bin')
+
+
+def evict_program_cache(max_bytes=PROGRAM_CACHE_MAX_BYTES):
+    """
+    Delete the least recently used program binaries
+    until the cache holds at most ``max_bytes``.
+    """
+    if not os.path.isdir(PROGRAM_CACHE_DIR):
+        return
+    entries = []
+    for name in os.listdir(PROGRAM_CACHE_DIR):
+        path = os.path.join(PROGRAM_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for (mtime, size, path) in entries)
+    for (mtime, size, path) in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def context_programs(context):
+    """
+    Programs built in a context during this run, keyed by build options.
+
+    They are held by the context itself rather than by a module level
+    cache, so they are released together with the context.
+    """
+    programs = getattr(context, '_crprop_programs', None)
+    if programs is None:
+        programs = context._crprop_programs = {}
+    return programs
+
+
+def kernel_build_options(eom_integrator=None, field_model=None, precision='strict',
+                         igrf_eval='recurrence'):
+    """
+    OpenCL compiler options specializing the propagation kernels.
+
+    Fixing the integrator and field model at build time removes the
+    runtime stepper selection and leaves straight-line code to the compiler.
+
+    Parameters
+    ----------
+    eom_integrator : int, optional
+                     integrator index, see ``eom_dict`` in definitions.py,
+                     chosen at runtime from the kernel options if not given
+    field_model    : str, optional
+                     field model, one of ``field_model_dict``, used by every
+                     integrator; by default dipole, and IGRF for adaboris
+    precision      : str, optional
+                     arithmetic precision, one of ``precision_dict``
+    igrf_eval      : str, optional
+                     IGRF evaluation, 'recurrence' or 'direct'
+
+    Returns
+    -------
+    options : str
+              compiler options
+    """
+    options = precision_dict[precision]
+    if eom_integrator is not None:
+        options += " -D EOM_INTEGRATOR=%i"%eom_integrator
+    if field_model is not None:
+        options += " -D FIELD_MODEL=%i"%field_model_dict[field_model]
+    if igrf_eval == 'direct':
+        options += " -D IGRF_DIRECT"
+    return options
+
+
+def build_program(context, device, options='', use_cache=True):
+    """
+    Read the particle propagation OpenCL source and compile it.
+
+    Compiled binaries are cached under ``PROGRAM_CACHE_DIR``, keyed by
+    the contents of the whole include tree, the build options and the
+    device and driver identity, so later runs skip the compilation.
+    Programs are also kept in memory with their context, see ``context_programs``.
+
+    Parameters
+    ----------
+    context   : pyopencl.Context
+                context in which to build the program
+    device    : list
+                devices used for reporting the build log
+    options   : str, optional
+                additional compiler options
+    use_cache : bool, optional
+                read and write the on-disk program binary cache
+
+    Returns
+    -------
+    program : pyopencl.Program
+              compiled program
+    """
+    # Get OpenCL code and compile the program
+    fstr, included = kernel_source('run_prop.cl')
+    opts_string = "-I %s -D EARTH_RADIUS_M=%.1ff %s"%(CL_SRC_PATH, EARTH_RADIUS_M, options)
+    programs = context_programs(context)
+    if use_cache and opts_string in programs:
+        return programs[opts_string]
+
+    devices = context.devices
+    cache_files = [program_cache_file(included, opts_string, dev) for dev in devices]
+    if use_cache and all(os.path.exists(f) for f in cache_files):
+        try:
+            binaries = []
+            for f in cache_files:
+                with open(f, 'rb') as handle:
+                    binaries.append(handle.read())
+            program = cl.Program(context, devices, binaries)
+            program.build(options=opts_string, cache_dir=None)
+            # Mark as recently used for eviction
+            for f in cache_files:
+                os.utime(f, None)
+            programs[opts_string] = program
+            return program
+        except (cl.Error, IOError, OSError) as e:
+            print('Ignoring unusable cached program binary: %s'%e)
+
+    program = cl.Program(context, fstr)
+    try:
+        program.build(options=opts_string, cache_dir=None)
+    except:
+        print('Build log:')
+        print(program.get_build_info(device[0], cl.program_build_info.LOG))
+        raise
+
+    if use_cache:
+        try:
+            if not os.path.exists(PROGRAM_CACHE_DIR):
+                os.makedirs(PROGRAM_CACHE_DIR)
+            for (f, binary) in zip(cache_files, program.get_info(cl.program_info.BINARIES)):
+                # Write then rename, so concurrent runs never read a partial binary
+                tmp_file = '%s.%i.tmp'%(f, os.getpid())
+                with open(tmp_file, 'wb') as handle:
+                    handle.write(binary)
+                os.rename(tmp_file, f)
+            evict_program_cache()
+        except (IOError, OSError) as e:
+            print('Could not cache program binary: %s'%e)
+        programs[opts_string] = program
+
+    return program
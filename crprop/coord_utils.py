@@ -4,8 +4,7 @@ try:
     import os
     import sys
     import numpy as np
-    import astropy.coordinates as coords
-    from astropy import units as u
+    from definitions import *
 
 except ImportError as e:
     print(e)
@@ -141,6 +140,9 @@ def geodetic_to_geocentric(lat, lon, height=1):
     """
     Convert Geodetic direction to Geocentric positional coordinates.
 
+    Closed-form conversion on the WGS84 ellipsoid, vectorized
+    over arrays of any (broadcastable) shape.
+
     Parameters
     ----------
     lat : float
@@ -159,14 +161,131 @@ def geodetic_to_geocentric(lat, lon, height=1):
     z : float
         geocentric z value(s) in Earth radii
 
+    Example
+    -------
+    >>> from coord_utils import geodetic_to_geocentric
+    >>> geodetic_to_geocentric(0., 0., 0.)
+    (1.0, 0.0, 0.0)
     """
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    e2 = WGS84_F*(2.-WGS84_F)
 
-    r = 6.37781e6 # radius of the Earth
-    e_pos = coords.EarthLocation.from_geodetic(lat=lat*u.deg, lon=lon*u.deg,
-                                               height=height*r*u.meter)
-    x = e_pos.x.value/r
-    y = e_pos.y.value/r
-    z = e_pos.z.value/r
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+    # Prime vertical radius of curvature, in Earth radii
+    N = (WGS84_A/EARTH_RADIUS_M)/np.sqrt(1.-e2*sin_lat*sin_lat)
+
+    x = (N+height)*cos_lat*np.cos(lon)
+    y = (N+height)*cos_lat*np.sin(lon)
+    z = (N*(1.-e2)+height)*sin_lat
 
     return x, y, z
 
+
+def geocentric_to_geodetic(x, y, z):
+    """
+    Convert Geocentric positional coordinates to Geodetic coordinates.
+
+    Uses the closed-form (non-iterative) solution of Heikkinen (1982)
+    on the WGS84 ellipsoid, exact at any height above the Earth and
+    vectorized over arrays of any (broadcastable) shape.
+
+    Parameters
+    ----------
+    x : array_like
+        geocentric x value(s) in Earth radii
+    y : array_like
+        geocentric y value(s) in Earth radii
+    z : array_like
+        geocentric z value(s) in Earth radii
+
+    Returns
+    -------
+    lat    : array_like
+             geodetic latitude(s) in degrees
+    lon    : array_like
+             geodetic longitude(s) in degrees
+    height : array_like
+             height(s) above the Earth in Earth radii
+
+    Example
+    -------
+    >>> from coord_utils import geocentric_to_geodetic
+    >>> geocentric_to_geodetic(1., 0., 0.)
+    (0.0, 0.0, 0.0)
+    """
+    # Work in units of the equatorial radius
+    x = np.asarray(x, dtype=np.float64)*(EARTH_RADIUS_M/WGS84_A)
+    y = np.asarray(y, dtype=np.float64)*(EARTH_RADIUS_M/WGS84_A)
+    z = np.asarray(z, dtype=np.float64)*(EARTH_RADIUS_M/WGS84_A)
+    b = 1.-WGS84_F
+    e2 = WGS84_F*(2.-WGS84_F)
+    ep2 = e2/(b*b)
+
+    p2 = x*x + y*y
+    p = np.sqrt(p2)
+    z2 = z*z
+    F = 54.*b*b*z2
+    G = p2 + (1.-e2)*z2 - e2*e2
+    c = e2*e2*F*p2/(G*G*G)
+    s = np.cbrt(1. + c + np.sqrt(c*c + 2.*c))
+    k = s + 1. + 1./s
+    P = F/(3.*k*k*G*G)
+    Q = np.sqrt(1. + 2.*e2*e2*P)
+    r0 = (-P*e2*p/(1.+Q)
+          + np.sqrt(np.maximum(0.5*(1.+1./Q) - P*(1.-e2)*z2/(Q*(1.+Q)) - 0.5*P*p2, 0.)))
+    pe = p - e2*r0
+    U = np.sqrt(pe*pe + z2)
+    V = np.sqrt(pe*pe + (1.-e2)*z2)
+    z0 = b*b*z/V
+
+    lat = np.degrees(np.arctan2(z + ep2*z0, p))
+    lon = np.degrees(np.arctan2(y, x))
+    height = U*(1. - b*b/V)*(WGS84_A/EARTH_RADIUS_M)
+
+    return lat, lon, height
+
+
+def local_sky_direction(lat, lon, zenith, azimuth):
+    """
+    Convert local horizontal sky directions at a site to
+    geocentric Cartesian unit vectors pointing towards the sky.
+
+    Parameters
+    ----------
+    lat     : float
+              geodetic latitude of the site in degrees
+    lon     : float
+              geodetic longitude of the site in degrees
+    zenith  : array_like
+              zenith angle(s) in degrees
+    azimuth : array_like
+              azimuth angle(s) in degrees, from north towards east
+
+    Returns
+    -------
+    direction : array_like
+                Nx3 geocentric unit vectors
+
+    Example
+    -------
+    >>> from coord_utils import local_sky_direction
+    >>> local_sky_direction(0., 0., 0., 0.)
+    array([[1., 0., 0.]])
+    """
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    zenith = np.radians(np.atleast_1d(zenith))
+    azimuth = np.radians(np.atleast_1d(azimuth))
+
+    # Local up, north and east unit vectors
+    up = np.array([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+    north = np.array([-np.sin(lat)*np.cos(lon), -np.sin(lat)*np.sin(lon), np.cos(lat)])
+    east = np.array([-np.sin(lon), np.cos(lon), 0.])
+
+    direction = (np.outer(np.cos(zenith), up)
+                 + np.outer(np.sin(zenith)*np.cos(azimuth), north)
+                 + np.outer(np.sin(zenith)*np.sin(azimuth), east))
+
+    return direction
@@ -0,0 +1,301 @@
+from __future__ import absolute_import
+
+try:
+    import os
+    import sys
+    import time
+    import numpy as np
+    import pyopencl as cl # OpenCL - GPU computing interface
+    from definitions import *
+    from coord_utils import geodetic_to_geocentric, local_sky_direction
+    from particle_utils import get_particle_props
+    from field_utils import igrf_coefficients
+    from headless_utils import field_grid_buffer
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+# PyOpenCL memory flags
+mf = cl.mem_flags
+
+# Trajectory classes, matching run_prop.cl
+TRAJ_RUNNING = 0    # still being propagated
+TRAJ_ALLOWED = 1    # escaped past the outer radius
+TRAJ_FORBIDDEN = 2  # returned to the Earth
+TRAJ_BUDGET = 3     # exceeded the step budget (forbidden)
+TRAJ_SKIPPED = 4    # below a converged cutoff, assumed forbidden
+
+# Elementary charge (C), as used in particle_properties.json
+ELEMENTARY_CHARGE = 1.602176462e-19
+
+# Outer radius (Earth radii) past which a trajectory escapes
+CUTOFF_RMAX = 10.
+
+
+def antiparticle_zmel(rigidity, particle_type='proton'):
+    """
+    Charge, mass, energy and gamma of antiparticles
+    of a given species and rigidity, for backtracking.
+
+    Parameters
+    ----------
+    rigidity      : array_like
+                    particle rigidities in GV
+    particle_type : str, optional
+                    particle species
+
+    Returns
+    -------
+    zmel : array_like
+           Nx4 float32 array of charge (C, sign reversed),
+           mass (kg), kinetic energy (eV) and gamma
+    """
+    particle_dict = get_particle_props(particle_type)
+    chargeC = particle_dict['charge']
+    masseV = particle_dict['masseV']
+    Z = chargeC/ELEMENTARY_CHARGE
+
+    # Momentum (eV/c) and total energy (eV)
+    pc = np.asarray(rigidity, dtype=np.float64)*1e9*Z
+    Etot = np.sqrt(pc**2 + masseV**2)
+
+    zmel = np.zeros((pc.size, 4), dtype=np.float32)
+    zmel[:,0] = -chargeC
+    zmel[:,1] = particle_dict['masskg']
+    zmel[:,2] = Etot - masseV
+    zmel[:,3] = Etot/masseV
+
+    return zmel
+
+
+def effective_cutoff(rigidity, status):
+    """
+    Upper, lower and effective cutoff rigidities.
+
+    The upper cutoff is the highest forbidden rigidity,
+    the lower cutoff the lowest allowed rigidity, and the
+    effective cutoff is the upper cutoff minus the total width
+    of the allowed bands between the two (penumbra).
+
+    Parameters
+    ----------
+    rigidity : array_like
+               uniformly spaced, increasing rigidities in GV
+    status   : array_like
+               trajectory classes, with rigidity along the last axis
+
+    Returns
+    -------
+    cutoff : array_like
+             effective cutoff rigidities in GV
+    upper  : array_like
+             upper cutoff rigidities in GV
+    lower  : array_like
+             lower cutoff rigidities in GV
+    """
+    rigidity = np.asarray(rigidity)
+    status = np.asarray(status)
+    dR = rigidity[1]-rigidity[0] if rigidity.size > 1 else 0.
+    allowed = (status == TRAJ_ALLOWED)
+    forbidden = ~allowed
+
+    # No forbidden trajectory: cutoff at the lowest rigidity
+    iupper = rigidity.size - 1 - np.argmax(forbidden[...,::-1], axis=-1)
+    upper = np.where(forbidden.any(axis=-1), rigidity[iupper], rigidity[0])
+
+    # No allowed trajectory: cutoff at the highest rigidity
+    ilower = np.argmax(allowed, axis=-1)
+    lower = np.where(allowed.any(axis=-1), rigidity[ilower], rigidity[-1])
+
+    in_penumbra = allowed & (rigidity <= upper[...,np.newaxis])
+    cutoff = upper - dR*in_penumbra.sum(axis=-1)
+    cutoff = np.where(forbidden.any(axis=-1), cutoff, rigidity[0])
+
+    return cutoff, upper, lower
+
+
+def skip_converged(status, forbidden_run):
+    """
+    Mark trajectories below a converged cutoff as skipped.
+
+    A direction has converged once all rigidities above some point
+    are classified and include ``forbidden_run`` consecutive forbidden
+    trajectories; everything below that run is assumed forbidden.
+
+    Parameters
+    ----------
+    status        : array_like
+                    NdirxNrig trajectory classes, rigidity increasing
+                    along the last axis, updated in place
+    forbidden_run : int
+                    number of consecutive forbidden rigidities
+
+    Returns
+    -------
+    num_skipped : int
+                  number of newly skipped trajectories
+    """
+    num_skipped = 0
+    running = (status == TRAJ_RUNNING)
+    for idir in np.flatnonzero(running.any(axis=1)):
+        row = status[idir]
+        # Classified rigidities above the highest running one
+        top = np.flatnonzero(row == TRAJ_RUNNING)[-1] + 1
+        count = 0
+        for irig in range(row.size-1, top-1, -1):
+            if row[irig] == TRAJ_ALLOWED:
+                count = 0
+                continue
+            count += 1
+            if count >= forbidden_run:
+                below = row[:irig]
+                num_skipped += (below == TRAJ_RUNNING).sum()
+                below[below == TRAJ_RUNNING] = TRAJ_SKIPPED
+                break
+
+    return num_skipped
+
+
+def cutoff_rigidity_map(queue, program, lat, lon, alt_km=20.,
+                        zenith=np.arange(0., 61., 10.),
+                        azimuth=np.arange(0., 360., 30.),
+                        rigidity=np.arange(0.5, 30.05, 0.1),
+                        particle_type='proton', time_step=1e-4, eom_integrator=4,
+                        igrf_days=0., field_grid=None,
+                        max_steps=100000, substeps=1000, forbidden_run=20):
+    """
+    Compute a cutoff rigidity sky map for a site by backtracking antiparticles.
+
+    Every (direction, rigidity) pair is launched from the site with
+    reversed charge and velocity, and classified as allowed when it
+    escapes past 10 Earth radii, or forbidden when it returns to the
+    Earth or exceeds the step budget. Each launch carries all unfinished
+    pairs, and directions whose cutoff has converged stop early.
+
+    Parameters
+    ----------
+    queue          : pyopencl.CommandQueue
+                     queue on which to launch the kernel
+    program        : pyopencl.Program
+                     compiled ``run_prop.cl`` program
+    lat            : float
+                     geodetic latitude of the site in degrees
+    lon            : float
+                     geodetic longitude of the site in degrees
+    alt_km         : float, optional
+                     starting altitude above the site in km
+    zenith         : array_like, optional
+                     zenith angles of the arrival directions in degrees
+    azimuth        : array_like, optional
+                     azimuth angles (from north towards east) in degrees
+    rigidity       : array_like, optional
+                     uniformly spaced, increasing rigidities in GV
+    particle_type  : str, optional
+                     particle species
+    time_step      : float, optional
+                     integration time step (s), the upper bound for adaboris
+    eom_integrator : int, optional
+                     integrator index, see ``eom_dict`` in definitions.py
+    igrf_days      : float, optional
+                     days since the IGRF coefficient epoch
+    field_grid     : array_like, optional
+                     gridded field for programs built with ``FIELD_GRID``
+    max_steps      : int, optional
+                     step budget per trajectory
+    substeps       : int, optional
+                     integration steps per kernel launch
+    forbidden_run  : int, optional
+                     consecutive forbidden rigidities marking a converged cutoff
+
+    Returns
+    -------
+    result : dict
+             zenith, azimuth and rigidity grids, trajectory ``status`` and
+             ``steps`` (NzenithxNazimuthxNrigidity), and the ``cutoff``,
+             ``upper`` and ``lower`` cutoff rigidity maps (NzenithxNazimuth)
+    """
+    context = queue.context
+    zenith = np.atleast_1d(np.asarray(zenith, dtype=np.float64))
+    azimuth = np.atleast_1d(np.asarray(azimuth, dtype=np.float64))
+    rigidity = np.atleast_1d(np.asarray(rigidity, dtype=np.float64))
+    nzen, nazi, nrig = zenith.size, azimuth.size, rigidity.size
+    ndir = nzen*nazi
+    npairs = ndir*nrig
+
+    # Backtracked antiparticles leave the site towards the sky direction
+    zen_grid, azi_grid = np.meshgrid(zenith, azimuth, indexing='ij')
+    direction = local_sky_direction(lat, lon, zen_grid.ravel(), azi_grid.ravel())
+
+    np_position = np.ones((npairs, 4), dtype=np.float32)
+    np_position[:,0:3] = geodetic_to_geocentric(lat, lon, alt_km*1e3/EARTH_RADIUS_M)
+    np_velocity = np.zeros((npairs, 4), dtype=np.float32)
+    np_velocity[:,0:3] = np.repeat(direction, nrig, axis=0)
+    np_zmel = np.tile(antiparticle_zmel(rigidity, particle_type), (ndir, 1))
+
+    # Trajectories returning below the local ground radius are forbidden
+    rmin = np.sqrt(np.sum(np.square(geodetic_to_geocentric(lat, lon, 0.))))
+    options = np.array([time_step, rmin, CUTOFF_RMAX, eom_integrator], dtype=np.float32)
+
+    status = np.zeros((ndir, nrig), dtype=np.int32)
+    steps = np.zeros(npairs, dtype=np.int32)
+    dev_status = np.zeros(npairs, dtype=np.int32)
+
+    cl_active = cl.Buffer(context, mf.READ_ONLY, size=4*npairs)
+    cl_position = cl.Buffer(context, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=np_position)
+    cl_velocity = cl.Buffer(context, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=np_velocity)
+    cl_zmel = cl.Buffer(context, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=np_zmel)
+    cl_status = cl.Buffer(context, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=dev_status)
+    cl_steps = cl.Buffer(context, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=steps)
+    cl_igrf_coeffs = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR,
+                               hostbuf=igrf_coefficients(igrf_days))
+    cl_field_grid = field_grid_buffer(context, field_grid)
+
+    kernel = cl.Kernel(program, 'particle_classify')
+    kernel.set_args(cl_active, cl_position, cl_velocity, cl_zmel, cl_status, cl_steps,
+                    cl_igrf_coeffs, cl_field_grid, options,
+                    np.int32(substeps), np.int32(max_steps))
+
+    start = time.time()
+    active = np.arange(npairs, dtype=np.int32)
+    nlaunch = 0
+    while active.size > 0:
+        # Each launch carries every unfinished (direction, rigidity) pair
+        cl.enqueue_copy(queue, cl_active, active)
+        cl.enqueue_nd_range_kernel(queue, kernel, (active.size,), None)
+        cl.enqueue_copy(queue, dev_status, cl_status)
+        nlaunch += 1
+
+        status.ravel()[active] = dev_status[active]
+        skip_converged(status, forbidden_run)
+        active = np.flatnonzero(status.ravel() == TRAJ_RUNNING).astype(np.int32)
+
+    cl.enqueue_copy(queue, steps, cl_steps)
+    queue.finish()
+    print('Classified %i trajectories in %i launches, %.3f s'%(npairs, nlaunch, time.time()-start))
+
+    status = status.reshape(nzen, nazi, nrig)
+    cutoff, upper, lower = effective_cutoff(rigidity, status)
+
+    return {'zenith': zenith, 'azimuth': azimuth, 'rigidity': rigidity,
+            'status': status, 'steps': steps.reshape(nzen, nazi, nrig),
+            'cutoff': cutoff, 'upper': upper, 'lower': lower}
+
+
+def write_cutoff_map(filename, result):
+    """
+    Save a cutoff rigidity map to a NumPy ``.npz`` archive.
+
+    Parameters
+    ----------
+    filename : str
+               output file path
+    result   : dict
+               output of ``cutoff_rigidity_map``
+    """
+    out_dir = os.path.dirname(filename)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    np.savez(filename, **result)
+    print('Cutoff rigidity map written to %s'%filename)
@@ -19,3 +19,30 @@ CL_SRC_PATH = os.path.join(CRPROP_DIR, 'cl_src')
 HAWCX = -0.1205300654
 HAWCY = -0.939836962102
 HAWCZ = 0.323942291206
+
+# User cache directory (field grids)
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                        os.path.join(os.path.expanduser('~'), '.cache')),
+                         'crprop')
+
+# WGS84 reference ellipsoid: equatorial radius (m) and flattening
+WGS84_A = 6378137.
+WGS84_F = 1./298.257223563
+
+# Earth radius (m) scaling positions in Earth radii, passed to
+# the OpenCL kernels as EARTH_RADIUS_M (E_r_m in constants.cl)
+EARTH_RADIUS_M = WGS84_A
+
+# Speed of light (m/s), matching speed_of_light in constants.cl
+SPEED_OF_LIGHT = 299792458.
+
+# Particle lifecycle states of batch runs, matching run_prop.cl
+LIFE_ALIVE = 0    # still being propagated
+LIFE_EARTH = 1    # hit the Earth
+LIFE_ESCAPED = 2  # got past the outer radius
+
+# Dictionary for choosing EOM integrators, matching Step in run_prop.cl
+eom_dict = {'euler'    : 1,
+            'rk4'      : 2,
+            'boris'    : 3,
+            'adaboris' : 4}
@@ -8,7 +8,7 @@ Right Mouse Button:        - zoom in and out of scene\n
 Keys\n
   p, spacebar:        - start or pause the program\n
   q, Esc:        - exit the program\n
-  + / -:        - speed up / slow down time step\n
+  + / -:        - speed up / slow down simulated time\n
   r:        - start/stop rotation of viewing perspective\n
   s:        - save frames to file (default is no save)\n
   t:        - toggle between a textured Earth and a simple sphere\n
@@ -30,7 +30,7 @@ def printHelp():
           Keys\n
             p, spacebar:            - start or pause the program\n
             q, Esc:                 - exit the program\n
-            + / -:                  - speed up / slow down time step\n
+            + / -:                  - speed up / slow down simulated time\n
             r:                      - start/stop rotation of viewing perspective\n
             s:                      - save frames to file (default is no save)\n
             t:                      - toggle between a textured Earth and a simple sphere\n
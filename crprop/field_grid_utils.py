@@ -0,0 +1,360 @@
+from __future__ import absolute_import
+
+try:
+    import os
+    import sys
+    import json
+    import numpy as np
+    import pyopencl as cl # OpenCL - GPU computing interface
+    from definitions import *
+    from field_utils import *
+    from coord_utils import sph2cart
+    from cl_utils import build_program
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+# PyOpenCL memory flags
+mf = cl.mem_flags
+
+# Radial extent of the grid in Earth radii,
+# matching the death bounds of the propagation
+GRID_RMIN = 1.
+GRID_RMAX = 10.
+
+# Sampled field grids, keyed by model, epoch and resolution
+FIELD_GRID_CACHE_DIR = os.path.join(CACHE_DIR, 'field_grids')
+
+
+def grid_nodes(shape, rmin=GRID_RMIN, rmax=GRID_RMAX):
+    """
+    Geocentric positions of the field grid nodes.
+
+    Nodes are uniform in ln(r), in theta including both poles,
+    and in phi over [0, 2pi), ordered with phi varying fastest.
+
+    Parameters
+    ----------
+    shape : tuple
+            number of nodes in (r, theta, phi)
+    rmin  : float, optional
+            inner radius in Earth radii
+    rmax  : float, optional
+            outer radius in Earth radii
+
+    Returns
+    -------
+    position : array_like
+               Nx4 float32 node positions in meters
+    r        : array_like
+               node radii in Earth radii
+    """
+    nr, ntheta, nphi = shape
+    r = np.exp(np.linspace(np.log(rmin), np.log(rmax), nr))
+    theta = np.linspace(0., np.pi, ntheta)
+    phi = 2.*np.pi*np.arange(nphi)/nphi
+
+    r, theta, phi = np.meshgrid(r, theta, phi, indexing='ij')
+    r = r.ravel()
+    theta = theta.ravel()
+    phi = phi.ravel()
+
+    position = np.zeros((r.size, 4), dtype=np.float32)
+    position[:,0:3] = EARTH_RADIUS_M*sph2cart(r, phi, theta)
+
+    return position, r
+
+
+def grid_build_options(shape, rmin=GRID_RMIN, rmax=GRID_RMAX):
+    """
+    OpenCL compiler options enabling the gridded field lookup.
+
+    Parameters
+    ----------
+    shape : tuple
+            number of nodes in (r, theta, phi)
+    rmin  : float, optional
+            inner radius in Earth radii
+    rmax  : float, optional
+            outer radius in Earth radii
+
+    Returns
+    -------
+    options : str
+              compiler options defining FIELD_GRID and the grid geometry
+    """
+    nr, ntheta, nphi = shape
+    return (" -D FIELD_GRID -D GRID_NR=%i -D GRID_NTHETA=%i -D GRID_NPHI=%i"
+            " -D GRID_RMIN=%.9ef -D GRID_RMAX=%.9ef"%(nr, ntheta, nphi, rmin, rmax))
+
+
+def grid_cache_file(model, igrf_days, shape, rmin=GRID_RMIN, rmax=GRID_RMAX):
+    """
+    Cache file path for a field grid, keyed by
+    field model, epoch and resolution.
+    """
+    name = 'field_grid_%s'%model
+    if model == 'igrf':
+        name += '_%.3fd'%igrf_days
+    name += '_%ix%ix%i_r%g-%g.npy'%(tuple(shape) + (rmin, rmax))
+    return os.path.join(FIELD_GRID_CACHE_DIR, name)
+
+
+def grid_error_file(cache_file):
+    """
+    Cache file path for the interpolation error of a cached field grid.
+    """
+    return os.path.splitext(cache_file)[0] + '_error.json'
+
+
+def write_cache_file(cache_file, write):
+    """
+    Write a cache file through ``write(handle)``.
+
+    The file is written under a temporary name and then renamed,
+    so concurrent runs never read a partial file.
+    Returns False if the file could not be written.
+    """
+    try:
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_file = '%s.%i.tmp'%(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as handle:
+            write(handle)
+        os.rename(tmp_file, cache_file)
+        return True
+    except (IOError, OSError) as e:
+        print('Could not write cache file %s: %s'%(cache_file, e))
+        return False
+
+
+def load_field_grid(cache_file, shape):
+    """
+    Load a cached field grid, returning None if it is missing or unusable.
+    """
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        grid = np.load(cache_file)
+        if grid.shape == (np.prod(shape), 4):
+            print('Loaded field grid from %s'%cache_file)
+            return grid
+    except (ValueError, IOError, OSError, EOFError) as e:
+        print('Ignoring unusable cached field grid: %s'%e)
+    return None
+
+
+def load_grid_error(error_file):
+    """
+    Load the cached interpolation error of a field grid,
+    returning None if it is missing or unusable.
+    """
+    if not os.path.exists(error_file):
+        return None
+    try:
+        with open(error_file) as handle:
+            error = json.load(handle)
+        return dict((key, float(error[key])) for key in ('max', 'mean', 'rms'))
+    except (ValueError, KeyError, TypeError, IOError, OSError) as e:
+        print('Ignoring unusable cached field grid error: %s'%e)
+    return None
+
+
+def sample_field(queue, program, position, model='igrf', igrf_days=0.):
+    """
+    Evaluate an analytic field model at the given positions on the device.
+
+    Parameters
+    ----------
+    queue     : pyopencl.CommandQueue
+                queue on which to launch the kernel
+    program   : pyopencl.Program
+                compiled ``run_prop.cl`` program
+    position  : array_like
+                Nx4 float32 positions in meters
+    model     : str, optional
+                field model, one of ``field_model_dict``
+    igrf_days : float, optional
+                days since the IGRF coefficient epoch
+
+    Returns
+    -------
+    bfield : array_like
+             Nx4 field vectors (T), with the magnitude in the last column
+    """
+    context = queue.context
+    position = np.ascontiguousarray(position, dtype=np.float32)
+    bfield = np.empty_like(position)
+
+    cl_position = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=position)
+    cl_bfield = cl.Buffer(context, mf.WRITE_ONLY, bfield.nbytes)
+    cl_igrf_coeffs = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR,
+                               hostbuf=igrf_coefficients(igrf_days))
+
+    kernel = cl.Kernel(program, 'sample_field')
+    kernel(queue, (position.shape[0],), None,
+           cl_position, cl_bfield, cl_igrf_coeffs,
+           np.int32(field_model_dict[model]))
+    cl.enqueue_copy(queue, bfield, cl_bfield)
+
+    return bfield
+
+
+def field_grid(queue, program, model='igrf', igrf_days=0., shape=default_grid_shape,
+               use_cache=True):
+    """
+    Sample a field model on the (ln r, theta, phi) grid read by ``GetGridField``.
+
+    Grids are cached on disk under ``FIELD_GRID_CACHE_DIR``, keyed by
+    model, epoch and resolution, and reloaded by later runs.
+
+    Parameters
+    ----------
+    queue     : pyopencl.CommandQueue
+                queue on which to sample the field
+    program   : pyopencl.Program
+                compiled ``run_prop.cl`` program
+    model     : str, optional
+                field model, one of ``field_model_dict``
+    igrf_days : float, optional
+                days since the IGRF coefficient epoch
+    shape     : tuple, optional
+                number of nodes in (r, theta, phi)
+    use_cache : bool, optional
+                read and write the on-disk grid cache
+
+    Returns
+    -------
+    grid : array_like
+           Nx4 float32 array of r^3*B at the grid nodes
+    """
+    cache_file = grid_cache_file(model, igrf_days, shape)
+    if use_cache:
+        grid = load_field_grid(cache_file, shape)
+        if grid is not None:
+            return grid
+
+    position, r = grid_nodes(shape)
+    grid = sample_field(queue, program, position, model=model, igrf_days=igrf_days)
+    grid[:,0:3] *= (r**3)[:,np.newaxis]
+    grid[:,3] = 0.
+
+    if use_cache and write_cache_file(cache_file, lambda handle: np.save(handle, grid)):
+        print('Saved field grid to %s'%cache_file)
+
+    return grid
+
+
+def field_grid_error(queue, program, grid_program, grid, model='igrf', igrf_days=0.,
+                     num_points=100000, seed=0):
+    """
+    Interpolation error of a field grid against the analytic model.
+
+    Points are drawn uniformly in ln(r) between the grid bounds
+    and uniformly over the sphere.
+
+    Parameters
+    ----------
+    queue        : pyopencl.CommandQueue
+                   queue on which to launch the kernels
+    program      : pyopencl.Program
+                   program holding the ``sample_field`` kernel
+    grid_program : pyopencl.Program
+                   program built with ``grid_build_options``
+    grid         : array_like
+                   field grid from ``field_grid``
+    model        : str, optional
+                   field model the grid was sampled from
+    igrf_days    : float, optional
+                   days since the IGRF coefficient epoch
+    num_points   : int, optional
+                   number of random test points
+    seed         : int, optional
+                   random seed for the test points
+
+    Returns
+    -------
+    error : dict
+            maximum, mean and rms of |B_grid - B_model|/|B_model|
+    """
+    context = queue.context
+    rng = np.random.RandomState(seed)
+    r = np.exp(rng.uniform(np.log(GRID_RMIN), np.log(GRID_RMAX), num_points))
+    phi = rng.uniform(0., 2.*np.pi, num_points)
+    theta = np.arccos(rng.uniform(-1., 1., num_points))
+    position = np.zeros((num_points, 4), dtype=np.float32)
+    position[:,0:3] = EARTH_RADIUS_M*sph2cart(r, phi, theta)
+
+    B_model = sample_field(queue, program, position, model=model, igrf_days=igrf_days)
+
+    B_grid = np.empty_like(position)
+    cl_position = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=position)
+    cl_bfield = cl.Buffer(context, mf.WRITE_ONLY, B_grid.nbytes)
+    cl_grid = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=grid)
+    kernel = cl.Kernel(grid_program, 'sample_grid_field')
+    kernel(queue, (num_points,), None, cl_position, cl_bfield, cl_grid)
+    cl.enqueue_copy(queue, B_grid, cl_bfield)
+
+    rel = np.sqrt(((B_grid[:,0:3]-B_model[:,0:3])**2).sum(axis=1))/B_model[:,3]
+    return {'max': rel.max(), 'mean': rel.mean(), 'rms': np.sqrt((rel**2).mean())}
+
+
+def build_grid_program(queue, device, model='igrf', igrf_days=0., shape=default_grid_shape,
+                       options='', use_cache=True):
+    """
+    Build the gridded field lookup and a program that interpolates from it.
+
+    The interpolation error is cached alongside the grid and only
+    measured again when the grid is resampled.
+
+    Parameters
+    ----------
+    queue     : pyopencl.CommandQueue
+                queue on which to sample the field
+    device    : list
+                devices used for reporting the build log
+    model     : str, optional
+                field model, one of ``field_model_dict``
+    igrf_days : float, optional
+                days since the IGRF coefficient epoch
+    shape     : tuple, optional
+                number of nodes in (r, theta, phi)
+    options   : str, optional
+                additional compiler options
+    use_cache : bool, optional
+                read and write the on-disk grid cache
+
+    Returns
+    -------
+    program : pyopencl.Program
+              program whose integrators interpolate from the grid
+    grid    : array_like
+              Nx4 float32 array of r^3*B at the grid nodes
+    """
+    context = queue.context
+    cache_file = grid_cache_file(model, igrf_days, shape)
+    error_file = grid_error_file(cache_file)
+    grid = load_field_grid(cache_file, shape) if use_cache else None
+    error = load_grid_error(error_file) if grid is not None else None
+
+    grid_program = build_program(context, device, options=options + grid_build_options(shape))
+
+    # The analytic field is only needed to sample the grid and measure its error
+    if error is None:
+        program = build_program(context, device, options=options)
+        if grid is None:
+            grid = field_grid(queue, program, model=model, igrf_days=igrf_days,
+                              shape=shape, use_cache=use_cache)
+        error = field_grid_error(queue, program, grid_program, grid,
+                                 model=model, igrf_days=igrf_days)
+        error = dict((key, float(value)) for (key, value) in error.items())
+        if use_cache:
+            write_cache_file(error_file, lambda handle: handle.write(
+                json.dumps(error).encode('utf-8')))
+
+    print('Field grid %s %ix%ix%i: relative interpolation error max %.2e, mean %.2e, rms %.2e'%(
+          (model,) + tuple(shape) + (error['max'], error['mean'], error['rms'])))
+
+    return grid_program, grid
@@ -0,0 +1,89 @@
+from __future__ import absolute_import
+
+try:
+    import os
+    import sys
+    import json
+    import numpy as np
+    from definitions import *
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+# Path to IGRF coefficients json file
+json_igrf_file = os.path.join(CRPROP_DIR, 'data/igrf_coefficients.json')
+
+# Maximum degree of the IGRF expansion
+IGRF_NMAX = 13
+
+# Dictionary for choosing analytic field models,
+# matching the model index of the sample_field kernel
+field_model_dict = {'dipole'  : 1,
+                    'igrf'    : 2,
+                    'uniform' : 3}
+
+# Default number of field grid nodes in (r, theta, phi)
+default_grid_shape = (64, 91, 180)
+
+
+def load_igrf_file(jfile=json_igrf_file):
+    """
+    Load the IGRF coefficient json file
+    """
+    with open(jfile) as handle:
+        j = json.load(handle)
+
+    return j
+
+
+def igrf_epoch_days(epoch):
+    """
+    Convert a decimal year to days since the IGRF coefficient epoch.
+
+    Parameters
+    ----------
+    epoch : float
+            decimal year, e.g. 2020.5
+
+    Returns
+    -------
+    days : float
+           days elapsed since the coefficient epoch
+    """
+    igrf_dict = load_igrf_file()
+    return (epoch - igrf_dict['epoch'])*365.
+
+
+def igrf_coefficients(days=0.):
+    """
+    Time-interpolated IGRF coefficient table, as read
+    by the ``igrf`` OpenCL function.
+
+    The coefficients are identical for every particle,
+    so they are computed once on the host and passed
+    to the kernels as a read-only buffer.
+
+    Parameters
+    ----------
+    days : float, optional
+           days since the coefficient epoch
+
+    Returns
+    -------
+    table : array_like
+            2x13x14 float32 array, holding g[n-1][m] in
+            ``table[0]`` and h[n-1][m] in ``table[1]`` (nT)
+    """
+    igrf_dict = load_igrf_file()
+    index = np.asarray(igrf_dict['index'])
+    g = np.asarray(igrf_dict['g'], dtype=np.float64)
+    h = np.asarray(igrf_dict['h'], dtype=np.float64)
+
+    table = np.zeros((2, IGRF_NMAX, IGRF_NMAX+1), dtype=np.float32)
+    n = index[:,0]-1
+    m = index[:,1]
+    table[0, n, m] = g[:,0] + g[:,1]*days/365.
+    table[1, n, m] = h[:,0] + h[:,1]*days/365.
+
+    return table
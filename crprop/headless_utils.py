@@ -0,0 +1,293 @@
+from __future__ import absolute_import
+
+try:
+    import os
+    import sys
+    import time
+    import numpy as np
+    import pyopencl as cl # OpenCL - GPU computing interface
+    from definitions import *
+    from field_utils import igrf_coefficients
+    from recorder_utils import record_buffer, no_record_opts
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+# PyOpenCL memory flags
+mf = cl.mem_flags
+
+
+def run_headless(queue, program, np_position, np_velocity, np_zmel, run_options,
+                 num_steps=None, sim_time=None, substeps=10, check_interval=100,
+                 igrf_days=0., field_grid=None, recorder=None, refill=None, initializer=None,
+                 sweep=None):
+    """
+    Propagate particles without an OpenGL context.
+
+    The ``particle_prop_batch`` kernel is launched in a tight loop
+    on plain device buffers, either for a fixed number of steps
+    or until every live particle has reached a fixed simulated time.
+    Each launch advances every live particle by up to ``substeps`` steps;
+    with ``sim_time``, particles stop on the device at that time, their
+    last step shortened to land on it, and launches are limited to the
+    steps still needed.
+    Particles hitting the Earth or passing 10 Earth radii are marked dead
+    with an exit record, and every ``check_interval`` launches the list of
+    live particles is compacted so that launches only carry live particles.
+    With ``refill``, the freed slots are given fresh particles, whose clock
+    starts at the median clock of the live particles. With a recorder,
+    trajectories are streamed to disk as the run goes. With an ``initializer``, starting
+    particles, and refills if it is also the ``refill``, are drawn
+    directly in device memory. With a ``sweep``, the ``particle_prop_sweep``
+    kernel gives every particle the time step and integrator of its
+    configuration, so that many configurations share one launch.
+
+    Parameters
+    ----------
+    queue          : pyopencl.CommandQueue
+                     queue on which to launch the kernel
+    program        : pyopencl.Program
+                     compiled ``run_prop.cl`` program
+    np_position    : array_like
+                     Nx4 starting positions in Earth radii, None with an initializer
+    np_velocity    : array_like
+                     Nx4 starting directions, None with an initializer
+    np_zmel        : array_like
+                     Nx4 charge, mass, energy, gamma, None with an initializer
+    run_options    : array_like
+                     kernel options (time step, log Emax, Erange, integrator)
+    num_steps      : int, optional
+                     number of integration steps to run
+    sim_time       : float, optional
+                     simulated time (s) each live particle must reach
+    substeps       : int, optional
+                     integration steps per kernel launch
+    check_interval : int, optional
+                     kernel launches between compactions of the live
+                     particles and checks of the simulated time
+    igrf_days      : float, optional
+                     days since the IGRF coefficient epoch
+    field_grid     : array_like, optional
+                     gridded field for programs built with ``FIELD_GRID``
+    recorder       : TrajectoryRecorder, optional
+                     recorder receiving decimated trajectory samples,
+                     in runs without ``refill``
+    refill         : callable or DeviceInitializer, optional
+                     ``refill(n)`` returns the (position, direction, zmel)
+                     Nx4 arrays of n fresh particles for the freed slots,
+                     or a ``DeviceInitializer`` draws them on the device
+    initializer    : DeviceInitializer, optional
+                     draws the starting particles on the device
+    sweep          : tuple, optional
+                     configuration index of every particle, and Cx4 array of
+                     the time step and integrator of each configuration,
+                     replacing those of ``run_options``; see ``sweep_buffers``
+
+    Returns
+    -------
+    position  : array_like
+                Nx4 final positions in Earth radii
+    velocity  : array_like
+                Nx4 final velocities in m/s, with time (s) in the last column
+    zmel      : array_like
+                Nx4 final charge, mass, energy, gamma
+    lifecycle : dict
+                ``status`` and ``particle_id`` of every slot, and the
+                ``exit_id``, ``exit_time``, ``exit_position`` (Earth radii),
+                ``exit_direction`` and ``exit_reason`` of every dead particle
+    """
+    if num_steps is None and sim_time is None:
+        raise ValueError("Either num_steps or sim_time must be given.")
+    if recorder is not None and refill is not None:
+        # Recorded tracks are kept by slot, and refills hand slots to new particles
+        raise ValueError("Trajectories cannot be recorded in runs with refills.")
+    if sweep is not None:
+        if refill is not None or recorder is not None or initializer is not None:
+            raise ValueError("Sweeps support neither refills, recording nor device initialization.")
+        (config_id, config_options) = sweep
+        config_id = np.ascontiguousarray(config_id, dtype=np.int32)
+        config_options = np.ascontiguousarray(config_options, dtype=np.float32)
+        if np.any(config_options[:,0] <= 0):
+            raise ValueError("Headless runs require a positive time step.")
+    elif run_options[0] <= 0:
+        raise ValueError("Headless runs require a positive time step.")
+
+    context = queue.context
+    if initializer is not None:
+        num_particles = initializer.num_particles
+        (cl_position, cl_velocity, cl_zmel) = initializer.buffers(queue)
+        # Host arrays for the time checks and host refills only
+        np_position = np.empty((num_particles, 4), dtype=np.float32)
+        np_velocity = np.empty((num_particles, 4), dtype=np.float32)
+        np_zmel = np.empty((num_particles, 4), dtype=np.float32)
+    else:
+        num_particles = np_position.shape[0]
+        np_position = np.array(np_position, dtype=np.float32)
+        np_velocity = np.array(np_velocity, dtype=np.float32)
+        np_zmel = np.array(np_zmel, dtype=np.float32)
+        cl_position = cl.Buffer(context, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=np_position)
+        cl_velocity = cl.Buffer(context, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=np_velocity)
+        cl_zmel = cl.Buffer(context, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=np_zmel)
+    np_status = np.zeros(num_particles, dtype=np.int32)
+    np_exit_record = np.zeros((num_particles, 2, 4), dtype=np.float32)
+    particle_id = np.arange(num_particles)
+    next_id = num_particles
+    exits = []
+
+    cl_active = cl.Buffer(context, mf.READ_ONLY, size=4*num_particles)
+    cl_status = cl.Buffer(context, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=np_status)
+    cl_exit_record = cl.Buffer(context, mf.WRITE_ONLY, size=np_exit_record.nbytes)
+    cl_igrf_coeffs = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR,
+                               hostbuf=igrf_coefficients(igrf_days))
+    cl_field_grid = field_grid_buffer(context, field_grid)
+    cl_record = record_buffer(context, recorder)
+    if recorder is not None:
+        recorder.check_substeps(substeps)
+
+    # Time steps of the run, one per configuration of a sweep
+    time_steps = run_options[0:1] if sweep is None else config_options[:,0]
+    # Particles stop on the device once they reach sim_time
+    stop_time = np.float32(np.inf if sim_time is None else sim_time)
+
+    # Retrieve the kernel once and bind its arguments for the whole run
+    kernel_args = (cl_active, cl_position, cl_velocity, cl_zmel, cl_status, cl_exit_record,
+                   cl_igrf_coeffs, cl_field_grid, cl_record, run_options,
+                   np.int32(substeps), no_record_opts(), stop_time)
+    if sweep is None:
+        kernel = cl.Kernel(program, 'particle_prop_batch')
+    else:
+        kernel = cl.Kernel(program, 'particle_prop_sweep')
+        kernel_args += (cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=config_id),
+                        cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=config_options))
+    kernel.set_args(*kernel_args)
+
+    active = np.arange(num_particles, dtype=np.int32)
+    cl.enqueue_copy(queue, cl_active, active)
+
+    start = time.time()
+    step = 0
+    particle_steps = 0
+    kernel_substeps = substeps
+    while True:
+        # Steps left until the slowest live particle reaches sim_time at full
+        # steps, so that no launch is spent on particles that are done
+        budget = None
+        if sim_time is not None:
+            cl.enqueue_copy(queue, np_velocity, cl_velocity)
+            remaining = sim_time - np_velocity[active,3].min()
+            budget = max(int(np.ceil(remaining/time_steps.min()*(1.-1e-3))), 1)
+
+        for i in range(check_interval):
+            nsub = substeps
+            if num_steps is not None:
+                nsub = min(nsub, num_steps - step)
+            if budget is not None:
+                nsub = min(nsub, budget)
+                budget -= nsub
+            if nsub <= 0:
+                break
+            if nsub != kernel_substeps:
+                kernel.set_arg(10, np.int32(nsub))
+                kernel_substeps = nsub
+            if recorder is not None:
+                kernel.set_arg(11, recorder.record_opts(step))
+            cl.enqueue_nd_range_kernel(queue, kernel, (active.size,), None)
+            step += nsub
+            particle_steps += nsub*active.size
+            if recorder is not None:
+                recorder.drain(queue, step)
+
+        # Collect the exit records of particles that died since the last check
+        cl.enqueue_copy(queue, np_status, cl_status)
+        dead = active[np_status[active] != LIFE_ALIVE]
+        if dead.size > 0:
+            cl.enqueue_copy(queue, np_exit_record, cl_exit_record)
+            exits.append((particle_id[dead], np_exit_record[dead], np_status[dead]))
+        live = active[np_status[active] == LIFE_ALIVE]
+
+        finished = (num_steps is not None and step >= num_steps)
+        if not finished and refill is None:
+            finished = (live.size == 0)
+        if not finished and sim_time is not None and live.size > 0:
+            # Particle time is carried in the last velocity component
+            cl.enqueue_copy(queue, np_velocity, cl_velocity)
+            # Within the rounding tolerance of the kernel
+            finished = (np_velocity[live,3].min() >= sim_time - 1e-3*time_steps.max())
+        if finished:
+            break
+
+        if refill is not None and dead.size > 0:
+            # Fresh particles take over the freed slots, starting at the run clock
+            # measured from the live particles, as adaptive steps drift from step*dt
+            cl.enqueue_copy(queue, np_velocity, cl_velocity)
+            if live.size > 0:
+                t0 = float(np.median(np_velocity[live,3]))
+            else:
+                t0 = float(np_exit_record[dead,0,3].max())
+            # Device initializers draw the refills in place on the device
+            if hasattr(refill, 'init'):
+                refill.init(queue, cl_position, cl_velocity, cl_zmel, dead.size,
+                            first_id=next_id, slots=dead, t0=t0)
+            else:
+                (position, direction, zmel) = refill(dead.size)
+                cl.enqueue_copy(queue, np_position, cl_position)
+                cl.enqueue_copy(queue, np_zmel, cl_zmel)
+                np_position[dead] = position
+                np_velocity[dead] = direction
+                np_velocity[dead,3] = t0
+                np_zmel[dead] = zmel
+                cl.enqueue_copy(queue, cl_position, np_position)
+                cl.enqueue_copy(queue, cl_velocity, np_velocity)
+                cl.enqueue_copy(queue, cl_zmel, np_zmel)
+            np_status[dead] = LIFE_ALIVE
+            cl.enqueue_copy(queue, cl_status, np_status)
+            particle_id[dead] = np.arange(next_id, next_id+dead.size)
+            next_id += dead.size
+            live = active
+
+        # Stream compaction: launches only carry the live particles
+        if live.size != active.size:
+            active = np.ascontiguousarray(live, dtype=np.int32)
+            cl.enqueue_copy(queue, cl_active, active)
+
+    position = np.empty_like(np_position)
+    velocity = np.empty_like(np_velocity)
+    zmel = np.empty_like(np_zmel)
+    cl.enqueue_copy(queue, position, cl_position)
+    cl.enqueue_copy(queue, velocity, cl_velocity)
+    cl.enqueue_copy(queue, zmel, cl_zmel)
+    queue.finish()
+    if recorder is not None:
+        recorder.close(queue, step)
+
+    elapsed = time.time() - start
+    print('Ran %i steps of %i particles in %.3f s (%.1f steps/s, %.3g particle steps/s)'%(
+          step, num_particles, elapsed, step/max(elapsed, 1e-9), particle_steps/max(elapsed, 1e-9)))
+
+    if exits:
+        (exit_id, exit_record, exit_reason) = [np.concatenate(e) for e in zip(*exits)]
+    else:
+        (exit_id, exit_record, exit_reason) = (np.zeros(0, dtype=np.int64),
+                                               np.zeros((0, 2, 4), dtype=np.float32),
+                                               np.zeros(0, dtype=np.int32))
+    lifecycle = {'status': np_status, 'particle_id': particle_id,
+                 'exit_id': exit_id, 'exit_time': exit_record[:,0,3],
+                 'exit_position': exit_record[:,0,0:3],
+                 'exit_direction': exit_record[:,1,0:3],
+                 'exit_reason': exit_reason}
+    print('%i particles died (%i hit the Earth, %i escaped)'%(
+          exit_id.size, (exit_reason == LIFE_EARTH).sum(), (exit_reason == LIFE_ESCAPED).sum()))
+
+    return (position, velocity, zmel, lifecycle)
+
+
+def field_grid_buffer(context, field_grid=None):
+    """
+    Read-only device buffer holding the field grid.
+    Without a grid, a single element placeholder is
+    returned for the unused kernel argument.
+    """
+    if field_grid is None:
+        field_grid = np.zeros((1, 4), dtype=np.float32)
+    return cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=field_grid)
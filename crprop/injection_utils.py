@@ -0,0 +1,283 @@
+from __future__ import absolute_import
+
+try:
+    import os
+    import sys
+    import json
+    import numpy as np
+    from coord_utils import geodetic_to_geocentric
+    from particle_utils import energy_distribution, particle_zmel
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+
+def load_sources(sources):
+    """
+    Injection sources from a YAML or JSON file, or a list of source dicts.
+
+    Each source is a dict with the keys
+
+    - ``lat``, ``lon``: geodetic latitude and longitude in degrees, either
+      single values for a site, or ``[min, max]`` ranges for a geographic box.
+      Both default to the whole globe, giving a shell.
+    - ``alt``: height above the Earth in Earth radii.
+    - ``zenith_max``: particles head down into the atmosphere, within this
+      zenith angle (deg) of the local vertical, or
+    - ``axis`` and ``half_angle``: particles head within ``half_angle``
+      (deg) of a fixed geocentric direction.
+      Without either, directions are isotropic.
+    - ``weight``, optional: share of the particles drawn from the source.
+    - ``name``, optional: source name, its index by default.
+
+    Parameters
+    ----------
+    sources : str or list
+              path to the file, or the list of sources
+
+    Returns
+    -------
+    sources : list
+              list of source dicts
+    """
+    if isinstance(sources, str):
+        with open(sources) as handle:
+            if os.path.splitext(sources)[1] == '.json':
+                sources = json.load(handle)
+            else:
+                import yaml
+                sources = yaml.safe_load(handle)
+
+    sources = list(sources)
+    if len(sources) == 0:
+        raise ValueError("At least one injection source is required.")
+    for (i, source) in enumerate(sources):
+        if 'alt' not in source:
+            raise ValueError("Injection source %i has no altitude 'alt'."%i)
+        if ('axis' in source) != ('half_angle' in source):
+            raise ValueError("Injection source %i needs both 'axis' and 'half_angle'."%i)
+        if 'axis' in source and 'zenith_max' in source:
+            raise ValueError("Injection source %i has both a fixed and a local direction cone."%i)
+
+    return sources
+
+
+def source_names(sources):
+    """
+    Names of the injection sources, defaulting to their index.
+    """
+    return np.array([str(source.get('name', i)) for (i, source) in enumerate(sources)])
+
+
+def source_counts(sources, num_particles, rng):
+    """
+    Split particles between sources in proportion to their weights.
+
+    Leftover particles go to sources with probability equal to their
+    fractional share (systematic sampling), so that small batches,
+    such as refills, are not biased towards any source.
+    """
+    weight = np.array([source.get('weight', 1.) for source in sources], dtype=np.float64)
+    if np.any(weight < 0) or weight.sum() <= 0:
+        raise ValueError("Injection source weights must be positive.")
+
+    share = num_particles*weight/weight.sum()
+    counts = np.floor(share).astype(np.int64)
+    leftover = num_particles - counts.sum()
+    if leftover > 0:
+        cum = np.cumsum(share - counts)
+        picks = np.searchsorted(cum, rng.random() + np.arange(leftover), side='right')
+        counts += np.bincount(np.minimum(picks, len(sources)-1), minlength=len(sources))
+
+    return counts
+
+
+def source_table(sources):
+    """
+    Per-source injection parameters as arrays.
+
+    Returns
+    -------
+    table : dict
+            latitude and longitude bounds (deg), altitude (Earth radii),
+            cone axes (zero for the local vertical) and cosine of the
+            cone half angles of every source
+    """
+    nsrc = len(sources)
+    table = {'lat': np.zeros((nsrc, 2)), 'lon': np.zeros((nsrc, 2)), 'alt': np.zeros(nsrc),
+             'axis': np.zeros((nsrc, 3)), 'cos_max': np.zeros(nsrc)}
+
+    for (i, source) in enumerate(sources):
+        table['lat'][i] = np.broadcast_to(source.get('lat', [-90., 90.]), 2)
+        lon = np.broadcast_to(source.get('lon', [-180., 180.]), 2).astype(np.float64)
+        # Boxes may straddle the antimeridian, e.g. [170, -170]
+        if lon[1] < lon[0]:
+            lon[1] += 360.
+        table['lon'][i] = lon
+        table['alt'][i] = source['alt']
+
+        if 'axis' in source:
+            axis = np.asarray(source['axis'], dtype=np.float64)
+            table['axis'][i] = axis/np.sqrt(np.dot(axis, axis))
+            table['cos_max'][i] = np.cos(np.radians(source['half_angle']))
+        elif 'zenith_max' in source:
+            table['cos_max'][i] = np.cos(np.radians(source['zenith_max']))
+        else:
+            table['cos_max'][i] = -1.
+
+    return table
+
+
+def cone_directions(axis, cos_max, rng):
+    """
+    Random unit vectors uniform in solid angle within cones.
+
+    Parameters
+    ----------
+    axis    : array_like
+              Nx3 unit cone axes
+    cos_max : array_like
+              cosines of the cone half angles, -1 for the whole sphere
+    rng     : numpy.random.Generator
+              random number generator
+
+    Returns
+    -------
+    direction : array_like
+                Nx3 unit vectors
+    """
+    num = axis.shape[0]
+    cos_theta = rng.uniform(cos_max, 1., num)
+    sin_theta = np.sqrt(np.maximum(1.-cos_theta*cos_theta, 0.))
+    phi = rng.uniform(0., 2.*np.pi, num)
+
+    # Orthonormal basis about each axis, from the coordinate
+    # axis least aligned with it
+    helper = np.zeros_like(axis)
+    helper[np.arange(num), np.argmin(np.abs(axis), axis=1)] = 1.
+    u = np.cross(axis, helper)
+    u /= np.sqrt(np.sum(u*u, axis=1))[:,np.newaxis]
+    v = np.cross(axis, u)
+
+    return (cos_theta[:,np.newaxis]*axis
+            + (sin_theta*np.cos(phi))[:,np.newaxis]*u
+            + (sin_theta*np.sin(phi))[:,np.newaxis]*v)
+
+
+def inject_particles(sources, num_particles, seed=None):
+    """
+    Starting positions and directions of particles drawn from injection sources.
+
+    Particles of every source are generated together in a single
+    vectorized pass: sites, geographic boxes and shells are all boxes in
+    latitude and longitude, sampled uniformly in area, and every direction
+    distribution is a cone, about a fixed axis or the local vertical.
+
+    Parameters
+    ----------
+    sources       : list
+                    injection sources, see ``load_sources``
+    num_particles : int
+                    number of particles
+    seed          : int or numpy.random.Generator, optional
+                    random seed or generator
+
+    Returns
+    -------
+    position  : array_like
+                Nx4 float32 positions in Earth radii
+    direction : array_like
+                Nx4 float32 unit directions
+    source_id : array_like
+                index of the source of each particle
+    """
+    rng = np.random.default_rng(seed)
+    table = source_table(sources)
+    source_id = np.repeat(np.arange(len(sources), dtype=np.int32),
+                          source_counts(sources, num_particles, rng))
+
+    # Uniform in area between the latitude and longitude bounds
+    sin_lat = np.sin(np.radians(table['lat'][source_id]))
+    lat = np.degrees(np.arcsin(rng.uniform(sin_lat[:,0], sin_lat[:,1])))
+    lon_bounds = table['lon'][source_id]
+    lon = rng.uniform(lon_bounds[:,0], lon_bounds[:,1])
+    alt = table['alt'][source_id]
+
+    position = np.zeros((num_particles, 4), dtype=np.float32)
+    position[:,0:3] = np.transpose(geodetic_to_geocentric(lat, lon, alt))
+    position[:,3] = 1.
+
+    # Local cones point down along the ellipsoid normal
+    axis = table['axis'][source_id]
+    local = ~np.any(axis, axis=1)
+    lat_r = np.radians(lat[local])
+    lon_r = np.radians(lon[local])
+    axis[local] = -np.transpose([np.cos(lat_r)*np.cos(lon_r), np.cos(lat_r)*np.sin(lon_r),
+                                 np.sin(lat_r)])
+
+    direction = np.zeros((num_particles, 4), dtype=np.float32)
+    direction[:,0:3] = cone_directions(axis, table['cos_max'][source_id], rng)
+
+    return position, direction, source_id
+
+
+def injected_buffers(particle_type, num_particles, Emin, Emax, sources, alpha=None, seed=None):
+    """
+    Initial particle buffers drawn from injection sources,
+    as ``initial_buffers`` does for a single site.
+
+    Parameters
+    ----------
+    particle_type : str
+                    particle species
+    num_particles : int
+                    number of particles
+    Emin          : float
+                    minimum particle energy in eV
+    Emax          : float
+                    maximum particle energy in eV
+    sources       : list
+                    injection sources, see ``load_sources``
+    alpha         : float, optional
+                    energy spectral index of the form E^-alpha
+    seed          : int or numpy.random.Generator, optional
+                    random seed or generator
+
+    Returns
+    -------
+    position  : array_like
+                Nx4 positions in Earth radii
+    velocity  : array_like
+                Nx4 unit directions, with zero time in the last column
+    zmel      : array_like
+                Nx4 charge, mass, energy, gamma
+    source_id : array_like
+                index of the source of each particle
+    """
+    rng = np.random.default_rng(seed)
+    (position, velocity, source_id) = inject_particles(sources, num_particles, seed=rng)
+    energy = energy_distribution(Emin, Emax, num_particles, alpha=alpha, seed=rng)
+    zmel = particle_zmel(particle_type, energy)
+
+    return position, velocity, zmel, source_id
+
+
+def tag_sources(lifecycle, source_id, sources):
+    """
+    Add the source of every slot and of every dead particle to a lifecycle.
+
+    Parameters
+    ----------
+    lifecycle : dict
+                particle status and exit records from ``run_headless``,
+                updated in place
+    source_id : array_like
+                source index of every particle, indexed by particle id
+    sources   : list
+                injection sources
+    """
+    source_id = np.asarray(source_id)
+    lifecycle['source'] = source_id[lifecycle['particle_id']]
+    lifecycle['exit_source'] = source_id[lifecycle['exit_id']]
+    lifecycle['source_name'] = source_names(sources)
@@ -0,0 +1,197 @@
+from __future__ import absolute_import
+
+try:
+    import time
+    import threading
+    import numpy as np
+    import pyopencl as cl # OpenCL - GPU computing interface
+    from headless_utils import run_headless
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+
+class DeviceScheduler(object):
+    """
+    Headless runs spread over several OpenCL devices.
+
+    Every device gets its own context, command queue and program, so that
+    devices of different platforms can be mixed, and runs in its own
+    thread. The particles are handed out in contiguous chunks: each device
+    first takes a small calibration chunk, then chunks sized by its share
+    of the throughput measured so far (particles per second), halved as the
+    remaining particles run out so that all devices finish together.
+    The chunks are gathered into a single output, in particle order.
+
+    Parameters
+    ----------
+    devices   : list
+                OpenCL devices or sub-devices, see ``find_devices``
+    build     : callable
+                ``build(queue, [device])`` returns the (program, field grid)
+                of a device, the field grid being None without one
+    min_chunk : int, optional
+                smallest chunk of particles handed to a device
+    """
+    def __init__(self, devices, build, min_chunk=1024):
+        self.devices = list(devices)
+        self.min_chunk = min_chunk
+        self.queues = []
+        self.programs = []
+        self.grids = []
+        for device in self.devices:
+            context = cl.Context(devices=[device])
+            queue = cl.CommandQueue(context)
+            (program, grid) = build(queue, [device])
+            self.queues.append(queue)
+            self.programs.append(program)
+            self.grids.append(grid)
+
+        # Particles run and busy time of each device
+        self.particles = np.zeros(len(self.devices), dtype=np.int64)
+        self.busy_time = np.zeros(len(self.devices))
+        self._lock = threading.Lock()
+
+    def rates(self):
+        """
+        Measured throughput of each device in particles per second,
+        NaN for devices without a completed chunk.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.busy_time > 0., self.particles/self.busy_time, np.nan)
+
+    def chunk_size(self, index, remaining):
+        """
+        Number of particles to hand to device ``index``,
+        out of the ``remaining`` ones.
+        """
+        num_devices = len(self.devices)
+        rates = self.rates()
+        if np.isnan(rates[index]):
+            # Calibration chunk, small enough to leave room for balancing
+            size = remaining//(4*num_devices)
+        else:
+            # Devices not measured yet count as the average of the others
+            rates = np.where(np.isnan(rates), np.nanmean(rates), rates)
+            size = int(remaining*rates[index]/rates.sum()/2.)
+        size = max(size, self.min_chunk)
+        # No chunk smaller than min_chunk is left behind
+        if remaining - size < self.min_chunk:
+            size = remaining
+        return size
+
+    def run(self, np_position, np_velocity, np_zmel, run_options, **kwargs):
+        """
+        Propagate particles with ``run_headless``, spread over all devices.
+
+        Parameters
+        ----------
+        np_position : array_like
+                      Nx4 starting positions in Earth radii
+        np_velocity : array_like
+                      Nx4 starting directions
+        np_zmel     : array_like
+                      Nx4 charge, mass, energy, gamma
+        run_options : array_like
+                      kernel options (time step, log Emax, Erange, integrator)
+        kwargs      : dict
+                      ``num_steps``, ``sim_time``, ``substeps``, ``check_interval``
+                      and ``igrf_days`` of ``run_headless``
+
+        Returns
+        -------
+        position  : array_like
+                    Nx4 final positions in Earth radii
+        velocity  : array_like
+                    Nx4 final velocities in m/s, with time (s) in the last column
+        zmel      : array_like
+                    Nx4 final charge, mass, energy, gamma
+        lifecycle : dict
+                    lifecycle of ``run_headless`` over all particles, with the
+                    ``device`` index that ran each slot
+        """
+        for name in ('refill', 'recorder', 'initializer', 'field_grid'):
+            if kwargs.get(name) is not None:
+                raise ValueError("Multi-device runs do not support '%s'."%name)
+
+        num_particles = np_position.shape[0]
+        if num_particles == 0:
+            raise ValueError("Multi-device runs need at least one particle.")
+        state = {'next': 0, 'error': None}
+        chunks = []
+
+        def worker(index):
+            try:
+                while True:
+                    with self._lock:
+                        if state['next'] >= num_particles or state['error'] is not None:
+                            return
+                        start = state['next']
+                        stop = start + self.chunk_size(index, num_particles - start)
+                        state['next'] = stop
+
+                    tick = time.time()
+                    result = run_headless(self.queues[index], self.programs[index],
+                                          np_position[start:stop], np_velocity[start:stop],
+                                          np_zmel[start:stop], run_options,
+                                          field_grid=self.grids[index], **kwargs)
+                    with self._lock:
+                        self.particles[index] += stop - start
+                        self.busy_time[index] += time.time() - tick
+                        chunks.append((start, stop, index, result))
+            except Exception as e:
+                with self._lock:
+                    state['error'] = e
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(self.devices))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if state['error'] is not None:
+            raise state['error']
+
+        for (i, device) in enumerate(self.devices):
+            print('Device %i (%s): %i particles, %.3g particles/s'%(
+                  i, device.name.strip(), self.particles[i], self.rates()[i]))
+
+        return gather_chunks(sorted(chunks, key=lambda c: c[0]))
+
+
+def gather_chunks(chunks):
+    """
+    Merge the ``run_headless`` results of contiguous chunks of particles.
+
+    Parameters
+    ----------
+    chunks : list
+             (start, stop, device index, result) of each chunk, in particle order
+
+    Returns
+    -------
+    position  : array_like
+                Nx4 final positions
+    velocity  : array_like
+                Nx4 final velocities
+    zmel      : array_like
+                Nx4 final charge, mass, energy, gamma
+    lifecycle : dict
+                lifecycle with particle ids counted over all chunks,
+                and the ``device`` of every slot
+    """
+    position = np.concatenate([c[3][0] for c in chunks])
+    velocity = np.concatenate([c[3][1] for c in chunks])
+    zmel = np.concatenate([c[3][2] for c in chunks])
+
+    lifecycles = [c[3][3] for c in chunks]
+    lifecycle = dict((key, np.concatenate([l[key] for l in lifecycles])) for key in lifecycles[0])
+    # Chunk particle ids start from zero
+    lifecycle['particle_id'] = np.concatenate([l['particle_id'] + c[0]
+                                               for (c, l) in zip(chunks, lifecycles)])
+    lifecycle['exit_id'] = np.concatenate([l['exit_id'] + c[0]
+                                           for (c, l) in zip(chunks, lifecycles)])
+    lifecycle['device'] = np.concatenate([np.full(c[1] - c[0], c[2], dtype=np.int32)
+                                          for c in chunks])
+
+    return position, velocity, zmel, lifecycle
@@ -0,0 +1,582 @@
+from __future__ import absolute_import
+
+try:
+    import os
+    import sys
+    import time
+    import numpy as np
+    from definitions import *
+    from field_utils import igrf_coefficients, field_model_dict, IGRF_NMAX
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+# Field model constants, matching constants.cl and bfield.cl
+BMAG = 0.000033             # uniform field strength (T)
+DIPOLE_B0 = 31.2e-6         # dipole equatorial field strength (T)
+DIPOLE_TILT = np.deg2rad(11.5)
+THETA_MIN = 0.001           # adaptive Boris rotation angle per step (rad)
+
+# Integrators implemented here, with the field model
+# used by the corresponding OpenCL stepper
+integrator_field_dict = {1 : 'dipole',  # euler
+                         3 : 'dipole',  # boris
+                         4 : 'igrf'}    # adaboris
+
+
+def _scratch(work, shape, names):
+    """
+    Scratch arrays for in-place evaluations, allocated
+    on the first call and reused afterwards.
+    """
+    if work is None:
+        work = {}
+    for name in names:
+        if name not in work or work[name].shape != shape:
+            work[name] = np.empty(shape)
+    return work
+
+
+def uniform_field(pos, out=None):
+    """
+    Uniform test field along z, as ``GetUniformField``.
+
+    Parameters
+    ----------
+    pos : array_like
+          Nx3 geocentric positions in meters
+    out : array_like, optional
+          Nx4 output array
+
+    Returns
+    -------
+    B : array_like
+        Nx4 field vectors (T), with the magnitude in the last column
+    """
+    if out is None:
+        out = np.empty((pos.shape[0], 4))
+    out[:,0:2] = 0.
+    out[:,2] = BMAG
+    out[:,3] = BMAG
+    return out
+
+
+def dipole_field(pos, out=None, work=None):
+    """
+    Tilted dipole field, as ``GetDipoleField``.
+
+    Parameters
+    ----------
+    pos  : array_like
+           Nx3 geocentric positions in meters
+    out  : array_like, optional
+           Nx4 output array
+    work : dict, optional
+           scratch arrays reused between calls
+
+    Returns
+    -------
+    B : array_like
+        Nx4 field vectors (T), with the magnitude in the last column
+    """
+    n = pos.shape[0]
+    if out is None:
+        out = np.empty((n, 4))
+    w = _scratch(work, (n,), ('r', 'yp', 'zp', 'theta', 'phi', 'ct', 'st', 'cp', 'sp',
+                              'Br', 'Bt', 'tmp'))
+    (x, y, z) = (pos[:,0], pos[:,1], pos[:,2])
+    (r, yp, zp, theta, phi) = (w['r'], w['yp'], w['zp'], w['theta'], w['phi'])
+    (ct, st, cp, sp, Br, Bt, tmp) = (w['ct'], w['st'], w['cp'], w['sp'], w['Br'], w['Bt'], w['tmp'])
+
+    # Rotate into the dipole frame
+    np.multiply(y, np.cos(DIPOLE_TILT), out=yp)
+    np.multiply(z, np.sin(DIPOLE_TILT), out=tmp)
+    yp -= tmp
+    np.multiply(y, np.sin(DIPOLE_TILT), out=zp)
+    np.multiply(z, np.cos(DIPOLE_TILT), out=tmp)
+    zp += tmp
+
+    np.multiply(x, x, out=r)
+    np.multiply(yp, yp, out=tmp)
+    r += tmp
+    np.multiply(zp, zp, out=tmp)
+    r += tmp
+    np.sqrt(r, out=r)
+    np.divide(zp, r, out=tmp)
+    np.clip(tmp, -1., 1., out=tmp)
+    np.arccos(tmp, out=theta)
+    np.arctan2(yp, x, out=phi)
+    np.cos(theta, out=ct)
+    np.sin(theta, out=st)
+    np.cos(phi, out=cp)
+    np.sin(phi, out=sp)
+
+    # B0/r^3, with r in Earth radii
+    r /= EARTH_RADIUS_M
+    np.power(r, -3, out=tmp)
+    tmp *= DIPOLE_B0
+    np.multiply(ct, tmp, out=Br)
+    Br *= -2.
+    np.multiply(st, tmp, out=Bt)
+    Bt *= -1.
+
+    # Br*sin(theta) + Btheta*cos(theta)
+    np.multiply(st, Br, out=tmp)
+    np.multiply(ct, Bt, out=r)
+    tmp += r
+    np.multiply(tmp, cp, out=out[:,0])
+    np.multiply(tmp, sp, out=out[:,1])
+    np.multiply(ct, Br, out=out[:,2])
+    np.multiply(st, Bt, out=tmp)
+    out[:,2] -= tmp
+
+    _magnitude(out, tmp)
+    return out
+
+
+def igrf_field(pos, coeffs, out=None, work=None):
+    """
+    IGRF field, as ``igrf_recurrence``.
+
+    Parameters
+    ----------
+    pos    : array_like
+             Nx3 geocentric positions in meters
+    coeffs : array_like
+             2x13x14 IGRF coefficient table from ``igrf_coefficients``
+    out    : array_like, optional
+             Nx4 output array
+    work   : dict, optional
+             scratch arrays reused between calls
+
+    Returns
+    -------
+    B : array_like
+        Nx4 field vectors (T), with the magnitude in the last column
+    """
+    num = pos.shape[0]
+    if out is None:
+        out = np.empty((num, 4))
+    names = ('r', 'inv_r', 'ct', 'st', 'cp', 'sp', 'Br', 'Bp', 'Bt', 'Pmm', 'dPmm',
+             'c_mp', 's_mp', 'rpow_m', 'rpow', 'P2', 'P10', 'P20', 'dP2', 'dP10', 'dP20',
+             'gc', 'tmp', 'tmp2')
+    w = _scratch(work, (num,), names)
+    (r, inv_r, ct, st, cp, sp) = (w['r'], w['inv_r'], w['ct'], w['st'], w['cp'], w['sp'])
+    (Br, Bp, Bt, Pmm, dPmm) = (w['Br'], w['Bp'], w['Bt'], w['Pmm'], w['dPmm'])
+    (c_mp, s_mp, rpow_m, rpow, gc, tmp, tmp2) = (w['c_mp'], w['s_mp'], w['rpow_m'], w['rpow'],
+                                                 w['gc'], w['tmp'], w['tmp2'])
+    (P2, P10, P20, dP2, dP10, dP20) = (w['P2'], w['P10'], w['P20'], w['dP2'], w['dP10'], w['dP20'])
+    g = coeffs[0]
+    h = coeffs[1]
+
+    # Spherical coordinates, avoiding the pole singularities
+    _norm(pos, r, tmp)
+    np.divide(pos[:,2], r, out=tmp)
+    np.clip(tmp, -1., 1., out=tmp)
+    np.arccos(tmp, out=tmp)
+    np.clip(tmp, 0.0001, np.pi-.00001, out=tmp)
+    np.cos(tmp, out=ct)
+    np.sin(tmp, out=st)
+    np.arctan2(pos[:,1], pos[:,0], out=tmp)
+    np.cos(tmp, out=cp)
+    np.sin(tmp, out=sp)
+    r /= EARTH_RADIUS_M
+    np.divide(1., r, out=inv_r)
+
+    Br[:] = 0.
+    Bp[:] = 0.
+    Bt[:] = 0.
+    Pmm[:] = 1.
+    dPmm[:] = 0.
+    c_mp[:] = 1.
+    s_mp[:] = 0.
+    np.power(inv_r, 3, out=rpow_m)
+
+    for m in range(IGRF_NMAX+1):
+        rpow[:] = rpow_m
+        if m == 0:
+            # P(0,0) starts the m = 0 column, the n = 0 term is not in the expansion
+            P10[:] = 1.
+            dP10[:] = 0.
+            rpow *= r
+        else:
+            # Sectoral term n = m
+            np.multiply(st, Pmm, out=P2)
+            np.multiply(st, dPmm, out=dP2)
+            np.multiply(ct, Pmm, out=tmp)
+            dP2 += tmp
+            Pmm[:] = P2
+            dPmm[:] = dP2
+            P10[:] = P2
+            dP10[:] = dP2
+            _igrf_term(w, g[m-1,m], h[m-1,m], m, m, P2, dP2)
+        P20[:] = 0.
+        dP20[:] = 0.
+
+        # Remaining degrees n > m of this order
+        for n in range(m+1, IGRF_NMAX+1):
+            rpow *= inv_r
+            K = ((n-1.)*(n-1.)-m*m)/((2.*n-1.)*(2.*n-3.))
+            np.multiply(ct, P10, out=P2)
+            np.multiply(P20, K, out=tmp)
+            P2 -= tmp
+            np.multiply(ct, dP10, out=dP2)
+            np.multiply(st, P10, out=tmp)
+            dP2 -= tmp
+            np.multiply(dP20, K, out=tmp)
+            dP2 -= tmp
+            _igrf_term(w, g[n-1,m], h[n-1,m], n, m, P2, dP2)
+            # Shift the recurrence by swapping buffers
+            (P20, P10, P2) = (P10, P2, P20)
+            (dP20, dP10, dP2) = (dP10, dP2, dP20)
+
+        # Next order: rotate the azimuthal harmonics by phi
+        np.multiply(c_mp, cp, out=gc)
+        np.multiply(s_mp, sp, out=tmp)
+        gc -= tmp
+        s_mp *= cp
+        np.multiply(c_mp, sp, out=tmp)
+        s_mp += tmp
+        c_mp[:] = gc
+        if m > 0:
+            rpow_m *= inv_r
+
+    Bp /= st
+    Bp *= -1.
+    Bt *= -1.
+
+    # Cartesian B in nanoT
+    np.multiply(Br, st, out=tmp)
+    np.multiply(Bt, ct, out=tmp2)
+    tmp += tmp2
+    np.multiply(tmp, cp, out=out[:,0])
+    np.multiply(Bp, sp, out=tmp2)
+    out[:,0] -= tmp2
+    np.multiply(tmp, sp, out=out[:,1])
+    np.multiply(Bp, cp, out=tmp2)
+    out[:,1] += tmp2
+    np.multiply(Br, ct, out=out[:,2])
+    np.multiply(Bt, st, out=tmp2)
+    out[:,2] -= tmp2
+
+    # Set units to Tesla
+    out[:,0:3] *= 1e-9
+    _magnitude(out, tmp)
+    return out
+
+
+def _igrf_term(w, gl, hl, n, m, P2, dP2):
+    """
+    Add the degree n, order m term of the IGRF expansion
+    to the spherical field sums held in the scratch arrays.
+    """
+    (gc, tmp, tmp2) = (w['gc'], w['tmp'], w['tmp2'])
+    (rpow, c_mp, s_mp) = (w['rpow'], w['c_mp'], w['s_mp'])
+    np.multiply(c_mp, gl, out=gc)
+    np.multiply(s_mp, hl, out=tmp)
+    gc += tmp
+
+    np.multiply(rpow, P2, out=tmp2)
+    np.multiply(gc, tmp2, out=tmp)
+    tmp *= n+1.
+    w['Br'] += tmp
+    np.multiply(rpow, dP2, out=tmp)
+    tmp *= gc
+    w['Bt'] += tmp
+    if m > 0:
+        np.multiply(c_mp, hl, out=tmp)
+        np.multiply(s_mp, gl, out=gc)
+        tmp -= gc
+        tmp *= tmp2
+        tmp *= m
+        w['Bp'] += tmp
+
+
+def _norm(a, out, tmp):
+    """
+    Row-wise norm of the first three columns of ``a`` into ``out``.
+    """
+    np.multiply(a[:,0], a[:,0], out=out)
+    np.multiply(a[:,1], a[:,1], out=tmp)
+    out += tmp
+    np.multiply(a[:,2], a[:,2], out=tmp)
+    out += tmp
+    np.sqrt(out, out=out)
+    return out
+
+
+def _magnitude(B, tmp):
+    """
+    Store the magnitude of Nx4 vectors in their last column.
+    """
+    _norm(B, B[:,3], tmp)
+
+
+def _cross(a, b, out, tmp):
+    """
+    Row-wise cross product of Nx3 arrays into ``out``.
+    """
+    for (i, j, k) in ((0, 1, 2), (1, 2, 0), (2, 0, 1)):
+        np.multiply(a[:,j], b[:,k], out=out[:,i])
+        np.multiply(a[:,k], b[:,j], out=tmp)
+        out[:,i] -= tmp
+    return out
+
+
+class NumpyPropagator(object):
+    """
+    Vectorized NumPy propagation of all particles, mirroring the
+    ``particle_prop_batch`` kernel in double precision.
+
+    Particles are held in the layout of ``initial_buffers`` and are
+    updated in place with preallocated scratch arrays. Particles hitting
+    the Earth or passing 10 Earth radii are no longer advanced, and
+    their exit records are kept as in ``run_headless``.
+
+    Parameters
+    ----------
+    np_position    : array_like
+                     Nx4 starting positions in Earth radii
+    np_velocity    : array_like
+                     Nx4 starting directions, with time (s) in the last column
+    np_zmel        : array_like
+                     Nx4 charge, mass, energy, gamma
+    eom_integrator : int, optional
+                     integrator index, see ``eom_dict`` in definitions.py:
+                     1 (euler), 3 (boris) or 4 (adaboris)
+    field_model    : str, optional
+                     field model, one of ``field_model_dict``,
+                     by default that of the OpenCL integrator
+    igrf_days      : float, optional
+                     days since the IGRF coefficient epoch
+    """
+    def __init__(self, np_position, np_velocity, np_zmel, eom_integrator=3,
+                 field_model=None, igrf_days=0.):
+        if eom_integrator not in integrator_field_dict:
+            raise ValueError("The NumPy backend implements the euler, boris "
+                             "and adaboris integrators.")
+        if field_model is None:
+            field_model = integrator_field_dict[eom_integrator]
+        if field_model not in field_model_dict:
+            raise ValueError("Unknown field model '%s'."%field_model)
+
+        self.eom_integrator = eom_integrator
+        self.field_model = field_model
+        self.igrf_coeffs = igrf_coefficients(igrf_days).astype(np.float64)
+
+        n = np_position.shape[0]
+        self.num_particles = n
+
+        # Positions in meters, directions scaled to speed, as LoadParticle
+        self.pos = np.asarray(np_position, dtype=np.float64)[:,0:3]*EARTH_RADIUS_M
+        self.zmel = np.array(np_zmel, dtype=np.float64)
+        gamma = self.zmel[:,3]
+        speed = np.sqrt(1.-1./gamma**2)*SPEED_OF_LIGHT
+        vel = np.asarray(np_velocity, dtype=np.float64)
+        self.vel = vel[:,0:3]/np.sqrt((vel[:,0:3]**2).sum(axis=1))[:,np.newaxis]*speed[:,np.newaxis]
+        self.time = vel[:,3].copy()
+
+        # Z*dt/(2*gamma*m) without dt
+        self.charge_ratio = 0.5*self.zmel[:,0]/(gamma*self.zmel[:,1])
+
+        self.status = np.zeros(n, dtype=np.int32)
+        self.alive = np.ones(n, dtype=bool)
+        self.exits = []
+        self.steps = 0
+
+        # Preallocated scratch arrays
+        self.B = np.empty((n, 4))
+        self.dt = np.empty(n)
+        self.h = np.empty((n, 3))
+        self.s = np.empty((n, 3))
+        self.u = np.empty((n, 3))
+        self.r = np.empty(n)
+        self.tmp = np.empty(n)
+        self.dead = np.empty(n, dtype=bool)
+        self.mask = np.empty(n, dtype=bool)
+        self.work = {}
+
+    def field(self):
+        """
+        Evaluate the field model at the particle positions into ``self.B``.
+        """
+        if self.field_model == 'dipole':
+            return dipole_field(self.pos, out=self.B, work=self.work)
+        elif self.field_model == 'igrf':
+            return igrf_field(self.pos, self.igrf_coeffs, out=self.B, work=self.work)
+        return uniform_field(self.pos, out=self.B)
+
+    def step(self, time_step):
+        """
+        Advance every live particle by one integration step.
+
+        Parameters
+        ----------
+        time_step : float
+                    integration time step (s), the upper bound for adaboris
+        """
+        B = self.field()
+        dt = self.dt
+
+        if self.eom_integrator == 4:
+            # Rotation angle per step limited to THETA_MIN
+            np.abs(self.charge_ratio, out=dt)
+            dt *= B[:,3]
+            np.divide(np.tan(0.5*THETA_MIN), dt, out=dt)
+            np.minimum(dt, time_step, out=dt)
+        else:
+            dt[:] = time_step
+        dt *= self.alive
+
+        if self.eom_integrator == 1:
+            # Euler: position first, then velocity with the force at the old state
+            _cross(self.vel, B, self.u, self.r)
+            np.multiply(self.charge_ratio, dt, out=self.tmp)
+            self.tmp *= 2.
+            np.multiply(dt[:,np.newaxis], self.vel, out=self.h)
+            self.pos += self.h
+            self.u *= self.tmp[:,np.newaxis]
+            self.vel += self.u
+        else:
+            # Boris rotation, h = q*B and s = 2h/(1+|h|^2)
+            np.multiply(self.charge_ratio, dt, out=self.tmp)
+            np.multiply(B[:,0:3], self.tmp[:,np.newaxis], out=self.h)
+            _norm(self.h, self.tmp, self.r)
+            self.tmp *= self.tmp
+            self.tmp += 1.
+            np.divide(2., self.tmp, out=self.tmp)
+            np.multiply(self.h, self.tmp[:,np.newaxis], out=self.s)
+
+            _cross(self.vel, self.h, self.u, self.r)
+            self.u += self.vel
+            _cross(self.u, self.s, self.h, self.r)
+            self.vel += self.h
+
+            np.multiply(dt[:,np.newaxis], self.vel, out=self.h)
+            self.pos += self.h
+
+        self.time += dt
+        self.steps += 1
+        self.check_exits()
+
+    def check_exits(self):
+        """
+        Retire particles that hit the Earth or passed 10 Earth radii.
+        """
+        _norm(self.pos, self.r, self.tmp)
+        self.r /= EARTH_RADIUS_M
+
+        np.less_equal(self.r, 1., out=self.dead)
+        np.greater(self.r, 10., out=self.mask)
+        self.dead |= self.mask
+        self.dead &= self.alive
+        if not self.dead.any():
+            return
+
+        dead = np.flatnonzero(self.dead)
+        reason = np.where(self.r[dead] <= 1., LIFE_EARTH, LIFE_ESCAPED).astype(np.int32)
+        direction = self.vel[dead]/np.sqrt((self.vel[dead]**2).sum(axis=1))[:,np.newaxis]
+        self.exits.append((dead, self.time[dead], self.pos[dead]/EARTH_RADIUS_M, direction, reason))
+        self.status[dead] = reason
+        self.alive[dead] = False
+
+    def state(self):
+        """
+        Particle states in the layout of ``run_headless``.
+
+        Returns
+        -------
+        position  : array_like
+                    Nx4 float32 positions in Earth radii
+        velocity  : array_like
+                    Nx4 float32 velocities in m/s, with time (s) in the last column
+        zmel      : array_like
+                    Nx4 float32 charge, mass, energy, gamma
+        lifecycle : dict
+                    particle status and exit records, as in ``run_headless``
+        """
+        n = self.num_particles
+        position = np.ones((n, 4), dtype=np.float32)
+        position[:,0:3] = self.pos/EARTH_RADIUS_M
+        velocity = np.empty((n, 4), dtype=np.float32)
+        velocity[:,0:3] = self.vel
+        velocity[:,3] = self.time
+        zmel = self.zmel.astype(np.float32)
+
+        if self.exits:
+            (exit_id, exit_time, exit_position, exit_direction, exit_reason) = [
+                np.concatenate(e) for e in zip(*self.exits)]
+        else:
+            (exit_id, exit_time, exit_position, exit_direction, exit_reason) = (
+                np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, 3)),
+                np.zeros((0, 3)), np.zeros(0, dtype=np.int32))
+        lifecycle = {'status': self.status.copy(), 'particle_id': np.arange(n),
+                     'exit_id': exit_id, 'exit_time': exit_time,
+                     'exit_position': exit_position, 'exit_direction': exit_direction,
+                     'exit_reason': exit_reason}
+
+        return (position, velocity, zmel, lifecycle)
+
+
+def run_numpy(np_position, np_velocity, np_zmel, run_options, num_steps=None, sim_time=None,
+              igrf_days=0., field_model=None):
+    """
+    Propagate particles with the NumPy backend, without OpenCL.
+
+    Takes the same inputs and returns the same outputs as ``run_headless``,
+    without trajectory recording or refills.
+
+    Parameters
+    ----------
+    np_position : array_like
+                  Nx4 starting positions in Earth radii
+    np_velocity : array_like
+                  Nx4 starting directions
+    np_zmel     : array_like
+                  Nx4 charge, mass, energy, gamma
+    run_options : array_like
+                  kernel options (time step, log Emax, Erange, integrator)
+    num_steps   : int, optional
+                  number of integration steps to run
+    sim_time    : float, optional
+                  simulated time (s) each live particle must reach
+    igrf_days   : float, optional
+                  days since the IGRF coefficient epoch
+    field_model : str, optional
+                  field model, by default that of the OpenCL integrator
+
+    Returns
+    -------
+    position  : array_like
+                Nx4 final positions in Earth radii
+    velocity  : array_like
+                Nx4 final velocities in m/s, with time (s) in the last column
+    zmel      : array_like
+                Nx4 final charge, mass, energy, gamma
+    lifecycle : dict
+                particle status and exit records, as in ``run_headless``
+    """
+    if num_steps is None and sim_time is None:
+        raise ValueError("Either num_steps or sim_time must be given.")
+    time_step = float(run_options[0])
+    if time_step <= 0:
+        raise ValueError("Headless runs require a positive time step.")
+
+    propagator = NumpyPropagator(np_position, np_velocity, np_zmel,
+                                 eom_integrator=int(run_options[3]),
+                                 field_model=field_model, igrf_days=igrf_days)
+
+    start = time.time()
+    while propagator.alive.any():
+        if num_steps is not None and propagator.steps >= num_steps:
+            break
+        if sim_time is not None and propagator.time[propagator.alive].min() >= sim_time:
+            break
+        propagator.step(time_step)
+
+    elapsed = time.time() - start
+    print('Ran %i steps of %i particles with NumPy in %.3f s (%.1f steps/s)'%(
+          propagator.steps, propagator.num_particles, elapsed, propagator.steps/max(elapsed, 1e-9)))
+
+    return propagator.state()
@@ -0,0 +1,270 @@
+from __future__ import absolute_import
+
+try:
+    import os
+    import ctypes
+    import numpy as np
+    import pyopencl as cl # OpenCL - GPU computing interface
+    from definitions import eom_dict
+
+    # Headless OpenGL platform (egl or osmesa), selected before OpenGL is
+    # first imported. Without a display server, Mesa's EGL needs its
+    # surfaceless platform.
+    os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+    if not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+        os.environ.setdefault('EGL_PLATFORM', 'surfaceless')
+
+    from OpenGL.GL import * # OpenGL - GPU rendering interface
+    from render_utils import default_view, set_camera, EarthMesh, ParticleRenderer
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+# PyOpenCL memory flags
+mf = cl.mem_flags
+
+class OffscreenContext(object):
+    """
+    OpenGL context without a window, rendering into a framebuffer object.
+
+    The platform is the one of ``PYOPENGL_PLATFORM``. On EGL the
+    context has no default framebuffer to speak of, on OSMesa it renders
+    to host memory, and in both cases frames are drawn into a framebuffer
+    object of color and depth renderbuffers, read with ``read_buffer``.
+
+    Parameters
+    ----------
+    width  : int
+             frame width in pixels
+    height : int
+             frame height in pixels
+    """
+    read_buffer = GL_COLOR_ATTACHMENT0
+
+    def __init__(self, width, height):
+        self.width = int(width)
+        self.height = int(height)
+        self.platform = os.environ.get('PYOPENGL_PLATFORM', 'egl')
+        if self.platform == 'osmesa':
+            self._make_osmesa_context()
+        else:
+            self._make_egl_context()
+
+        # Framebuffer object of the frame size
+        self.fbo = glGenFramebuffers(1)
+        self.renderbuffers = glGenRenderbuffers(2)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        for (rb, fmt, attachment) in zip(self.renderbuffers, (GL_RGBA8, GL_DEPTH_COMPONENT24),
+                                         (GL_COLOR_ATTACHMENT0, GL_DEPTH_ATTACHMENT)):
+            glBindRenderbuffer(GL_RENDERBUFFER, rb)
+            glRenderbufferStorage(GL_RENDERBUFFER, fmt, self.width, self.height)
+            glFramebufferRenderbuffer(GL_FRAMEBUFFER, attachment, GL_RENDERBUFFER, rb)
+        glBindRenderbuffer(GL_RENDERBUFFER, 0)
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError("Incomplete offscreen framebuffer of %ix%i pixels."%(
+                               self.width, self.height))
+        glDrawBuffer(GL_COLOR_ATTACHMENT0)
+        glReadBuffer(GL_COLOR_ATTACHMENT0)
+        glViewport(0, 0, self.width, self.height)
+        glEnable(GL_DEPTH_TEST)
+        glClearColor(0.0, 0.0, 0.0, 0.0)
+
+        print('Offscreen %s context: %s'%(self.platform, glGetString(GL_RENDERER).decode()))
+
+    def _make_egl_context(self):
+        from OpenGL import EGL
+        self._egl = EGL
+        self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        (major, minor) = (EGL.EGLint(), EGL.EGLint())
+        if not EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise RuntimeError("Could not initialize an EGL display.")
+
+        attribs = [EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                   EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8,
+                   EGL.EGL_BLUE_SIZE, 8, EGL.EGL_ALPHA_SIZE, 8,
+                   EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE]
+        (config, num_configs) = (EGL.EGLConfig(), EGL.EGLint())
+        EGL.eglChooseConfig(self.display, (EGL.EGLint*len(attribs))(*attribs),
+                            ctypes.pointer(config), 1, ctypes.pointer(num_configs))
+        if num_configs.value == 0:
+            raise RuntimeError("No EGL configuration supports desktop OpenGL.")
+
+        # Rendering goes to the framebuffer object, the surface only makes the context current
+        size = (EGL.EGLint*5)(EGL.EGL_WIDTH, 1, EGL.EGL_HEIGHT, 1, EGL.EGL_NONE)
+        self.surface = EGL.eglCreatePbufferSurface(self.display, config, size)
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        self.context = EGL.eglCreateContext(self.display, config, EGL.EGL_NO_CONTEXT, None)
+        if not EGL.eglMakeCurrent(self.display, self.surface, self.surface, self.context):
+            raise RuntimeError("Could not make the EGL context current.")
+
+    def _make_osmesa_context(self):
+        from OpenGL import osmesa, arrays
+        self._osmesa = osmesa
+        self.context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0, 0, None)
+        if not self.context:
+            raise RuntimeError("Could not create an OSMesa context.")
+        self._host_buffer = arrays.GLubyteArray.zeros((self.height, self.width, 4))
+        if not osmesa.OSMesaMakeCurrent(self.context, self._host_buffer, GL_UNSIGNED_BYTE,
+                                        self.width, self.height):
+            raise RuntimeError("Could not make the OSMesa context current.")
+
+    def close(self):
+        """
+        Free the framebuffer object and destroy the context.
+        """
+        glDeleteRenderbuffers(2, self.renderbuffers)
+        glDeleteFramebuffers(1, [self.fbo])
+        if self.platform == 'osmesa':
+            self._osmesa.OSMesaDestroyContext(self.context)
+        else:
+            EGL = self._egl
+            EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE,
+                               EGL.EGL_NO_CONTEXT)
+            EGL.eglDestroySurface(self.display, self.surface)
+            EGL.eglDestroyContext(self.display, self.context)
+            EGL.eglTerminate(self.display)
+
+
+def frame_steps(frame_time, time_step):
+    """
+    Integration steps and step size covering a fixed simulated time per frame.
+
+    Parameters
+    ----------
+    frame_time : float
+                 simulated time per frame (s)
+    time_step  : float
+                 largest integration time step (s)
+
+    Returns
+    -------
+    steps : int
+            integration steps per frame
+    dt    : float
+            time step (s), with steps*dt = frame_time
+    """
+    steps = max(int(np.ceil(frame_time/time_step*(1.-1e-9))), 1)
+    return steps, frame_time/steps
+
+
+def render_offscreen(queue, program, gl_context, capture, np_position, np_velocity, np_zmel,
+                     run_options, num_frames, frame_time, igrf_coeffs, field_grid,
+                     texture=None, view=None, camera_rotation=0.):
+    """
+    Propagate particles and render a movie of them without a window.
+
+    Every frame advances all particles by the same simulated time
+    ``frame_time``, whatever the rendering speed, and is handed to the
+    frame ``capture``. Frames are covered in steps of a fixed size, so
+    the adaptive Boris integrator, which shortens its steps, is rejected.
+    Particle positions and colors are copied from the OpenCL buffers to
+    the vertex buffers each frame, so that no OpenCL and OpenGL sharing
+    is needed.
+
+    Parameters
+    ----------
+    queue           : pyopencl.CommandQueue
+                      OpenCL queue of a context without OpenGL sharing
+    program         : pyopencl.Program
+                      compiled ``run_prop.cl`` program
+    gl_context      : OffscreenContext
+                      current offscreen context
+    capture         : capture_utils.FrameCapture
+                      frame capture reading ``gl_context.read_buffer``,
+                      closed when all frames are rendered
+    np_position     : array_like
+                      Nx4 initial positions
+    np_velocity     : array_like
+                      Nx4 initial velocities
+    np_zmel         : array_like
+                      Nx4 charge, mass, energy, gamma
+    run_options     : array_like
+                      time step, log10(Emax), log10 energy range and integrator;
+                      the time step is the largest one taken
+    num_frames      : int
+                      number of frames
+    frame_time      : float
+                      simulated time per frame (s)
+    igrf_coeffs     : pyopencl.Buffer
+                      IGRF coefficients
+    field_grid      : pyopencl.Buffer
+                      gridded field, see ``field_grid_buffer``
+    texture         : int, optional
+                      Earth texture name, a plain sphere by default
+    view            : dict, optional
+                      camera of ``set_camera``, the viewer's initial view by default
+    camera_rotation : float, optional
+                      rotation of the camera about z per frame in degrees
+
+    Returns
+    -------
+    position : array_like
+               Nx4 final positions
+    velocity : array_like
+               Nx4 final velocities
+    zmel     : array_like
+               Nx4 charge, mass, energy, gamma
+    """
+    if int(run_options[3]) == eom_dict['adaboris']:
+        raise ValueError("Offscreen movies need a fixed step integrator, not adaboris.")
+
+    context = queue.context
+    num_particles = np_position.shape[0]
+    position = np.array(np_position, dtype=np.float32)
+    color = np.zeros((num_particles, 4), dtype=np.float32)
+    velocity = np.array(np_velocity, dtype=np.float32)
+    zmel = np.array(np_zmel, dtype=np.float32)
+
+    cl_position = cl.Buffer(context, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=position)
+    cl_color = cl.Buffer(context, mf.READ_WRITE, size=color.nbytes)
+    cl_velocity = cl.Buffer(context, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=velocity)
+    cl_zmel = cl.Buffer(context, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=zmel)
+
+    (position_buffer, color_buffer) = glGenBuffers(2)
+    for buf in (position_buffer, color_buffer):
+        glBindBuffer(GL_ARRAY_BUFFER, buf)
+        glBufferData(GL_ARRAY_BUFFER, position.nbytes, None, GL_STREAM_DRAW)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    (steps, dt) = frame_steps(frame_time, run_options[0])
+    options = np.array(run_options, dtype=np.float32)
+    options[0] = dt
+    kernel = cl.Kernel(program, 'particle_prop_multistep')
+
+    earth = EarthMesh(texture) if texture is not None else EarthMesh(stacks=32, slices=32)
+    particles = ParticleRenderer()
+
+    view = dict(default_view if view is None else view)
+    view['rotate'] = dict(view['rotate'])
+
+    print('Rendering %i frames of %g s, %i steps of %g s each'%(num_frames, frame_time, steps, dt))
+    for frame in range(num_frames):
+        # The first frame shows the starting positions
+        kernel(queue, (num_particles,), None, cl_position, cl_color, cl_velocity, cl_zmel,
+               igrf_coeffs, field_grid, options, np.int32(steps if frame > 0 else 0))
+        cl.enqueue_copy(queue, position, cl_position)
+        cl.enqueue_copy(queue, color, cl_color)
+        queue.finish()
+
+        glBindBuffer(GL_ARRAY_BUFFER, position_buffer)
+        glBufferSubData(GL_ARRAY_BUFFER, 0, position.nbytes, position)
+        glBindBuffer(GL_ARRAY_BUFFER, color_buffer)
+        glBufferSubData(GL_ARRAY_BUFFER, 0, color.nbytes, color)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        set_camera(gl_context.width, gl_context.height, **view)
+        earth.draw()
+        particles.draw(position_buffer, color_buffer, num_particles)
+        capture.capture(gl_context.width, gl_context.height)
+
+        view['rotate']['z'] += camera_rotation
+
+    capture.close()
+    earth.delete()
+    glDeleteBuffers(2, [position_buffer, color_buffer])
+
+    cl.enqueue_copy(queue, velocity, cl_velocity)
+    cl.enqueue_copy(queue, zmel, cl_zmel)
+    queue.finish()
+    return position, velocity, zmel
@@ -6,6 +6,7 @@ try:
     import json
     import numpy as np
     from coord_utils import *
+    from spectrum_utils import power_law_quantile
 
 except ImportError as e:
     print(e)
@@ -19,6 +20,12 @@ run_dir = os.path.dirname(os.path.realpath(__file__))
 # Path to particle attributes json file
 json_pfile = os.path.join(run_dir, 'data/particle_properties.json')
 
+# Particle attributes, loaded from json_pfile on first use
+particle_props_cache = {}
+
+# Former species names still accepted for another key of json_pfile
+particle_aliases = {'magensium': 'magnesium'}
+
 # Cos ( Lowest Zenith )
 #cosThetaMin = 1
 cosThetaMin = -1.
@@ -50,20 +57,27 @@ def load_json_file(jfile):
 def get_particle_props(particle_name):
     """
     Get specific particle species properties
-    from default json file.
+    from default json file, read once and cached.
     """
     # Get full particle attribute dictionary
-    full_pdict = load_json_file(json_pfile)
+    if not particle_props_cache:
+        particle_props_cache.update(load_json_file(json_pfile))
 
     # Get specific species attributes
-    particle_props_dict = full_pdict[particle_name]
+    name = particle_aliases.get(particle_name, particle_name)
+    if name not in particle_props_cache:
+        known = sorted(particle_props_cache)
+        raise ValueError("Unknown particle species '%s', options: %s."%(
+                         particle_name, ', '.join(known)))
+    particle_props_dict = particle_props_cache[name]
 
     return particle_props_dict
 
-def energy_distribution(Emin, Emax, num_particles, alpha=None):
+def energy_distribution(Emin, Emax, num_particles, alpha=None, seed=None):
     """ Generate particle energies.  If given a spectral index 'alpha',
-        energies are randomly drawn from a power law energy spectrum.
-        Otherwise, energies are evenly distributed in logspace.
+        energies are randomly drawn from a power law energy spectrum
+        by inverse transform sampling. Otherwise, energies are evenly
+        distributed in logspace.
 
         Parameters
         ----------
@@ -75,49 +89,100 @@ def energy_distribution(Emin, Emax, num_particles, alpha=None):
              number of particles
         alpha : float, optional
              energy spectral index of the form E^-alpha
+        seed : int or numpy.random.Generator, optional
+             random seed or generator of the power law energies
 
         Returns
         -------
         numpy array of particle energies
 
     """
-    if alpha:
-        E = 10**np.arange(np.log10(Emin), np.log10(Emax), 0.01)
-        weights = E**-alpha
-        return np.random.choice(E, size=num_particles, p=weights/weights.sum())
+    if alpha is not None:
+        rng = np.random.default_rng(seed)
+        return power_law_quantile(rng.random(num_particles), Emin, Emax, alpha)
     else:
         return np.logspace(np.log10(Emin), np.log10(Emax), num_particles)
 
-def initial_buffers(particle_type, num_particles, Emin, Emax, lat, lon, height, alpha=None):
-    np_position = np.ndarray((num_particles, 4), dtype=np.float32)
-    np_velocity = np.ndarray((num_particles, 4), dtype=np.float32)
-    np_zmel = np.ndarray((num_particles, 4), dtype=np.float32)
-
+def particle_zmel(particle_type, energy):
+    """
+    Charge, mass, energy and gamma of particles of a given species.
+
+    Parameters
+    ----------
+    particle_type : str
+                    particle species
+    energy        : array_like
+                    kinetic energies in eV
+
+    Returns
+    -------
+    zmel : array_like
+           Nx4 float32 array of charge (C), mass (kg),
+           kinetic energy (eV) and gamma
+    """
     # Get species attributes
     particle_dict = get_particle_props(particle_type)
     chargeC = particle_dict['charge']
     masskg  = particle_dict['masskg']
     masseV  = particle_dict['masseV']
-    print('{} properties: \n\t masseV {} \n\t masskg {} \n\t charge in C {}\n\n'.format(particle_type, masseV, masskg, chargeC))
+
+    energy = np.asarray(energy)
+    zmel = np.zeros((energy.size, 4), dtype=np.float32)
+    zmel[:,0] = chargeC
+    zmel[:,1] = masskg
+    zmel[:,2] = energy
+    zmel[:,3] = energy/masseV+1.
+
+    return zmel
+
+def initial_buffers(particle_type, num_particles, Emin, Emax, lat, lon, height, alpha=None,
+                    seed=None):
+    rng = np.random.default_rng(seed)
+    np_position = np.ndarray((num_particles, 4), dtype=np.float32)
+    np_velocity = np.ndarray((num_particles, 4), dtype=np.float32)
+    np_zmel = np.ndarray((num_particles, 4), dtype=np.float32)
 
     ## Test values
-    Energy_array = energy_distribution(Emin, Emax, num_particles, alpha=alpha)
-    Gamma_array = Energy_array/masseV+1.
-    np_zmel[:,0] = chargeC
-    np_zmel[:,1] = masskg
-    np_zmel[:,2] = Energy_array
-    np_zmel[:,3] = Gamma_array
+    Energy_array = energy_distribution(Emin, Emax, num_particles, alpha=alpha, seed=rng)
+    np_zmel[:] = particle_zmel(particle_type, Energy_array)
 
     # Assign starting particle positions.
     np_position[:,0:3] = geodetic_to_geocentric(lat, lon, height)
     np_position[:,3] = 1.
 
     vr = -np.ones(num_particles)
-    vphi = 2.*np.pi*np.random.random(num_particles)
-    vtheta = np.arccos(np.random.uniform(cosThetaMin, 1, num_particles))
+    vphi = 2.*np.pi*rng.random(num_particles)
+    vtheta = np.arccos(rng.uniform(cosThetaMin, 1, num_particles))
 
     # Transform to Cartesian Coords
     np_velocity[:,0:3] = sph2cart(vr, vphi, vtheta)
     np_velocity[:,3] = 0.
 
     return (np_position, np_velocity, np_zmel)
+
+def write_particle_states(filename, position, velocity, zmel, lifecycle=None):
+    """
+    Save particle states, and optionally their
+    lifecycle, to a NumPy ``.npz`` archive.
+
+    Parameters
+    ----------
+    filename  : str
+                output file path
+    position  : array_like
+                Nx4 positions in Earth radii
+    velocity  : array_like
+                Nx4 velocities in m/s, with time (s) in the last column
+    zmel      : array_like
+                Nx4 charge, mass, energy, gamma
+    lifecycle : dict, optional
+                particle status and exit records from ``run_headless``
+    """
+    out_dir = os.path.dirname(filename)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    if lifecycle is None:
+        lifecycle = {}
+    np.savez(filename, position=position, velocity=velocity, zmel=zmel, **lifecycle)
+    print('Particle states written to %s'%filename)
@@ -0,0 +1,213 @@
+from __future__ import absolute_import
+
+try:
+    import os
+    import sys
+    import json
+    import threading
+    import numpy as np
+    import pyopencl as cl # OpenCL - GPU computing interface
+    from definitions import *
+    from trajectory_utils import trajectory_index_file
+
+    if sys.version_info[0] < 3:
+        import Queue as queue_module
+    else:
+        import queue as queue_module
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+# PyOpenCL memory flags
+mf = cl.mem_flags
+
+
+class TrajectoryRecorder(object):
+    """
+    Streaming trajectory recorder for the ``particle_prop_batch`` kernel.
+
+    The kernel writes the state of every particle each ``record_every``
+    steps into a device-side ring buffer of ``num_chunks*chunk_samples``
+    samples, so decimated steps never leave the device. Each completed
+    chunk is copied to a host staging array without blocking and
+    written by a background thread to its own memory-mapped ``.npy``
+    shard, of shape (samples, particles, 2, 4) holding position (Earth
+    radii) and velocity (m/s), each with the time (s) in the last
+    component. At most ``num_chunks`` staging arrays exist, so host
+    memory stays bounded however long the run is. Samples of dead
+    particles, which are no longer propagated, are NaN.
+
+    Parameters
+    ----------
+    queue         : pyopencl.CommandQueue
+                    in-order queue on which the kernel is launched
+    num_particles : int
+                    number of particles propagated by each launch
+    out_dir       : str
+                    directory receiving the shards and their index
+    record_every  : int, optional
+                    integration steps between recorded samples
+    chunk_samples : int, optional
+                    samples per chunk, and so per shard
+    num_chunks    : int, optional
+                    chunks held by the ring buffer, at least 2
+    """
+    def __init__(self, queue, num_particles, out_dir, record_every=100,
+                 chunk_samples=16, num_chunks=2):
+        if record_every < 1 or chunk_samples < 1:
+            raise ValueError("record_every and chunk_samples must be positive.")
+        if num_chunks < 2:
+            raise ValueError("The ring buffer must hold at least 2 chunks.")
+
+        self.num_particles = num_particles
+        self.out_dir = out_dir
+        self.record_every = record_every
+        self.chunk_samples = chunk_samples
+        self.num_chunks = num_chunks
+        self.ring_samples = num_chunks*chunk_samples
+        self.sample_shape = (num_particles, 2, 4)
+        self.sample_nbytes = num_particles*2*16
+        ring_nbytes = self.ring_samples*self.sample_nbytes
+        self.buffer = cl.Buffer(queue.context, mf.READ_WRITE, size=ring_nbytes)
+        cl.enqueue_fill_buffer(queue, self.buffer, np.float32(np.nan), 0, ring_nbytes)
+
+        # Host staging arrays cycle between the drain and the writer thread
+        self._free = queue_module.Queue()
+        for i in range(num_chunks):
+            staging = np.empty((chunk_samples,) + self.sample_shape, dtype=np.float32)
+            self._free.put(staging)
+        self._pending = queue_module.Queue()
+        self._writer = threading.Thread(target=self._write_shards)
+        self._writer.daemon = True
+        self._writer.start()
+
+        self.drained_samples = 0
+        self.shards = []
+        self._error = None
+
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+    def record_opts(self, step):
+        """
+        Recorder options of the ``particle_prop_batch`` kernel
+        for a launch starting after ``step`` steps.
+        """
+        return np.array([self.record_every, step, self.ring_samples, self.num_particles],
+                        dtype=np.int32)
+
+    def check_substeps(self, substeps):
+        """
+        Raise if a single launch of ``substeps`` steps could overwrite
+        samples of the ring buffer that have not been drained yet.
+        """
+        samples = -(-substeps//self.record_every)
+        if self.chunk_samples - 1 + samples > self.ring_samples:
+            raise ValueError(("Recording every %i steps, launches of %i steps overrun the ring "
+                              "buffer; use fewer substeps or larger chunks.")
+                             %(self.record_every, substeps))
+
+    def drain(self, queue, step):
+        """
+        Enqueue the transfer of every chunk completed after ``step`` steps.
+
+        Transfers follow the kernel launches in the in-order ``queue``,
+        and return without waiting for the device.
+        """
+        while step//self.record_every - self.drained_samples >= self.chunk_samples:
+            self._drain_samples(queue, self.chunk_samples)
+
+    def close(self, queue, step):
+        """
+        Drain the remaining samples, including a final partial chunk,
+        wait for the shards to be written and write the shard index.
+
+        Returns
+        -------
+        index_file : str
+                     path to the shard index
+        """
+        self.drain(queue, step)
+        remaining = step//self.record_every - self.drained_samples
+        if remaining > 0:
+            self._drain_samples(queue, remaining)
+
+        self._pending.put(None)
+        self._writer.join()
+        if self._error is not None:
+            raise self._error
+
+        index = {'record_every': self.record_every,
+                 'num_particles': self.num_particles,
+                 'layout': ['sample', 'particle', ['position', 'velocity'],
+                            ['x', 'y', 'z', 'time']],
+                 'shards': self.shards}
+        index_file = os.path.join(self.out_dir, trajectory_index_file)
+        with open(index_file, 'w') as handle:
+            json.dump(index, handle, indent=2)
+
+        print('Recorded %i samples of %i particles to %i shards in %s'%(
+              self.drained_samples, self.num_particles, len(self.shards), self.out_dir))
+
+        return index_file
+
+    def _drain_samples(self, queue, num_samples):
+        staging = self._free.get()
+        if self._error is not None:
+            raise self._error
+
+        # Chunks never wrap around the ring, as it holds a whole number of chunks
+        slot = self.drained_samples % self.ring_samples
+        event = cl.enqueue_copy(queue, staging[:num_samples], self.buffer,
+                                src_offset=slot*self.sample_nbytes, is_blocking=False)
+        # Clear the drained samples, leaving NaN for particles that are no longer propagated
+        cl.enqueue_fill_buffer(queue, self.buffer, np.float32(np.nan),
+                               slot*self.sample_nbytes, num_samples*self.sample_nbytes)
+
+        shard = {'file': 'trajectory_%05i.npy'%len(self.shards),
+                 'first_step': (self.drained_samples+1)*self.record_every,
+                 'num_samples': num_samples}
+        self.shards.append(shard)
+        self.drained_samples += num_samples
+
+        self._pending.put((event, staging, shard))
+
+    def _write_shards(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            (event, staging, shard) = item
+            try:
+                event.wait()
+                if self._error is None:
+                    self._write_shard(staging, shard)
+            except Exception as e:
+                self._error = e
+            self._free.put(staging)
+
+    def _write_shard(self, staging, shard):
+        shape = (shard['num_samples'],) + self.sample_shape
+        filename = os.path.join(self.out_dir, shard['file'])
+        out = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=shape)
+        out[...] = staging[:shard['num_samples']]
+        out.flush()
+        del out
+
+
+def record_buffer(context, recorder=None):
+    """
+    Ring buffer of a recorder, or a single element placeholder
+    for the unused kernel argument when not recording.
+    """
+    if recorder is None:
+        return cl.Buffer(context, mf.READ_WRITE, size=2*16)
+    return recorder.buffer
+
+
+def no_record_opts():
+    """
+    Recorder options of the ``particle_prop_batch`` kernel disabling recording.
+    """
+    return np.array([0, 0, 1, 0], dtype=np.int32)
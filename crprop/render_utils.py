@@ -0,0 +1,358 @@
+from __future__ import absolute_import
+
+try:
+    import ctypes
+    import numpy as np
+    from PIL import Image, ImageDraw, ImageFont
+    from OpenGL.GL import * # OpenGL - GPU rendering interface
+    from OpenGL.GL import shaders
+    from OpenGL.GLU import * # OpenGL tools (mipmaps, NURBS, perspective projection, shapes)
+    from definitions import *
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+
+# Initial perspective of the viewer, also used for offscreen movies
+default_view = {'zoom': 60.,
+                'rotate': {'x': -55., 'y': 0., 'z': 45.},
+                'translate': {'x': 0., 'y': 0., 'z': 0.},
+                'initial_translate': {'x': 0., 'y': 0., 'z': -10.501}}
+
+# Rotation of the Earth texture about z to align with HAWC longitude (deg)
+earth_rotation = 180./np.pi*np.arctan(HAWCY/HAWCX)
+
+# Particles drawn as round point sprites, with positions
+# in Earth radii and colors from the propagation kernel
+point_vertex_shader = """
+#version 120
+attribute vec4 position;
+attribute vec4 color;
+uniform float point_size;
+varying vec4 point_color;
+
+void main()
+{
+    gl_Position = gl_ModelViewProjectionMatrix*position;
+    gl_PointSize = point_size;
+    point_color = color;
+}
+"""
+
+point_fragment_shader = """
+#version 120
+varying vec4 point_color;
+
+void main()
+{
+    // Round points, fading out at the edge
+    vec2 d = 2.0*gl_PointCoord - 1.0;
+    float r2 = dot(d, d);
+    if (r2 > 1.0)
+        discard;
+    gl_FragColor = vec4(point_color.rgb, point_color.a*(1.0 - smoothstep(0.5, 1.0, r2)));
+}
+"""
+
+
+def load_texture_image(texture_file):
+    """
+    Load an image file into a 2D texture with Pillow, as ``load_texture``
+    does with pygame, for contexts without a window system.
+
+    Parameters
+    ----------
+    texture_file : str
+                   path to the image file
+
+    Returns
+    -------
+    tex_id : int
+             OpenGL texture name
+    """
+    im = Image.open(texture_file).convert('RGBA').transpose(Image.FLIP_TOP_BOTTOM)
+    tex_id = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_2D, tex_id)
+    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, im.size[0], im.size[1], 0, GL_RGBA, GL_UNSIGNED_BYTE,
+                 im.tobytes())
+    glBindTexture(GL_TEXTURE_2D, 0)
+    return tex_id
+
+
+def sphere_mesh(stacks, slices):
+    """
+    Unit sphere tessellated as ``gluSphere`` does, with the same texture coordinates.
+
+    Parameters
+    ----------
+    stacks : int
+             subdivisions along the z axis
+    slices : int
+             subdivisions around the z axis
+
+    Returns
+    -------
+    vertices : array_like
+               (stacks+1)*(slices+1) x 5 positions and texture coordinates
+    indices  : array_like
+               vertex indices of the triangles, counterclockwise seen from outside
+    """
+    rho = np.linspace(0., np.pi, stacks+1)[:,None]
+    theta = np.linspace(0., 2.*np.pi, slices+1)[None,:]
+    # The seam closes on the first slice
+    theta[0,-1] = 0.
+    vertices = np.zeros((stacks+1, slices+1, 5), dtype=np.float32)
+    vertices[...,0] = -np.sin(theta)*np.sin(rho)
+    vertices[...,1] = np.cos(theta)*np.sin(rho)
+    vertices[...,2] = np.cos(rho)
+    vertices[...,3] = np.arange(slices+1)[None,:]/float(slices)
+    vertices[...,4] = 1. - np.arange(stacks+1)[:,None]/float(stacks)
+
+    corner = (np.arange(stacks)[:,None]*(slices+1) + np.arange(slices)[None,:]).ravel()
+    below = corner + slices + 1
+    indices = np.transpose([corner, below, corner+1, corner+1, below, below+1]).astype(np.uint32)
+    return vertices.reshape(-1, 5), indices.ravel()
+
+
+def set_camera(width, height, zoom, rotate, translate, initial_translate):
+    """
+    Clear the frame and set up the perspective projection and camera.
+
+    Parameters
+    ----------
+    width             : int
+                        frame width in pixels
+    height            : int
+                        frame height in pixels
+    zoom              : float
+                        vertical field of view in degrees
+    rotate            : dict
+                        rotation angles about x and z in degrees
+    translate         : dict
+                        translation of the origin
+    initial_translate : dict
+                        translation of the camera from the origin
+    """
+    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    glMatrixMode(GL_MODELVIEW)
+    glLoadIdentity()
+
+    glViewport(0, 0, width, height)
+    glMatrixMode(GL_PROJECTION)
+    glLoadIdentity()
+    gluPerspective(zoom, width / float(height), .1, 10000.)
+
+    glTranslatef(initial_translate['x'], initial_translate['y'], initial_translate['z'])
+    glRotatef(rotate['x'], 1, 0, 0)
+    glRotatef(rotate['z'], 0, 0, 1)
+    glTranslatef(translate['x'], translate['y'], translate['z'])
+
+
+class EarthMesh(object):
+    """
+    The Earth as a sphere tessellated once into vertex and index buffers.
+
+    Parameters
+    ----------
+    texture : int, optional
+              texture name of the Earth map, a plain
+              transparent blue sphere without it
+    stacks  : int, optional
+              subdivisions along the z axis
+    slices  : int, optional
+              subdivisions around the z axis
+    """
+    def __init__(self, texture=None, stacks=100, slices=100):
+        self.texture = texture
+        (vertices, indices) = sphere_mesh(stacks, slices)
+        self.num_indices = indices.size
+        (self.vertex_buffer, self.index_buffer) = glGenBuffers(2)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer)
+        glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices, GL_STATIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices, GL_STATIC_DRAW)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+    def draw(self):
+        """
+        Draw the Earth, behind anything drawn later.
+        """
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        glMatrixMode(GL_MODELVIEW)
+        glPushMatrix()
+        glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glVertexPointer(3, GL_FLOAT, 20, ctypes.c_void_p(0))
+
+        if self.texture is not None:
+            glDepthMask(GL_FALSE)
+            glColor4f(1.0, 1.0, 1.0, 1.0)
+
+            # Only front of sphere appears
+            glEnable(GL_CULL_FACE)
+            glCullFace(GL_BACK)
+
+            glEnable(GL_TEXTURE_2D)
+            glBindTexture(GL_TEXTURE_2D, self.texture)
+            glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+            glTexCoordPointer(2, GL_FLOAT, 20, ctypes.c_void_p(12))
+
+            # Rotate Earth to align with HAWC longitude
+            glRotated(earth_rotation, 0.0, 0.0, 1.0)
+            glDrawElements(GL_TRIANGLES, self.num_indices, GL_UNSIGNED_INT, None)
+
+            glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+            glBindTexture(GL_TEXTURE_2D, 0)
+            glDisable(GL_TEXTURE_2D)
+            glDisable(GL_CULL_FACE)
+            glDepthMask(GL_TRUE)
+        else:
+            glColor4f(0.0, 0.0, 1.0, 0.15)
+            glDrawElements(GL_TRIANGLES, self.num_indices, GL_UNSIGNED_INT, None)
+
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glPopMatrix()
+        glDisable(GL_BLEND)
+
+    def delete(self):
+        """
+        Free the vertex and index buffers.
+        """
+        glDeleteBuffers(2, [self.vertex_buffer, self.index_buffer])
+
+
+class ParticleRenderer(object):
+    """
+    Particles drawn as round point sprites by a shader, straight from
+    vertex buffers of Nx4 positions and colors.
+
+    Parameters
+    ----------
+    point_size : float, optional
+                 point diameter in pixels
+    """
+    def __init__(self, point_size=2.):
+        self.point_size = point_size
+        self.program = shaders.compileProgram(
+            shaders.compileShader(point_vertex_shader, GL_VERTEX_SHADER),
+            shaders.compileShader(point_fragment_shader, GL_FRAGMENT_SHADER))
+        self.position_loc = glGetAttribLocation(self.program, 'position')
+        self.color_loc = glGetAttribLocation(self.program, 'color')
+        self.point_size_loc = glGetUniformLocation(self.program, 'point_size')
+
+    def draw(self, position_buffer, color_buffer, num_particles):
+        """
+        Draw the particles.
+
+        Parameters
+        ----------
+        position_buffer : int
+                          vertex buffer of the positions
+        color_buffer    : int
+                          vertex buffer of the colors
+        num_particles   : int
+                          number of particles
+        """
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        glEnable(GL_VERTEX_PROGRAM_POINT_SIZE)
+        glEnable(GL_POINT_SPRITE)
+        glUseProgram(self.program)
+        glUniform1f(self.point_size_loc, self.point_size)
+
+        for (loc, buf) in ((self.position_loc, position_buffer), (self.color_loc, color_buffer)):
+            glBindBuffer(GL_ARRAY_BUFFER, buf)
+            glEnableVertexAttribArray(loc)
+            glVertexAttribPointer(loc, 4, GL_FLOAT, GL_FALSE, 0, None)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        glDrawArrays(GL_POINTS, 0, num_particles)
+
+        glDisableVertexAttribArray(self.position_loc)
+        glDisableVertexAttribArray(self.color_loc)
+        glUseProgram(0)
+        glDisable(GL_POINT_SPRITE)
+        glDisable(GL_VERTEX_PROGRAM_POINT_SIZE)
+        glDisable(GL_BLEND)
+
+
+class TextOverlay(object):
+    """
+    Lines of text rasterized once into a texture with Pillow,
+    and drawn as a single quad in the top left corner.
+
+    Parameters
+    ----------
+    lines   : list
+              lines of text, blank ones included
+    spacing : int, optional
+              line height in pixels
+    """
+    def __init__(self, lines, spacing=12):
+        self.spacing = spacing
+        self.texture = glGenTextures(1)
+        self.set_text(lines)
+
+    def set_text(self, lines):
+        """
+        Rasterize new lines of text.
+        """
+        font = ImageFont.load_default()
+        widths = [font.getbbox(line)[2] for line in lines if line]
+        self.size = (max(widths + [1]), max(self.spacing*len(lines), 1))
+        im = Image.new('RGBA', self.size, (255, 255, 255, 0))
+        draw = ImageDraw.Draw(im)
+        for (i, line) in enumerate(lines):
+            draw.text((0, i*self.spacing), line, font=font, fill=(255, 255, 255, 255))
+
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.size[0], self.size[1], 0, GL_RGBA,
+                     GL_UNSIGNED_BYTE, im.tobytes())
+        glBindTexture(GL_TEXTURE_2D, 0)
+
+    def draw(self, width, height, x=0.05, y=0.01):
+        """
+        Draw the text with its top left corner at the
+        fractions x and y of the frame from the top left.
+        """
+        glViewport(0, 0, width, height)
+        glMatrixMode(GL_PROJECTION)
+        glLoadIdentity()
+        glOrtho(0., width, height, 0., -1., 1.)
+        glMatrixMode(GL_MODELVIEW)
+        glLoadIdentity()
+
+        depth_test = glIsEnabled(GL_DEPTH_TEST)
+        glDisable(GL_DEPTH_TEST)
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        glEnable(GL_TEXTURE_2D)
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glColor4f(1.0, 1.0, 1.0, 1.0)
+
+        # Whole pixels keep the text sharp
+        (left, top) = (int(x*width), int(y*height))
+        (right, bottom) = (left + self.size[0], top + self.size[1])
+        glBegin(GL_QUADS)
+        glTexCoord2f(0., 0.); glVertex2f(left, top)
+        glTexCoord2f(0., 1.); glVertex2f(left, bottom)
+        glTexCoord2f(1., 1.); glVertex2f(right, bottom)
+        glTexCoord2f(1., 0.); glVertex2f(right, top)
+        glEnd()
+
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glDisable(GL_TEXTURE_2D)
+        glDisable(GL_BLEND)
+        if depth_test:
+            glEnable(GL_DEPTH_TEST)
@@ -0,0 +1,302 @@
+from __future__ import absolute_import
+
+try:
+    import os
+    import sys
+    import numpy as np
+    import pyopencl as cl # OpenCL - GPU computing interface
+    from definitions import *
+    from coord_utils import geodetic_to_geocentric
+    from particle_utils import get_particle_props, cosThetaMin
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+# PyOpenCL memory flags
+mf = cl.mem_flags
+
+# Philox4x32-10 constants, matching rng.cl
+PHILOX_M0 = np.uint64(0xD2511F53)
+PHILOX_M1 = np.uint64(0xCD9E8D57)
+PHILOX_W0 = np.uint32(0x9E3779B9)
+PHILOX_W1 = np.uint32(0xBB67AE85)
+PHILOX_ROUNDS = 10
+
+
+def seed_key(seed=None):
+    """
+    Philox key of a run seed.
+
+    Parameters
+    ----------
+    seed : int or numpy.random.SeedSequence, optional
+           seed of the run, fresh entropy by default
+
+    Returns
+    -------
+    key : array_like
+          two uint32 key words
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.generate_state(2, dtype=np.uint32)
+
+
+def philox4x32(counter, key, rounds=PHILOX_ROUNDS):
+    """
+    Philox4x32 counter-based random words, as ``Philox4x32`` in rng.cl.
+
+    Parameters
+    ----------
+    counter : array_like
+              Nx4 uint32 counters
+    key     : array_like
+              two uint32 key words
+    rounds  : int, optional
+              number of rounds
+
+    Returns
+    -------
+    words : array_like
+            Nx4 uint32 random words
+    """
+    ctr = np.array(counter, dtype=np.uint32, ndmin=2).T.copy()
+    k0, k1 = np.asarray(key, dtype=np.uint32)
+    mask = np.uint64(0xFFFFFFFF)
+    for i in range(rounds):
+        prod0 = PHILOX_M0*ctr[0].astype(np.uint64)
+        prod1 = PHILOX_M1*ctr[2].astype(np.uint64)
+        hi0 = (prod0 >> np.uint64(32)).astype(np.uint32)
+        hi1 = (prod1 >> np.uint64(32)).astype(np.uint32)
+        ctr = np.array([hi1^ctr[1]^k0, (prod1 & mask).astype(np.uint32),
+                        hi0^ctr[3]^k1, (prod0 & mask).astype(np.uint32)])
+        k0 = np.uint32((int(k0) + int(PHILOX_W0)) & 0xFFFFFFFF)
+        k1 = np.uint32((int(k1) + int(PHILOX_W1)) & 0xFFFFFFFF)
+
+    return ctr.T
+
+
+def uniform_float(words):
+    """
+    Uniform deviates in [0, 1) from the top 24 bits of
+    random words, as ``UniformFloat`` in rng.cl.
+    """
+    return (np.asarray(words) >> 8).astype(np.float64)/16777216.
+
+
+def particle_counters(ids):
+    """
+    Philox counters of particle ids.
+    """
+    ids = np.asarray(ids, dtype=np.uint64)
+    counter = np.zeros((ids.size, 4), dtype=np.uint32)
+    counter[:,0] = (ids & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+    counter[:,1] = (ids >> np.uint64(32)).astype(np.uint32)
+    return counter
+
+
+def draw_species(words, species):
+    """
+    Species index of particles from their random words,
+    as in the ``particle_init`` kernel.
+
+    Parameters
+    ----------
+    words   : array_like
+              Nx4 uint32 random words of the particles
+    species : array_like
+              Sx4 species table, with the cumulative fractions in the last column
+
+    Returns
+    -------
+    species_id : array_like
+                 index in ``species`` of each particle
+    """
+    species = np.atleast_2d(species)
+    u = uniform_float(words[:,3])
+    species_id = np.searchsorted(species[:-1,3], u, side='right')
+    return species_id.astype(np.int32)
+
+
+def init_states(key, ids, site, species, spectra, cos_min, t0=0.):
+    """
+    Starting states of particles, as drawn by the ``particle_init`` kernel.
+
+    Computed in double precision, this reproduces any particle of a
+    device-initialized run on the host from the seed and its id alone.
+
+    Parameters
+    ----------
+    key     : array_like
+              Philox key of the run, see ``seed_key``
+    ids     : array_like
+              particle ids
+    site    : array_like
+              starting position in Earth radii
+    species : array_like
+              Sx4 charge (C), mass (kg), rest energy (eV) and
+              cumulative fraction of each species
+    spectra : array_like
+              Sx4 Emin and Emax (eV) and spectral index alpha of each species
+    cos_min : float
+              cosine of the largest polar angle
+    t0      : float, optional
+              starting time (s)
+
+    Returns
+    -------
+    position : array_like
+               Nx4 positions in Earth radii
+    velocity : array_like
+               Nx4 unit directions, with the time in the last column
+    zmel     : array_like
+               Nx4 charge, mass, energy, gamma
+    """
+    words = philox4x32(particle_counters(ids), key)
+    num = words.shape[0]
+    species = np.atleast_2d(species)
+    species_id = draw_species(words, species)
+    (Emin, Emax, alpha) = np.atleast_2d(spectra)[species_id,0:3].T
+    charge, masskg, masseV = species[species_id,0:3].T
+
+    phi = 2.*np.pi*uniform_float(words[:,0])
+    cos_theta = cos_min + (1.-cos_min)*uniform_float(words[:,1])
+    sin_theta = np.sqrt(np.maximum(1.-cos_theta**2, 0.))
+    velocity = np.zeros((num, 4))
+    velocity[:,0:3] = -np.transpose([sin_theta*np.cos(phi), sin_theta*np.sin(phi), cos_theta])
+    velocity[:,3] = t0
+
+    log_ratio = np.log(Emax/Emin)
+    g = 1. - alpha
+    u = uniform_float(words[:,2])
+    flat = np.abs(g*log_ratio) < 1e-6
+    g = np.where(flat, 1., g)
+    energy = Emin*np.exp(np.where(flat, u*log_ratio, np.log1p(u*np.expm1(g*log_ratio))/g))
+    zmel = np.zeros((num, 4))
+    zmel[:,0] = charge
+    zmel[:,1] = masskg
+    zmel[:,2] = energy
+    zmel[:,3] = energy/masseV + 1.
+
+    position = np.zeros((num, 4))
+    position[:,0:3] = site[0:3]
+    position[:,3] = 1.
+
+    return position, velocity, zmel
+
+
+class DeviceInitializer(object):
+    """
+    Starting states of particles drawn directly in device memory.
+
+    The ``particle_init`` kernel gives particle ``id`` the Philox random
+    numbers of counter ``id`` under the run's key, so that its direction and
+    energy depend on the seed and its id only. Nothing is generated on the
+    host or uploaded, initial fills and refills of dead slots draw the same
+    particles, and runs split by particle id reproduce a single run.
+    Directions follow ``initial_buffers``, and energies an E^-alpha power law
+    (uniform in log E without alpha). With ``components``, every launch draws
+    a mix of species, each with its own power law.
+
+    Parameters
+    ----------
+    program       : pyopencl.Program
+                    compiled ``run_prop.cl`` program
+    num_particles : int
+                    number of particle slots
+    particle_type : str
+                    particle species
+    Emin          : float
+                    minimum particle energy in eV
+    Emax          : float
+                    maximum particle energy in eV
+    lat           : float
+                    geodetic latitude of the starting position in degrees
+    lon           : float
+                    geodetic longitude of the starting position in degrees
+    height        : float
+                    height of the starting position in Earth radii
+    alpha         : float, optional
+                    energy spectral index of the form E^-alpha
+    seed          : int or numpy.random.SeedSequence, optional
+                    seed of the run
+    components    : list, optional
+                    composition from ``spectrum_components``, of single power
+                    laws, replacing ``particle_type`` and ``alpha``
+    """
+    def __init__(self, program, num_particles, particle_type, Emin, Emax, lat, lon, height,
+                 alpha=None, seed=None, components=None):
+        if components is None:
+            components = [{'species': particle_type, 'fraction': 1., 'edges': [Emin, Emax],
+                           'alpha': [1. if alpha is None else alpha]}]
+        if any(len(c['alpha']) > 1 for c in components):
+            raise ValueError("Device initialization draws single power laws only, not broken ones.")
+
+        self.num_particles = num_particles
+        self.key = seed_key(seed)
+        self.site = np.zeros(4, dtype=np.float32)
+        self.site[0:3] = geodetic_to_geocentric(lat, lon, height)
+        self.species_names = [c['species'] for c in components]
+
+        # Species and spectrum tables, with the cumulative fractions last
+        self.species = np.zeros((len(components), 4), dtype=np.float32)
+        self.spectra = np.zeros((len(components), 4), dtype=np.float32)
+        for (i, c) in enumerate(components):
+            particle_dict = get_particle_props(c['species'])
+            self.species[i,0:3] = (particle_dict['charge'], particle_dict['masskg'],
+                                   particle_dict['masseV'])
+            self.spectra[i,0:3] = (c['edges'][0], c['edges'][-1], c['alpha'][0])
+        self.species[:,3] = np.cumsum([c['fraction'] for c in components])
+        self.species[-1,3] = 1.
+        self.cos_min = np.float32(cosThetaMin)
+
+        context = program.get_info(cl.program_info.CONTEXT)
+        self.cl_species = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=self.species)
+        self.cl_spectra = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=self.spectra)
+        self.kernel = cl.Kernel(program, 'particle_init')
+
+    def init(self, queue, cl_position, cl_velocity, cl_zmel, num, first_id=0, slots=None, t0=0.):
+        """
+        Enqueue the initialization of ``num`` particles with consecutive
+        ids from ``first_id``, into the given ``slots`` or the first slots.
+        """
+        if num == 0:
+            return
+        if slots is None:
+            cl_slots = cl.Buffer(queue.context, mf.READ_ONLY, size=4)
+        else:
+            slots = np.ascontiguousarray(slots, dtype=np.int32)
+            cl_slots = cl.Buffer(queue.context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=slots)
+
+        key = np.zeros(1, dtype=cl.cltypes.uint2)
+        key[0]['x'], key[0]['y'] = self.key
+        self.kernel(queue, (num,), None, cl_slots, cl_position, cl_velocity, cl_zmel,
+                    key, np.uint64(first_id), np.int32(slots is not None),
+                    self.site, self.cl_species, self.cl_spectra, np.int32(len(self.species)),
+                    self.cos_min, np.float32(t0))
+
+    def buffers(self, queue):
+        """
+        Device buffers of position, velocity and zmel holding the
+        starting states of all particles, with ids 0 to N-1.
+        """
+        nbytes = 16*self.num_particles
+        cl_position = cl.Buffer(queue.context, mf.READ_WRITE, size=nbytes)
+        cl_velocity = cl.Buffer(queue.context, mf.READ_WRITE, size=nbytes)
+        cl_zmel = cl.Buffer(queue.context, mf.READ_WRITE, size=nbytes)
+        self.init(queue, cl_position, cl_velocity, cl_zmel, self.num_particles)
+        return cl_position, cl_velocity, cl_zmel
+
+    def host_states(self, ids, t0=0.):
+        """
+        Starting states of the given particle ids, computed on the host.
+        """
+        return init_states(self.key, ids, self.site, self.species.astype(np.float64),
+                           self.spectra.astype(np.float64), float(self.cos_min), t0=t0)
+
+    def species_ids(self, ids):
+        """
+        Species index, in ``species_names``, of the given particle ids.
+        """
+        return draw_species(philox4x32(particle_counters(ids), self.key), self.species)
@@ -3,30 +3,65 @@ from __future__ import absolute_import
 try:
     import os
     import sys
+    import importlib
     import numpy as np
     import argparse
     import yaml
     from definitions import *
     from particle_utils import *
-    from extras import printText, printHelp
-    from opengl_utils import *
-    #load_texture, axis, threeAxis, mouse, motion
-
-    from PIL import Image
-
-    import pyopencl as cl # OpenCL - GPU computing interface
-    from pyopencl.tools import get_gl_sharing_context_properties
-    from OpenGL.GL import * # OpenGL - GPU rendering interface
-    from OpenGL.GLU import * # OpenGL tools (mipmaps, NURBS, perspective projection, shapes)
-    from OpenGL.GLUT import * # OpenGL tool to make a visualization window
-    from OpenGL.arrays import vbo
+    from injection_utils import load_sources, injected_buffers, tag_sources
+    from spectrum_utils import spectrum_components, spectrum_zmel, tag_species
+    from extras import info_message, printHelp
+    from field_utils import igrf_coefficients, igrf_epoch_days, default_grid_shape
+    from numpy_backend import run_numpy
+    from batch_utils import shard_seed, shard_counts, shard_energy_range, exit_histograms
+    from sweep_utils import SWEEP_KEYS, expand_sweep, config_label, sweep_buffers, tag_configs
 
 except ImportError as e:
     print(e)
     raise ImportError
 
-# PyOpenCL memory flags
-mf = cl.mem_flags
+
+def import_names(module_name):
+    """ Import a module and bring its public names into the
+        script namespace, as 'from module import *' would.
+    """
+    module = importlib.import_module(module_name)
+    names = getattr(module, '__all__', [n for n in vars(module) if not n.startswith('_')])
+    globals().update((n, getattr(module, n)) for n in names)
+    return module
+
+
+# OpenCL and the OpenGL viewer are only imported by the run modes
+# that use them, keeping startup fast for short batch jobs
+def import_opencl():
+    """ Import the OpenCL modules, needed by everything but the NumPy backend.
+    """
+    global cl
+    try:
+        import pyopencl as cl # OpenCL - GPU computing interface
+        for module_name in ('cl_utils', 'headless_utils', 'recorder_utils',
+                            'field_grid_utils', 'cutoff_utils', 'rng_utils', 'simulation_utils'):
+            import_names(module_name)
+    except ImportError as e:
+        print(e)
+        raise ImportError("PyOpenCL is required, use --headless --backend numpy to run without it.")
+
+
+def import_viewer():
+    """ Import the OpenGL modules, needed by the interactive viewer only.
+    """
+    try:
+        import_names('opengl_utils')
+        import_names('render_utils')
+        import_names('capture_utils')
+        import_names('OpenGL.GL')   # OpenGL - GPU rendering interface
+        import_names('OpenGL.GLU')  # OpenGL tools (mipmaps, NURBS, perspective projection, shapes)
+        import_names('OpenGL.GLUT') # OpenGL tool to make a visualization window
+    except ImportError as e:
+        print(e)
+        raise ImportError("OpenGL is required for the interactive viewer, "
+                          "use --headless to run without it.")
 
 np.set_printoptions(threshold=sys.maxsize)
 
@@ -37,44 +72,13 @@ texture_file = os.path.join(TEXTURE_DIR, 'earthmap1k.jpg')
 # Path to output frame pngs
 frame_prefix = os.path.join(FRAME_OUTPUT_DIR, 'particle')
 
-# Whether to save frames to pngs
+# Whether to save frames to pngs, captured in the background
 save_frames = False
-frame = 0
+capture = None
 
 # Continuously rotate perspective
 rotate_perspective = False
 
-# Dictionary for choosing EOM integrators
-eom_dict = {'euler'    : 1,
-            'rk4'      : 2,
-            'boris'    : 3,
-            'adaboris' : 4}
-
-
-# Dictionary for grabbing available devices
-deviceDict = {'gpu' : cl.device_type.GPU,
-              'cpu' : cl.device_type.CPU}
-
-# Define pyopencl context and queue based on available hardware
-def init_device(cpu_device=False):
-    # Find a device... default is for GPU
-    device_type_name = 'gpu'
-    if cpu_device:
-        device_type_name = 'cpu'
-
-    # Grab OpenCL device calls
-    device_type = deviceDict[device_type_name]
-
-    print('\n============== Grabbing Compute Resources =============\n')
-    platform = cl.get_platforms()[0]
-    print('\t\tPlatform: %s'%platform)
-    device = platform.get_devices(device_type=device_type)
-    print('\t\tDevice: %s'%device[0])
-    print('\n=======================================================\n')
-    context = cl.Context(devices=device,
-                         properties=[(cl.context_properties.PLATFORM, platform)] + get_gl_sharing_context_properties())
-    return device, context
-
 def glut_window():
 
     global initRun
@@ -90,6 +94,7 @@ def glut_window():
     glClearColor(0.0,0.0,0.0,0.0) # Black Background
     #glClearColor(1.0,1.0,1.0,0.0) # White Background
     glutDisplayFunc(on_display)  # Called by GLUT every frame
+    glutReshapeFunc(on_reshape)
     glutKeyboardFunc(on_key)
     glutMouseFunc(mouse)
     glutMotionFunc(motion)
@@ -103,24 +108,19 @@ def on_key(*args):
     global drawInfoMessage
     global rotate_perspective
     global width, height, isBigDisplay
-    global save_frames, time_step, time_pause_var, run_options
+    global save_frames, capture
 
     # Pause and restart
     if args[0] == b' ' or args[0] == b'p':
-        time_step = time_pause_var-time_step
-        run_options[0] = time_step
+        simulation.toggle_pause()
 
-    # Speed up by 10 percent
+    # Simulated time per second up by 10 percent
     if args[0] == b'+':
-        time_step += 0.1*time_step
-        time_pause_var = time_step
-        run_options[0] = time_step
+        simulation.set_rate(1.1*simulation.sim_rate)
 
-    # Slow down by 10 percent
+    # Simulated time per second down by 10 percent
     if args[0] == b'-':
-        time_step -= 0.1*time_step
-        time_pause_var = time_step
-        run_options[0] = time_step
+        simulation.set_rate(simulation.sim_rate/1.1)
 
     # Rotate vieweing perspective
     if args[0] == b'r':
@@ -129,8 +129,15 @@ def on_key(*args):
     # Save frames to file
     if args[0] == b's':
         save_frames = not save_frames
-        if not os.path.exists(FRAME_OUTPUT_DIR):
-            os.makedirs(FRAME_OUTPUT_DIR)
+        if capture is None and video_file:
+            # One writer keeps the movie frames in order
+            capture = FrameCapture(frame_prefix, num_writers=1,
+                                   write_frame=VideoWriter(video_file, fps=video_fps))
+        elif capture is None:
+            capture = FrameCapture(frame_prefix, num_writers=capture_writers)
+        elif not save_frames:
+            # Write the frames still in flight
+            capture.flush()
 
     # Toggle textured Earth and simple sphere
     if args[0] == b't':
@@ -140,21 +147,30 @@ def on_key(*args):
     if args[0] == b'i':
         drawInfoMessage = not drawInfoMessage
     
-    # Quickly toggle large and small display sizes
+    # Quickly toggle large and small display sizes,
+    # width and height follow in on_reshape
     if args[0] == b'b':
         if isBigDisplay:
-            width /= display_scale_factor
-            height /= display_scale_factor
+            glutReshapeWindow(width // display_scale_factor, height // display_scale_factor)
         else:
-            width *= display_scale_factor
-            height *= display_scale_factor
+            glutReshapeWindow(width * display_scale_factor, height * display_scale_factor)
         isBigDisplay = not isBigDisplay
 
     # Exit program
     if args[0] == b'\033' or args[0] == b'q':
+        simulation.stop()
+        if capture is not None:
+            capture.close()
         sys.exit()
 
 
+def on_reshape(w, h):
+    """ Track the window size, used for the viewport and frame capture.
+    """
+    global width, height
+    width, height = w, max(h, 1)
+
+
 def on_display():
 
     # Rotate camera
@@ -163,131 +179,38 @@ def on_display():
         rotate['z'] += dx
 
     """Render the particles"""
-    # Update or particle positions by calling the OpenCL kernel
-    cl.enqueue_acquire_gl_objects(queue, [cl_gl_position, cl_gl_color])
-
-    kernelargs = (cl_gl_position, cl_gl_color, cl_velocity, cl_zmel,
-                  cl_start_position, cl_start_velocity,
-                  run_options)
-                  #np.float32(log_Emax), np.float32(Erange), np.float32(time_step))
-
-    program.particle_prop(queue, (num_particles,), None, *(kernelargs))
-    cl.enqueue_release_gl_objects(queue, [cl_gl_position, cl_gl_color])
-    queue.finish()
-
-    glFlush()
-
-    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-    glMatrixMode(GL_MODELVIEW)
-    glLoadIdentity()
+    # Latest state completed by the simulation thread
+    index = simulation.acquire()
 
-    glViewport(0, 0, width, height)
-    glMatrixMode(GL_PROJECTION)
-    glLoadIdentity()
-    gluPerspective(zoom, width / float(height), .1, 10000.)
-
-    # Handle mouse transformations
-    glTranslatef(initial_translate['x'], initial_translate['y'], initial_translate['z'])
-    glRotatef(rotate['x'], 1, 0, 0)
-    glRotatef(rotate['z'], 0, 0, 1)
-    glTranslatef(translate['x'], translate['y'], translate['z'])
+    # Camera with the mouse transformations
+    set_camera(width, height, zoom, rotate, translate, initial_translate)
 
     if (drawTexturedEarth):
         # Draw Earth
-        global texture
-        glDepthMask(GL_FALSE)
-
-        glEnable(GL_BLEND)
-        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-        glColor4f(1.0,1.0,1.0,1.0)
-        #glColor4f(1.0,1.0,1.0,0.75)
-        quad = gluNewQuadric()
-
-        glPushMatrix()
-
-        # Only front of sphere appears
-        glEnable(GL_CULL_FACE)
-        glCullFace(GL_BACK)
-
-        # Bind texture to quadric
-        glEnable(GL_TEXTURE_2D)
-        glBindTexture(GL_TEXTURE_2D, texture)
-        gluQuadricTexture(quad, True)
-
-        # Rotate Earth to align with HAWC longitude
-        e_rot = 180./np.pi*np.arctan(HAWCY/HAWCX)
-        glRotated(e_rot, 0.0, 0.0, 1.0)
-
-        # Define sphere as quadric surface
-        gluSphere(quad, 1.0, 100, 100)
-
-        glDisable(GL_BLEND)
-        glDisable(GL_CULL_FACE)
-        glDepthMask(GL_TRUE)
-
-        glPopMatrix()
-
-
+        earth.draw()
     else:
-        # Draw a blue sphere
-        # Draw xyz axes
+        # Draw xyz axes and a transparent Earth
         threeAxis(1.5)
-        # Draw Transparent Earth
-        glEnable(GL_BLEND)
-        glColor4f(0.0, 0.0, 1.0, 0.15)
-        glutSolidSphere(1.0, 32, 32)
-        glDisable(GL_BLEND)
+        sphere.draw()
 
     # Render the particles
-    glEnable(GL_POINT_SMOOTH)
-    glPointSize(2)
-    glEnable(GL_BLEND)
-    glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-
-    # Set up the VBOs
-    gl_color.bind()
-    glColorPointer(4, GL_FLOAT, 0, gl_color)
-    gl_position.bind()
-    glVertexPointer(4, GL_FLOAT, 0, gl_position)
-    glEnableClientState(GL_VERTEX_ARRAY)
-    glEnableClientState(GL_COLOR_ARRAY)
-
-    # Draw the VBOs
-    glDrawArrays(GL_POINTS, 0, num_particles)
+    particles.draw(gl_position_ids[index], gl_color_ids[index], num_particles)
 
-    glDisableClientState(GL_COLOR_ARRAY)
-    glDisableClientState(GL_VERTEX_ARRAY)
-
-    glDisable(GL_BLEND)
+    # The simulation refills these buffers once OpenGL is done with them
+    glFinish()
+    simulation.release()
 
     # Info message on screen
-    textx = 0.05
-    texty = 0.99
-    texty_delta = 0.0115
     if drawInfoMessage:
-        for lineno in range(21):
-            texty -= texty_delta
-            glut_print(printText(lineno=lineno), textx, texty)
-
-    glutSwapBuffers()
+        overlay.draw(width, height, x=0.05, y=0.02)
 
-    # Inspired by the 'render.py` script from 
-    # https://groups.google.com/forum/#!topic/pygame-mirror-on-google-groups/qdFuQh8RY4g
-    # NOTE: the GL_RGB / GL_RGBA difference
+    # Start reading the frame back before the swap, written by the
+    # capture threads a few frames later
     if save_frames:
-        global frame
-        png_file_write(frame_prefix, frame, glReadPixels( 0,0, w, h, GL_RGBA, GL_UNSIGNED_BYTE))
-        frame += 1
-
+        capture.capture(width, height)
 
-#######################################################################################
-
-# write a png file from GL framebuffer data
+    glutSwapBuffers()
 
-def png_file_write(name, number, data):
-    im = Image.frombuffer("RGBA", (720,576), data, "raw", "RGBA", 0, 0)
-    fnumber = "%05d" % number
-    im.save(name + fnumber + ".png")
 
 ######################################################################################
 
@@ -309,22 +232,162 @@ if __name__=="__main__":
     p.add_argument("-e", "--energy_lims", dest="energy_lims", nargs=2,
                    default=[1e7, 1e8], type=check_positive_float,
                    help="Minimum and maximum energy of particles (eV). ")
-    p.add_argument("-a", "--alpha", dest="alpha", type=check_positive_float,
+    p.add_argument("-a", "--alpha", dest="alpha", type=check_positive_float, nargs='+',
                    help=("Optional energy spectral index. "
-                         "If given, weight the energy distribution of events by E^-alpha."))
+                         "If given, weight the energy distribution of events by E^-alpha. "
+                         "With --energy_breaks, one index per segment of a broken power law."))
+    p.add_argument("--energy_breaks", dest="energy_breaks", type=check_positive_float, nargs='+',
+                   help="Energies (eV) of the breaks of a broken power law spectrum.")
+    p.add_argument("--composition", dest="composition",
+                   help=("YAML or JSON file mapping species to their fraction of the particles, "
+                         "and optionally their own alpha and energy breaks, "
+                         "or inline fractions such as proton:0.9,helium:0.1."))
+    p.add_argument("--seed", dest="seed", type=int,
+                   help="Random seed of the particle energies, positions and directions.")
     p.add_argument("--lat_lon_alt", dest="lat_lon_alt",
                    nargs=3, type=float, default=[18.99, -97.308, 3],
                    help=("Geodetic latitude of starting particle position in degrees, "
                          "Geodetic longitude of starting particle position in degrees, "
-                         "Height of starting particle position in Earth radii where 1 is ground level."))
+                         "Height of starting particle position in Earth radii "
+                         "where 1 is ground level."))
+    p.add_argument("--sources", dest="sources",
+                   help=("YAML or JSON file of injection sources (sites, geographic boxes "
+                         "and shells with direction cones), replacing --lat_lon_alt."))
     p.add_argument("-s", "--eom_step", dest="eom_step", default="boris",
                    help=("Stepper function to integrate equations of motion. "
                          "Options: boris, adaboris, euler, rk4."))
     p.add_argument("-d", "--cpu", dest="device", help='Flag to run on CPU', action='store_true')
+    p.add_argument("-f", "--field", dest="field", choices=["dipole", "igrf", "uniform"],
+                   help=("Magnetic field model used by every stepper. By default "
+                         "dipole, and IGRF for adaboris."))
+    p.add_argument("--precision", dest="precision", default="strict", choices=["strict", "fast"],
+                   help=("Kernel arithmetic: strict IEEE single precision, "
+                         "or fast relaxed math (-cl-fast-relaxed-math)."))
+    p.add_argument("--igrf_epoch", dest="igrf_epoch", default=2015.0, type=float,
+                   help="Decimal year at which the IGRF coefficients are evaluated.")
+    p.add_argument("--igrf_eval", dest="igrf_eval", default="recurrence",
+                   choices=["recurrence", "direct"],
+                   help=("IGRF evaluation used by the IGRF field model: "
+                         "recurrence-based or direct (pow/cos/sin per term)."))
+    p.add_argument("--field_grid", dest="field_grid", choices=["igrf", "dipole"],
+                   help=("Sample this field model once on a spherical grid (cached on disk) "
+                         "and interpolate from it in all integrators, instead of --field."))
+    p.add_argument("--grid_shape", dest="grid_shape", nargs=3, type=check_positive_int,
+                   default=list(default_grid_shape),
+                   help="Number of field grid nodes in r, theta and phi.")
+    p.add_argument("-t", "--time_step", dest="time_step", default=0.0005,
+                   type=check_positive_float,
+                   help="Integration time step (s). The viewer starts paused at this step size.")
+
+    # Headless batch propagation without OpenGL
+    p.add_argument("--headless", dest="headless", action='store_true',
+                   help="Propagate without a display and write the final particle states to file.")
+    p.add_argument("--backend", dest="backend", default="opencl", choices=["opencl", "numpy"],
+                   help=("Propagation backend of a headless run. The NumPy backend needs no "
+                         "OpenCL runtime and supports the euler, boris and adaboris steppers."))
+    p.add_argument("--num_steps", dest="num_steps", type=check_positive_int,
+                   help="Number of integration steps for a headless run.")
+    p.add_argument("--sim_time", dest="sim_time", type=check_positive_float,
+                   help="Simulated time (s) every particle reaches in a headless run.")
+    p.add_argument("-o", "--output", dest="output", default="particle_states.npz",
+                   help="Output file for the final particle states of a headless run.")
+    p.add_argument("--substeps", dest="substeps", default=10, type=check_positive_int,
+                   help="Integration steps per kernel launch in a headless run or the viewer.")
+    p.add_argument("--num_shards", dest="num_shards", type=check_positive_int,
+                   help=("Split the particles of a headless run into this many shards, "
+                         "run one at a time with --shard (see batch.py). "
+                         "Runs are not sharded by default."))
+    p.add_argument("--shard", dest="shard", type=int,
+                   help=("Shard of the run to propagate, e.g. the task id of a job array. "
+                         "Its particles are seeded from --seed and the shard id."))
+    p.add_argument("--refill", dest="refill", action='store_true',
+                   help=("Replace particles that hit the Earth or escape with fresh ones "
+                         "in a headless run."))
+    p.add_argument("--device_init", dest="device_init", action='store_true',
+                   help=("Draw the starting particles, and refills, of a headless run directly "
+                         "on the device, each from the seed and its id alone "
+                         "(single site and power law)."))
+    p.add_argument("--all_devices", dest="all_devices", action='store_true',
+                   help=("Spread a headless run over every OpenCL device of every platform "
+                         "(CPU devices only with --cpu), balanced by measured throughput."))
+    p.add_argument("--device_fission", dest="device_fission", default=0, type=int,
+                   help=("Split CPU devices into sub-devices of this many compute units "
+                         "with --all_devices."))
+    p.add_argument("--record_every", dest="record_every", type=check_positive_int,
+                   help="Record trajectories of a headless run every this many steps.")
+    p.add_argument("--record_dir", dest="record_dir", default="trajectories",
+                   help="Output directory for the recorded trajectory shards.")
+    p.add_argument("--record_chunk", dest="record_chunk", default=16, type=check_positive_int,
+                   help="Recorded samples per trajectory shard.")
+    p.add_argument("--steps_per_frame", dest="steps_per_frame", default=1, type=check_positive_int,
+                   help=("Integration steps per rendered frame of offscreen movies "
+                         "without --frame_time."))
+    p.add_argument("--sim_rate", dest="sim_rate", default=0.05, type=check_positive_float,
+                   help=("Simulated seconds per second of the viewer, changed with the + and - "
+                         "keys. The simulation runs on its own thread, at most --substeps steps "
+                         "per drawn state."))
+    p.add_argument("--capture_writers", dest="capture_writers", default=2, type=check_positive_int,
+                   help="Background threads encoding the frames saved by the viewer.")
+    p.add_argument("--video", dest="video",
+                   help=("Stream the frames saved by the viewer into this movie file through "
+                         "ffmpeg, instead of png files. Without ffmpeg, raw frames are written "
+                         "next to it."))
+    p.add_argument("--video_fps", dest="video_fps", default=60., type=check_positive_float,
+                   help="Frame rate of the --video movie.")
+    p.add_argument("--frame_dir", dest="frame_dir", default=FRAME_OUTPUT_DIR,
+                   help="Output directory of the saved png frames.")
+
+    # Movies rendered without a window, e.g. on compute nodes
+    offscreen = p.add_argument_group("offscreen movie rendering")
+    offscreen.add_argument("--render_frames", dest="render_frames", type=check_positive_int,
+                           help=("Render this many frames into an offscreen framebuffer, "
+                                 "saved as png frames or to the --video movie, "
+                                 "without opening a window."))
+    offscreen.add_argument("--frame_time", dest="frame_time", type=check_positive_float,
+                           help=("Simulated time (s) per rendered frame, covered in steps "
+                                 "of at most --time_step. By default time_step*steps_per_frame."))
+    offscreen.add_argument("--render_size", dest="render_size", nargs=2, default=[720, 576],
+                           type=check_positive_int, help="Width and height of the rendered frames.")
+    offscreen.add_argument("--gl_platform", dest="gl_platform", default="egl",
+                           choices=["egl", "osmesa"],
+                           help=("Headless OpenGL platform: EGL (GPU or Mesa), "
+                                 "or OSMesa software rendering."))
+    offscreen.add_argument("--camera_rotation", dest="camera_rotation", default=0., type=float,
+                           help="Rotation of the camera about the z axis per rendered frame (deg).")
+
+    # Cutoff rigidity sky map of the site given by --lat_lon_alt
+    cutoff = p.add_argument_group("cutoff rigidity map")
+    cutoff.add_argument("--cutoff_map", dest="cutoff_map", action='store_true',
+                        help=("Backtrack antiparticles from the site over a grid of directions "
+                              "and rigidities, and write a cutoff rigidity sky map to file."))
+    cutoff.add_argument("--site_alt_km", dest="site_alt_km", default=20., type=float,
+                        help=("Starting altitude of the backtracked trajectories "
+                              "above the site (km)."))
+    cutoff.add_argument("--zenith_max", dest="zenith_max", default=60., type=float,
+                        help="Maximum zenith angle of the sky map (deg).")
+    cutoff.add_argument("--zenith_step", dest="zenith_step", default=10., type=check_positive_float,
+                        help="Zenith angle spacing of the sky map (deg).")
+    cutoff.add_argument("--azimuth_step", dest="azimuth_step", default=30.,
+                        type=check_positive_float,
+                        help="Azimuth angle spacing of the sky map (deg).")
+    cutoff.add_argument("--rigidity_lims", dest="rigidity_lims", nargs=2, default=[0.5, 30.],
+                        type=check_positive_float,
+                        help="Minimum and maximum rigidity of the scan (GV).")
+    cutoff.add_argument("--rigidity_step", dest="rigidity_step", default=0.1,
+                        type=check_positive_float,
+                        help="Rigidity spacing of the scan (GV).")
+    cutoff.add_argument("--max_steps", dest="max_steps", default=100000, type=check_positive_int,
+                        help="Step budget after which a trajectory is considered forbidden.")
 
     # Use of a config file for all options 
     config_parse = p.add_mutually_exclusive_group()
-    config_parse.add_argument("-c", "--config", dest="config_file", default='crprop/config.yml', help="Path to yaml configuration file")
+    config_parse.add_argument("-c", "--config", dest="config_file", default='crprop/config.yml',
+                              help="Path to yaml configuration file")
+    p.add_argument("--sweep", dest="sweep_file",
+                   help=("YAML sweep file: a config file whose 'sweep' section lists "
+                         "configurations of particle_type, energy_lims, alpha, lat_lon_alt, "
+                         "eom_step and time_step, all run in one headless launch "
+                         "of -n particles each."))
 
     args = p.parse_args()
     args_dict = vars(args)
@@ -348,8 +411,35 @@ if __name__=="__main__":
             else:
                 args_dict[arg] = cfg["args"][arg]
 
+    # A sweep file extends a config file with the configurations to sweep
+    sweep_configs = None
+    if args.sweep_file:
+        # Options given on the command line, found by parsing it again
+        # without the defaults, win over those of the sweep file
+        unset = object()
+        given = p.parse_args(namespace=argparse.Namespace(**dict((k, unset) for k in args_dict)))
+        cli_args = set(k for (k, v) in vars(given).items() if v is not unset)
+
+        with open(args.sweep_file, 'r') as ymlfile:
+            cfg = yaml.safe_load(ymlfile)
+        for arg in cfg.get("args") or {}:
+            if arg not in args_dict:
+                raise ValueError(("'{}' specified in the sweep file "
+                                  "is an invalid argument!".format(arg)))
+            if arg not in cli_args:
+                args_dict[arg] = cfg["args"][arg]
+        base = dict((k, args_dict[k]) for k in SWEEP_KEYS)
+        sweep_configs = expand_sweep(cfg.get("sweep") or {}, base)
+        sweep_labels = [config_label(c, base) for c in sweep_configs]
+        if not args.headless or args.backend != "opencl" or args.cutoff_map:
+            p.error("--sweep requires an OpenCL --headless run")
+        if (args.refill or args.device_init or args.record_every or args.all_devices or args.sources
+                or args.composition or args.num_shards is not None or args.shard is not None):
+            p.error("--sweep supports none of --refill, --device_init, --record_every, "
+                    "--all_devices, --sources, --composition and --num_shards")
+
     # Get particle parameters
-    global particle_type, num_particles, Emin, Emax, log_Emax, Erange, run_options
+    global particle_type, num_particles, Emin, Emax, log_Emax, Erange, run_options, steps_per_frame
     cpu_device_flag = args.device
     particle_type = args.particle_type
     num_particles = args.num_particles
@@ -357,67 +447,320 @@ if __name__=="__main__":
     Emax = args.energy_lims[1]
     log_Emax = np.log10(Emax)
     Erange = np.log10(Emax)-np.log10(Emin)
+    if args.alpha is not None:
+        args.alpha = list(np.atleast_1d(args.alpha))
     eom_integrator = eom_dict[args.eom_step.lower()]
+    # The gridded field replaces the field model in every integrator
+    if args.field_grid and args.field and args.field != args.field_grid:
+        p.error("--field %s disagrees with --field_grid %s, which replaces it"%(
+                args.field, args.field_grid))
+    steps_per_frame = args.steps_per_frame
+    capture_writers = args.capture_writers
+    video_file = args.video
+    video_fps = args.video_fps
+    frame_prefix = os.path.join(args.frame_dir, 'particle')
+    igrf_days = igrf_epoch_days(args.igrf_epoch)
+
+    def get_program(queue, dev):
+        """ Compile the propagation program, with the
+            gridded field lookup if requested.
+        """
+        if args.field_grid:
+            return build_grid_program(queue, dev, model=args.field_grid, igrf_days=igrf_days,
+                                      shape=tuple(args.grid_shape), options=build_options)
+        return build_program(queue.context, dev, options=build_options), None
 
     lat = args.lat_lon_alt[0]
     lon = args.lat_lon_alt[1]
     alt = args.lat_lon_alt[2]
 
-    run_options = np.array([time_step, log_Emax, Erange, eom_integrator], dtype=np.float32)
+    sources = load_sources(args.sources) if args.sources else None
+    source_ids = []
+
+    # Power law spectra and compositions are sampled by particle index,
+    # while evenly log-spaced energies are kept without either
+    components = None
+    if args.alpha is not None or args.composition:
+        components = spectrum_components(Emin, Emax, alpha=args.alpha, breaks=args.energy_breaks,
+                                         composition=args.composition, particle_type=particle_type)
+    species_ids = []
+
+    # Species properties, printed once for the whole run
+    for species in ([c['species'] for c in components] if components else [particle_type]):
+        props = get_particle_props(species)
+        print('{} properties: \n\t masseV {} \n\t masskg {} \n\t charge in C {}\n\n'.format(
+              species, props['masseV'], props['masskg'], props['charge']))
+
+    # Separate streams for the energies and the starting positions and directions
+    seed_sequence = np.random.SeedSequence(args.seed)
+    # Shard runs, even of a single shard, write what batch.py merge needs
+    shard_run = (args.num_shards is not None or args.shard is not None)
+    if args.num_shards is None:
+        args.num_shards = 1
+    if args.shard is None:
+        args.shard = 0
+    if shard_run:
+        if not args.headless or args.cutoff_map:
+            p.error("--num_shards applies to headless particle runs only")
+        if args.seed is None:
+            p.error("--num_shards requires a --seed shared by all shards")
+        if not 0 <= args.shard < args.num_shards:
+            p.error("--shard must be between 0 and %i"%(args.num_shards-1))
+        if num_particles < args.num_shards:
+            p.error("--num_shards must not exceed the number of particles")
+        # Each shard draws its own particles, from its child of the job seed,
+        # and evenly log-spaced energies from its slice of the job's grid
+        if args.alpha is None:
+            (Emin, Emax) = shard_energy_range(Emin, Emax, num_particles, args.num_shards,
+                                              args.shard)
+        num_particles = int(shard_counts(num_particles, args.num_shards)[args.shard])
+        seed_sequence = shard_seed(args.seed, args.shard)
+        print('Shard %i of %i: %i particles'%(args.shard, args.num_shards, num_particles))
+    print('Random seed: %i'%seed_sequence.entropy)
+    (energy_seed, position_seed, device_seed) = seed_sequence.spawn(3)
+    position_rng = np.random.default_rng(position_seed)
+
+    def new_particles(n):
+        """ Initial states of n particles, drawn from the injection
+            sources if given, else starting at lat_lon_alt.
+        """
+        if sources is None:
+            (position, velocity, zmel) = initial_buffers(particle_type, n, Emin, Emax,
+                                                         lat=lat, lon=lon, height=alt,
+                                                         seed=position_rng)
+        else:
+            (position, velocity, zmel, source_id) = injected_buffers(particle_type, n, Emin, Emax,
+                                                                     sources, seed=position_rng)
+            # Particle ids are handed out in order, including to refills
+            source_ids.append(source_id)
+
+        if components is not None:
+            first = sum(s.size for s in species_ids)
+            (zmel, species_id) = spectrum_zmel(components, n, energy_seed, first=first)
+            species_ids.append(species_id)
+
+        return (position, velocity, zmel)
+
+    def write_states(position, velocity, zmel, lifecycle):
+        """ Write the final states of a headless run, with particle sources and species.
+        """
+        if source_ids:
+            tag_sources(lifecycle, np.concatenate(source_ids), sources)
+        if species_ids:
+            tag_species(lifecycle, np.concatenate(species_ids), components)
+        if shard_run:
+            # Shard outputs carry what batch.py merge needs
+            lifecycle.update(exit_histograms(lifecycle), shard=args.shard,
+                             num_shards=args.num_shards, shard_particles=num_particles)
+        write_particle_states(args.output, position, velocity, zmel, lifecycle)
+
+    if args.backend == "numpy":
+        if not args.headless or args.num_steps is None and args.sim_time is None:
+            p.error("--backend numpy requires --headless with --num_steps or --sim_time")
+
+        run_options = np.array([args.time_step, log_Emax, Erange, eom_integrator], dtype=np.float32)
+        (np_position, np_velocity, np_zmel) = new_particles(num_particles)
+        (position, velocity, zmel, lifecycle) = run_numpy(
+            np_position, np_velocity, np_zmel, run_options, num_steps=args.num_steps,
+            sim_time=args.sim_time, igrf_days=igrf_days, field_model=args.field)
+        write_states(position, velocity, zmel, lifecycle)
+        sys.exit()
+
+    import_opencl()
+
+    # OpenCL compiler options, specializing the kernels for this run
+    build_integrator = eom_integrator
+    if sweep_configs is not None:
+        # Sweeps over several integrators select them at runtime
+        integrators = set(eom_dict[c['eom_step'].lower()] for c in sweep_configs)
+        build_integrator = integrators.pop() if len(integrators) == 1 else None
+    build_options = kernel_build_options(eom_integrator=build_integrator, field_model=args.field,
+                                         precision=args.precision, igrf_eval=args.igrf_eval)
+
+    if args.cutoff_map:
+        dev, context = init_device(cpu_device=cpu_device_flag, gl_sharing=False)
+        queue = cl.CommandQueue(context)
+        (program, grid) = get_program(queue, dev)
+
+        zenith = np.arange(0., args.zenith_max+0.5*args.zenith_step, args.zenith_step)
+        azimuth = np.arange(0., 360., args.azimuth_step)
+        rigidity = np.arange(args.rigidity_lims[0], args.rigidity_lims[1]+0.5*args.rigidity_step,
+                             args.rigidity_step)
+        result = cutoff_rigidity_map(queue, program, lat, lon, alt_km=args.site_alt_km,
+                                     zenith=zenith, azimuth=azimuth, rigidity=rigidity,
+                                     particle_type=particle_type, time_step=args.time_step,
+                                     eom_integrator=eom_integrator, igrf_days=igrf_days,
+                                     field_grid=grid, max_steps=args.max_steps,
+                                     substeps=args.substeps)
+        write_cutoff_map(args.output, result)
+        sys.exit()
+
+    if args.headless:
+        if args.num_steps is None and args.sim_time is None:
+            p.error("--headless requires --num_steps or --sim_time")
+        if args.record_every and args.refill:
+            p.error("--record_every cannot be combined with --refill")
+
+        run_options = np.array([args.time_step, log_Emax, Erange, eom_integrator], dtype=np.float32)
+
+        if sweep_configs is not None:
+            # All configurations share the context, program and launches
+            dev, context = init_device(cpu_device=cpu_device_flag, gl_sharing=False)
+            queue = cl.CommandQueue(context)
+            (program, grid) = get_program(queue, dev)
+            (np_position, np_velocity, np_zmel, config_id, config_options) = sweep_buffers(
+                sweep_configs, num_particles, seed=position_seed)
+            print('Sweeping %i configurations of %i particles'%(len(sweep_configs), num_particles))
+            (position, velocity, zmel, lifecycle) = run_headless(
+                queue, program, np_position, np_velocity, np_zmel, run_options,
+                num_steps=args.num_steps, sim_time=args.sim_time, substeps=args.substeps,
+                igrf_days=igrf_days, field_grid=grid, sweep=(config_id, config_options))
+            tag_configs(lifecycle, config_id, sweep_labels)
+            write_states(position, velocity, zmel, lifecycle)
+            sys.exit()
+
+        if args.all_devices:
+            if args.refill or args.device_init or args.record_every:
+                p.error("--all_devices does not support --refill, --device_init or --record_every")
+            import_names('multidevice_utils')
+            devices = find_devices('cpu' if cpu_device_flag else 'all', fission=args.device_fission)
+            scheduler = DeviceScheduler(devices, get_program)
+            (np_position, np_velocity, np_zmel) = new_particles(num_particles)
+            (position, velocity, zmel, lifecycle) = scheduler.run(
+                np_position, np_velocity, np_zmel, run_options, num_steps=args.num_steps,
+                sim_time=args.sim_time, substeps=args.substeps, igrf_days=igrf_days)
+            write_states(position, velocity, zmel, lifecycle)
+            sys.exit()
+
+        # Plain OpenCL context, no OpenGL sharing
+        dev, context = init_device(cpu_device=cpu_device_flag, gl_sharing=False)
+        queue = cl.CommandQueue(context)
+        (program, grid) = get_program(queue, dev)
+
+        # Initialize the necessary particle information
+        initializer = None
+        if args.device_init:
+            if sources is not None:
+                p.error("--device_init supports a single site only")
+            try:
+                initializer = DeviceInitializer(program, num_particles, particle_type, Emin, Emax,
+                                                lat, lon, alt, seed=device_seed,
+                                                components=components)
+            except ValueError as e:
+                p.error("--device_init: %s"%e)
+            (np_position, np_velocity, np_zmel) = (None, None, None)
+        else:
+            (np_position, np_velocity, np_zmel) = new_particles(num_particles)
+
+        recorder = None
+        if args.record_every:
+            recorder = TrajectoryRecorder(queue, num_particles, args.record_dir,
+                                          record_every=args.record_every,
+                                          chunk_samples=args.record_chunk)
+
+        refill = None
+        if args.refill:
+            refill = initializer or new_particles
+
+        (position, velocity, zmel, lifecycle) = run_headless(
+            queue, program, np_position, np_velocity, np_zmel, run_options,
+            num_steps=args.num_steps, sim_time=args.sim_time, substeps=args.substeps,
+            igrf_days=igrf_days, field_grid=grid, recorder=recorder, refill=refill,
+            initializer=initializer)
+        if initializer is not None and components is not None:
+            # Species of every particle id handed out, drawn on the device
+            last_id = max(lifecycle['particle_id'].max(), lifecycle['exit_id'].max(initial=-1))
+            species_ids.append(initializer.species_ids(np.arange(last_id+1)))
+        write_states(position, velocity, zmel, lifecycle)
+        sys.exit()
+
+    if args.render_frames:
+        if eom_integrator == eom_dict['adaboris']:
+            p.error("--render_frames needs a fixed step --eom_step, not adaboris")
+        # Headless OpenGL, selected before OpenGL is first imported
+        os.environ['PYOPENGL_PLATFORM'] = args.gl_platform
+        for module_name in ('offscreen_utils', 'render_utils', 'capture_utils'):
+            import_names(module_name)
+
+        gl_context = OffscreenContext(*args.render_size)
+        texture = load_texture_image(texture_file) if drawTexturedEarth else None
+        if video_file:
+            capture = FrameCapture(frame_prefix, num_writers=1, read_buffer=gl_context.read_buffer,
+                                   write_frame=VideoWriter(video_file, fps=video_fps))
+        else:
+            capture = FrameCapture(frame_prefix, num_writers=capture_writers,
+                                   read_buffer=gl_context.read_buffer)
+
+        # Plain OpenCL context, particles are copied to OpenGL every frame
+        dev, context = init_device(cpu_device=cpu_device_flag, gl_sharing=False)
+        queue = cl.CommandQueue(context)
+        (program, grid) = get_program(queue, dev)
+        cl_igrf_coeffs = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR,
+                                   hostbuf=igrf_coefficients(igrf_days))
+
+        (np_position, np_velocity, np_zmel) = new_particles(num_particles)
+        run_options = np.array([args.time_step, log_Emax, Erange, eom_integrator], dtype=np.float32)
+        frame_time = args.frame_time or args.time_step*steps_per_frame
+        render_offscreen(queue, program, gl_context, capture, np_position, np_velocity, np_zmel,
+                         run_options, args.render_frames, frame_time,
+                         cl_igrf_coeffs, field_grid_buffer(context, grid), texture=texture,
+                         camera_rotation=args.camera_rotation)
+        gl_context.close()
+        sys.exit()
+
+    import_viewer()
+
+    run_options = np.array([args.time_step, log_Emax, Erange, eom_integrator], dtype=np.float32)
 
     # Start a new OpenGL window
     window = glut_window()
 
-    # Preload texture once
-    texture = load_texture(texture_file)
+    # Earth meshes, particle shader and info message, built once
+    earth = EarthMesh(load_texture_image(texture_file))
+    sphere = EarthMesh(stacks=32, slices=32)
+    particles = ParticleRenderer()
+    overlay = TextOverlay([line for line in info_message.splitlines() if line.strip()])
 
     # Initialize the necessary particle information
-    (np_position, np_velocity, np_zmel) = initial_buffers(particle_type, num_particles, Emin, Emax, alpha=args.alpha,
-                                                          lat=lat, lon=lon, height=alt)
+    (np_position, np_velocity, np_zmel) = new_particles(num_particles)
 
-    # Arrays for OpenGL bindings
-    gl_position = vbo.VBO(data=np_position, usage=GL_DYNAMIC_DRAW, target=GL_ARRAY_BUFFER)
-    gl_position.bind()
-    np_color = np.ndarray((num_particles, 4), dtype=np.float32)
-    gl_color = vbo.VBO(data=np_color, usage=GL_DYNAMIC_DRAW, target=GL_ARRAY_BUFFER)
-    gl_color.bind()
+    # Two pairs of position and color buffers for OpenGL, filled in turn
+    # by the simulation while the renderer draws the other pair
+    gl_position_ids = [int(b) for b in glGenBuffers(2)]
+    gl_color_ids = [int(b) for b in glGenBuffers(2)]
+    for buffer_id in gl_position_ids + gl_color_ids:
+        glBindBuffer(GL_ARRAY_BUFFER, buffer_id)
+        glBufferData(GL_ARRAY_BUFFER, np_position.nbytes, np_position, GL_DYNAMIC_DRAW)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
 
     # Define pyopencl context and queue based on available hardware
     #platform = cl.get_platforms()[0]
     #dev = platform.get_devices(device_type=cl.device_type.GPU)
-    #context = cl.Context(properties=[(cl.context_properties.PLATFORM, platform)] + get_gl_sharing_context_properties())
+    #context = cl.Context(properties=[(cl.context_properties.PLATFORM, platform)]
+    #                     + get_gl_sharing_context_properties())
     dev, context = init_device(cpu_device=cpu_device_flag)
     queue = cl.CommandQueue(context)
 
+    cl_position = cl.Buffer(context, mf.COPY_HOST_PTR, hostbuf=np_position)
     cl_velocity = cl.Buffer(context, mf.COPY_HOST_PTR, hostbuf=np_velocity)
     cl_zmel = cl.Buffer(context, mf.COPY_HOST_PTR, hostbuf=np_zmel)
-    cl_start_position = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np_position)
-    cl_start_velocity = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np_velocity)
-
-    # Buffer object depends on version of PyOpenCL
-    if hasattr(gl_position, 'buffers'):
-        cl_gl_position = cl.GLBuffer(context, mf.READ_WRITE, int(gl_position.buffers[0]))
-        cl_gl_color = cl.GLBuffer(context, mf.READ_WRITE, int(gl_color.buffers[0]))
-    elif hasattr(gl_position, 'buffer'):
-        cl_gl_position = cl.GLBuffer(context, mf.READ_WRITE, int(gl_position.buffer))
-        cl_gl_color = cl.GLBuffer(context, mf.READ_WRITE, int(gl_color.buffer))
-    else:
-        print("Can not find a proper buffer object in pyopencl install. Exiting...")
-        sys.exit()
+    cl_gl_positions = [cl.GLBuffer(context, mf.READ_WRITE, b) for b in gl_position_ids]
+    cl_gl_colors = [cl.GLBuffer(context, mf.READ_WRITE, b) for b in gl_color_ids]
 
-    # Get OpenCL code and compile the program
-    cl_src_code = os.path.join(CL_SRC_PATH, 'run_prop.cl')
-    f = open(cl_src_code, 'r')
-    fstr = "".join(f.readlines())
-    program = cl.Program(context, fstr)
+    # IGRF coefficients are the same for all particles, computed once here
+    cl_igrf_coeffs = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR,
+                               hostbuf=igrf_coefficients(igrf_days))
 
-    opts_string = "-I %s"%CL_SRC_PATH
-    try:
-        program.build(options=opts_string, cache_dir=None)
-    except:
-        print('Build log:')
-        print(program.get_build_info(dev[0], cl.program_build_info.LOG))
-        raise
+    # Get OpenCL code and compile the program
+    (program, grid) = get_program(queue, dev)
+    cl_field_grid = field_grid_buffer(context, grid)
+
+    # Propagate on a separate queue and thread at sim_rate simulated
+    # seconds per second, starting paused
+    simulation = SimulationThread(context, program, cl_position, cl_velocity, cl_zmel,
+                                  cl_gl_positions, cl_gl_colors, cl_igrf_coeffs, cl_field_grid,
+                                  run_options, num_particles, sim_rate=args.sim_rate,
+                                  max_steps=args.substeps)
 
     # Run the simulation
     glutMainLoop()
@@ -0,0 +1,184 @@
+from __future__ import absolute_import
+
+try:
+    import time
+    import threading
+    import numpy as np
+    import pyopencl as cl # OpenCL - GPU computing interface
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+
+class SimulationThread(object):
+    """
+    Free-running propagation for the viewer, decoupled from rendering.
+
+    A background thread advances the particles on its own command queue,
+    and fills two pairs of OpenGL-shared position and color buffers in
+    turn. The renderer draws the most recently completed pair, between
+    ``acquire`` and ``release``, while the other pair is being filled, so
+    that drawing never waits for the kernel and the kernel never waits
+    for a frame. Simulated time follows wall-clock time at ``sim_rate``
+    simulated seconds per second, in steps of ``run_options[0]`` and at
+    most ``max_steps`` steps per filled pair. When the device cannot keep
+    up, the simulation runs at full throughput and falls behind the clock.
+
+    Parameters
+    ----------
+    context       : pyopencl.Context
+                    context with OpenGL sharing
+    program       : pyopencl.Program
+                    compiled ``run_prop.cl`` program
+    cl_position   : pyopencl.Buffer
+                    Nx4 positions, the state the kernel advances
+    cl_velocity   : pyopencl.Buffer
+                    Nx4 velocities
+    cl_zmel       : pyopencl.Buffer
+                    Nx4 charge, mass, energy, gamma
+    gl_positions  : list
+                    two ``pyopencl.GLBuffer`` of Nx4 positions to draw,
+                    or plain buffers copied to OpenGL by the renderer
+    gl_colors     : list
+                    two ``pyopencl.GLBuffer`` of Nx4 colors to draw,
+                    or plain buffers
+    igrf_coeffs   : pyopencl.Buffer
+                    IGRF coefficients
+    field_grid    : pyopencl.Buffer
+                    gridded field, see ``field_grid_buffer``
+    run_options   : array_like
+                    time step, log10(Emax), log10 energy range and integrator
+    num_particles : int
+                    number of particles
+    sim_rate      : float, optional
+                    simulated seconds per second
+    max_steps     : int, optional
+                    integration steps per filled pair at most
+    paused        : bool, optional
+                    start paused
+    """
+    def __init__(self, context, program, cl_position, cl_velocity, cl_zmel, gl_positions, gl_colors,
+                 igrf_coeffs, field_grid, run_options, num_particles, sim_rate=0.05, max_steps=10,
+                 paused=True):
+        self.queue = cl.CommandQueue(context)
+        self.kernel = cl.Kernel(program, 'particle_prop_multistep')
+        self.cl_position = cl_position
+        self.kernel_args = (cl_velocity, cl_zmel, igrf_coeffs, field_grid,
+                            np.array(run_options, dtype=np.float32))
+        self.gl_positions = gl_positions
+        self.gl_colors = gl_colors
+        self.gl_shared = hasattr(cl, 'GLBuffer') and isinstance(gl_positions[0], cl.GLBuffer)
+        self.num_particles = num_particles
+        self.time_step = float(run_options[0])
+        self.max_steps = max_steps
+        self.sim_rate = sim_rate
+        self.paused = paused
+        self.sim_time = 0.
+
+        # Buffer pair last completed, and the one being drawn
+        self.latest = 0
+        self.drawing = None
+        self._cond = threading.Condition()
+        self._running = True
+        self._error = None
+        self._clock = (time.time(), 0.)
+
+        # Colors of the starting positions
+        self._fill(0, 0)
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def acquire(self):
+        """
+        Index of the most recently completed buffer pair, which
+        is not refilled until ``release``.
+        """
+        with self._cond:
+            if self._error is not None:
+                raise self._error
+            self.drawing = self.latest
+            return self.drawing
+
+    def release(self):
+        """
+        Hand back the buffer pair once OpenGL is done reading it (glFinish).
+        """
+        with self._cond:
+            self.drawing = None
+            self._cond.notify_all()
+
+    def set_rate(self, sim_rate):
+        """
+        Change the simulated seconds per second, from now on.
+        """
+        with self._cond:
+            self._clock = (time.time(), self.sim_time)
+            self.sim_rate = sim_rate
+            self._cond.notify_all()
+
+    def toggle_pause(self):
+        """
+        Pause or resume the simulation.
+        """
+        with self._cond:
+            self.paused = not self.paused
+            self._clock = (time.time(), self.sim_time)
+            self._cond.notify_all()
+
+    def stop(self):
+        """
+        Stop the simulation thread.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _steps_due(self):
+        # Whole steps between the simulated time and the clock
+        if self.paused or self.sim_rate <= 0.:
+            return 0, None
+        (wall0, sim0) = self._clock
+        target = sim0 + (time.time() - wall0)*self.sim_rate
+        steps = int((target - self.sim_time)/self.time_step)
+        wait = (self.sim_time + self.time_step - target)/self.sim_rate
+        if steps > self.max_steps:
+            # Behind the clock, drop the backlog rather than catch up later
+            self._clock = (time.time(), self.sim_time + self.max_steps*self.time_step)
+            steps = self.max_steps
+        return steps, wait
+
+    def _fill(self, index, steps):
+        gl_objects = [self.gl_positions[index], self.gl_colors[index]]
+        if self.gl_shared:
+            cl.enqueue_acquire_gl_objects(self.queue, gl_objects)
+        self.kernel(self.queue, (self.num_particles,), None, self.cl_position,
+                    self.gl_colors[index], *(self.kernel_args + (np.int32(steps),)))
+        cl.enqueue_copy(self.queue, self.gl_positions[index], self.cl_position)
+        if self.gl_shared:
+            cl.enqueue_release_gl_objects(self.queue, gl_objects)
+        # Only this thread waits for the device
+        self.queue.finish()
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    (steps, wait) = self._steps_due()
+                    back = 1 - self.latest
+                    while self._running and (steps == 0 or self.drawing == back):
+                        self._cond.wait(wait if steps == 0 else None)
+                        (steps, wait) = self._steps_due()
+                    if not self._running:
+                        break
+
+                self._fill(back, steps)
+
+                with self._cond:
+                    self.sim_time += steps*self.time_step
+                    self.latest = back
+        except Exception as e:
+            self._error = e
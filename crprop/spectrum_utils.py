@@ -0,0 +1,316 @@
+from __future__ import absolute_import
+
+try:
+    import os
+    import sys
+    import json
+    import numpy as np
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+# Particles drawn from each random stream of a seeded spectrum. Particle k
+# always gets the same energy for a given seed, however the run is split.
+ENERGY_CHUNK = 2**20
+
+
+def power_law_quantile(u, Emin, Emax, alpha):
+    """
+    Inverse cumulative distribution of a E^-alpha power law.
+
+    Exact for any spectral index, including alpha = 1 (uniform in log E).
+    All arguments broadcast against each other.
+
+    Parameters
+    ----------
+    u     : array_like
+            uniform deviates in [0, 1)
+    Emin  : array_like
+            lower energy bounds
+    Emax  : array_like
+            upper energy bounds
+    alpha : array_like
+            spectral indices
+
+    Returns
+    -------
+    energy : array_like
+             energies, distributed as E^-alpha between Emin and Emax
+    """
+    u = np.asarray(u, dtype=np.float64)
+    Emin = np.asarray(Emin, dtype=np.float64)
+    log_ratio = np.log(np.asarray(Emax, dtype=np.float64)/Emin)
+    g = 1. - np.asarray(alpha, dtype=np.float64)
+
+    # ln(E/Emin) = ln(1 + u*((Emax/Emin)^g - 1))/g, tending to u*ln(Emax/Emin) as g -> 0
+    flat = (np.abs(g*log_ratio) < 1e-8)
+    g = np.where(flat, 1., g)
+    log_E = np.where(flat, u*log_ratio, np.log1p(u*np.expm1(g*log_ratio))/g)
+
+    return Emin*np.exp(log_E)
+
+
+def broken_power_law_weights(edges, alpha):
+    """
+    Fraction of the particles of a continuous broken power law in each segment.
+
+    Parameters
+    ----------
+    edges : array_like
+            increasing segment edges in eV, from Emin to Emax
+    alpha : array_like
+            spectral index of each segment
+
+    Returns
+    -------
+    weights : array_like
+              normalized weight of each segment
+    """
+    edges = np.asarray(edges, dtype=np.float64)
+    alpha = np.asarray(alpha, dtype=np.float64)
+    if edges.size != alpha.size + 1 or np.any(np.diff(edges) <= 0):
+        raise ValueError("A broken power law needs increasing edges and one index per segment.")
+
+    # ln of the flux at the lower edge of each segment, continuous across the breaks
+    log_ratio = np.log(edges[1:]/edges[:-1])
+    log_f = np.concatenate(([0.], np.cumsum(-alpha*log_ratio)[:-1]))
+    g = 1. - alpha
+    flat = (np.abs(g*log_ratio) < 1e-8)
+    shape = np.where(flat, log_ratio, np.expm1(g*log_ratio)/np.where(flat, 1., g))
+    log_w = log_f + np.log(edges[:-1]) + np.log(shape)
+
+    weights = np.exp(log_w - log_w.max())
+    return weights/weights.sum()
+
+
+def broken_power_law_quantile(u, edges, alpha):
+    """
+    Inverse cumulative distribution of a continuous broken power law.
+
+    Parameters
+    ----------
+    u     : array_like
+            uniform deviates in [0, 1)
+    edges : array_like
+            increasing segment edges in eV, from Emin to Emax
+    alpha : array_like
+            spectral index of each segment
+
+    Returns
+    -------
+    energy : array_like
+             energies in eV
+    """
+    edges = np.asarray(edges, dtype=np.float64)
+    alpha = np.asarray(alpha, dtype=np.float64)
+    cum = np.cumsum(broken_power_law_weights(edges, alpha))
+    cum[-1] = 1.
+
+    u = np.asarray(u, dtype=np.float64)
+    segment = np.minimum(np.searchsorted(cum, u, side='right'), alpha.size-1)
+    lower = np.concatenate(([0.], cum[:-1]))[segment]
+    # Deviate within the segment
+    u = np.clip((u - lower)/(cum[segment] - lower), 0., 1.)
+
+    return power_law_quantile(u, edges[segment], edges[segment+1], alpha[segment])
+
+
+def spectrum_components(Emin, Emax, alpha=None, breaks=None, composition=None,
+                        particle_type='proton'):
+    """
+    Species, fractions and broken power laws of an energy spectrum.
+
+    Parameters
+    ----------
+    Emin          : float
+                    minimum particle energy in eV
+    Emax          : float
+                    maximum particle energy in eV
+    alpha         : float or list, optional
+                    spectral index, or one index per segment between the breaks;
+                    uniform in log E by default
+    breaks        : list, optional
+                    energies (eV) of the spectral breaks
+    composition   : dict or str, optional
+                    mapping of species names to dicts holding their ``fraction``
+                    of the particles and optionally their own ``alpha`` and
+                    ``breaks``, a YAML/JSON file holding it, or inline fractions
+                    such as ``'proton:0.9,helium:0.1'``; a single
+                    ``particle_type`` by default
+    particle_type : str, optional
+                    particle species without a composition
+
+    Returns
+    -------
+    components : list
+                 dicts of ``species``, ``fraction``, segment ``edges`` (eV)
+                 and segment indices ``alpha``
+    """
+    if composition is None:
+        composition = {particle_type: {'fraction': 1.}}
+    elif isinstance(composition, str) and not os.path.exists(composition) and ':' in composition:
+        items = (item.split(':') for item in composition.split(','))
+        composition = dict((species.strip(), {'fraction': float(fraction)})
+                           for (species, fraction) in items)
+    elif isinstance(composition, str):
+        with open(composition) as handle:
+            if os.path.splitext(composition)[1] == '.json':
+                composition = json.load(handle)
+            else:
+                import yaml
+                composition = yaml.safe_load(handle)
+
+    # particle_utils imports this module, so import it on use
+    from particle_utils import get_particle_props
+
+    components = []
+    for species in sorted(composition):
+        # Unknown species fail here rather than mid-run
+        get_particle_props(species)
+        spec = composition[species]
+        species_alpha = spec.get('alpha', alpha)
+        species_breaks = spec.get('breaks', breaks)
+        species_breaks = [] if species_breaks is None else list(np.atleast_1d(species_breaks))
+        edges = np.array([Emin] + species_breaks + [Emax], dtype=np.float64)
+        species_alpha = np.atleast_1d(1. if species_alpha is None else species_alpha)
+        species_alpha = species_alpha.astype(np.float64)
+        if species_alpha.size == 1:
+            species_alpha = np.repeat(species_alpha, edges.size-1)
+        broken_power_law_weights(edges, species_alpha)
+        components.append({'species': species, 'fraction': float(spec['fraction']),
+                           'edges': edges, 'alpha': species_alpha})
+
+    fractions = np.array([c['fraction'] for c in components])
+    if np.any(fractions < 0) or fractions.sum() <= 0:
+        raise ValueError("Species fractions must be positive.")
+    for c in components:
+        c['fraction'] /= fractions.sum()
+
+    return components
+
+
+def sample_spectrum(components, num_particles, seed, first=0, chunk_size=ENERGY_CHUNK):
+    """
+    Draw species and energies from a spectrum, one chunk at a time.
+
+    The particles are split into fixed chunks of ``chunk_size``, chunk k
+    drawing from its own random stream spawned from ``seed``. Any range of
+    particles is thus reproducible on its own: workers given disjoint ranges
+    together draw exactly the particles of a single run, and only one chunk
+    is held in memory at a time.
+
+    Parameters
+    ----------
+    components    : list
+                    spectrum from ``spectrum_components``
+    num_particles : int
+                    number of particles to draw
+    seed          : int or numpy.random.SeedSequence
+                    seed of the run
+    first         : int, optional
+                    index of the first particle to draw
+    chunk_size    : int, optional
+                    particles per random stream
+
+    Yields
+    ------
+    species_id : array_like
+                 index in ``components`` of each particle of the chunk
+    energy     : array_like
+                 kinetic energy (eV) of each particle of the chunk
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    cum = np.cumsum([c['fraction'] for c in components])
+    cum[-1] = 1.
+
+    start = first
+    stop = first + num_particles
+    while start < stop:
+        chunk = start//chunk_size
+        stream = np.random.PCG64(np.random.SeedSequence(seed.entropy,
+                                                        spawn_key=seed.spawn_key + (chunk,)))
+        offset = start - chunk*chunk_size
+        size = min(stop - start, chunk_size - offset)
+        # Each particle takes two doubles, one 64 bit draw each, from its chunk's stream
+        stream.advance(2*offset)
+        u = np.random.Generator(stream).random((size, 2)).T
+
+        species_id = np.searchsorted(cum, u[0], side='right').astype(np.int32)
+        species_id = np.minimum(species_id, len(components)-1)
+        energy = np.empty(size, dtype=np.float64)
+        for (i, c) in enumerate(components):
+            sel = (species_id == i)
+            energy[sel] = broken_power_law_quantile(u[1,sel], c['edges'], c['alpha'])
+
+        yield species_id, energy
+        start += size
+
+
+def spectrum_zmel(components, num_particles, seed, first=0, chunk_size=ENERGY_CHUNK):
+    """
+    Charge, mass, energy and gamma of particles drawn from a spectrum,
+    filled chunk by chunk so only the float32 output is held in full.
+
+    Parameters
+    ----------
+    components    : list
+                    spectrum from ``spectrum_components``
+    num_particles : int
+                    number of particles to draw
+    seed          : int or numpy.random.SeedSequence
+                    seed of the run
+    first         : int, optional
+                    index of the first particle to draw
+    chunk_size    : int, optional
+                    particles per random stream
+
+    Returns
+    -------
+    zmel       : array_like
+                 Nx4 float32 array of charge (C), mass (kg),
+                 kinetic energy (eV) and gamma
+    species_id : array_like
+                 index in ``components`` of each particle
+    """
+    from particle_utils import get_particle_props
+    props = [get_particle_props(c['species']) for c in components]
+    charge = np.array([p['charge'] for p in props])
+    masskg = np.array([p['masskg'] for p in props])
+    masseV = np.array([p['masseV'] for p in props])
+
+    zmel = np.empty((num_particles, 4), dtype=np.float32)
+    species_id = np.empty(num_particles, dtype=np.int32)
+    i = 0
+    for (species, energy) in sample_spectrum(components, num_particles, seed,
+                                             first=first, chunk_size=chunk_size):
+        n = energy.size
+        zmel[i:i+n,0] = charge[species]
+        zmel[i:i+n,1] = masskg[species]
+        zmel[i:i+n,2] = energy
+        zmel[i:i+n,3] = energy/masseV[species] + 1.
+        species_id[i:i+n] = species
+        i += n
+
+    return zmel, species_id
+
+
+def tag_species(lifecycle, species_id, components):
+    """
+    Add the species of every slot and of every dead particle to a lifecycle.
+
+    Parameters
+    ----------
+    lifecycle  : dict
+                 particle status and exit records from ``run_headless``,
+                 updated in place
+    species_id : array_like
+                 species index of every particle, indexed by particle id
+    components : list
+                 spectrum from ``spectrum_components``
+    """
+    species_id = np.asarray(species_id)
+    lifecycle['species'] = species_id[lifecycle['particle_id']]
+    lifecycle['exit_species'] = species_id[lifecycle['exit_id']]
+    lifecycle['species_name'] = np.array([c['species'] for c in components])
@@ -0,0 +1,174 @@
+from __future__ import absolute_import
+
+try:
+    import json
+    import itertools
+    import numpy as np
+    from definitions import *
+    from particle_utils import initial_buffers
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+# Options a sweep may vary, with their run.py argument names
+SWEEP_KEYS = ('particle_type', 'energy_lims', 'alpha', 'lat_lon_alt', 'eom_step', 'time_step')
+
+
+def expand_sweep(sweep, base):
+    """
+    Configurations of a parameter sweep.
+
+    Parameters
+    ----------
+    sweep : dict
+            ``grid``, a mapping of options to the list of values each takes,
+            swept as their outer product, and/or ``configs``, a list of
+            mappings of options, appended after the grid
+    base  : dict
+            values of all ``SWEEP_KEYS`` shared by every configuration
+
+    Returns
+    -------
+    configs : list
+              dicts of every option of ``SWEEP_KEYS``, one per configuration
+    """
+    grid = sweep.get('grid') or {}
+    listed = list(sweep.get('configs') or [])
+    for spec in [grid] + listed:
+        unknown = set(spec) - set(SWEEP_KEYS)
+        if unknown:
+            raise ValueError("Sweeps vary %s only, not %s."%(', '.join(SWEEP_KEYS),
+                                                             ', '.join(sorted(unknown))))
+
+    keys = [k for k in SWEEP_KEYS if k in grid]
+    points = [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+    if not grid:
+        points = []
+
+    configs = []
+    for point in points + listed:
+        config = dict((k, base[k]) for k in SWEEP_KEYS)
+        config.update(point)
+        configs.append(config)
+    if not configs:
+        raise ValueError("The sweep holds no configuration.")
+    return configs
+
+
+def config_label(config, base):
+    """
+    Short description of a configuration, by the options that differ from ``base``.
+    """
+    return json.dumps(dict((k, config[k]) for k in SWEEP_KEYS if config[k] != base[k]),
+                      sort_keys=True)
+
+
+def sweep_buffers(configs, num_particles, seed=None):
+    """
+    Starting particles of every configuration of a sweep, packed in one array.
+
+    Parameters
+    ----------
+    configs       : list
+                    configurations from ``expand_sweep``
+    num_particles : int
+                    number of particles of each configuration
+    seed          : int or numpy.random.SeedSequence, optional
+                    seed of the sweep, each configuration drawing from its own child
+
+    Returns
+    -------
+    position       : array_like
+                     Nx4 starting positions in Earth radii, by configuration
+    velocity       : array_like
+                     Nx4 starting directions
+    zmel           : array_like
+                     Nx4 charge, mass, energy, gamma
+    config_id      : array_like
+                     configuration index of every particle
+    config_options : array_like
+                     Cx4 time step and integrator index of each configuration
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+
+    buffers = []
+    for (config, config_seed) in zip(configs, seed.spawn(len(configs))):
+        alpha = config['alpha']
+        if alpha is not None:
+            alpha = np.atleast_1d(alpha)
+            if alpha.size > 1:
+                raise ValueError("Sweeps draw single power law spectra only.")
+            alpha = float(alpha[0])
+        (lat, lon, height) = config['lat_lon_alt']
+        (Emin, Emax) = (float(config['energy_lims'][0]), float(config['energy_lims'][1]))
+        buffers.append(initial_buffers(config['particle_type'], num_particles, Emin, Emax,
+                                       lat, lon, height, alpha=alpha, seed=config_seed))
+
+    (position, velocity, zmel) = [np.concatenate(b).astype(np.float32) for b in zip(*buffers)]
+    config_id = np.repeat(np.arange(len(configs), dtype=np.int32), num_particles)
+    config_options = np.zeros((len(configs), 4), dtype=np.float32)
+    for (i, config) in enumerate(configs):
+        config_options[i,0:2] = (config['time_step'], eom_dict[config['eom_step'].lower()])
+
+    return position, velocity, zmel, config_id, config_options
+
+
+def tag_configs(lifecycle, config_id, labels):
+    """
+    Add the configuration of every slot and of every dead particle to a lifecycle.
+
+    Parameters
+    ----------
+    lifecycle : dict
+                particle status and exit records from ``run_headless``,
+                updated in place
+    config_id : array_like
+                configuration index of every particle, indexed by particle id
+    labels    : list
+                description of each configuration, see ``config_label``
+    """
+    config_id = np.asarray(config_id)
+    lifecycle['config'] = config_id[lifecycle['particle_id']]
+    lifecycle['exit_config'] = config_id[lifecycle['exit_id']]
+    lifecycle['config_name'] = np.array(labels)
+
+
+def group_by_config(states):
+    """
+    Split the output of a sweep by configuration.
+
+    Parameters
+    ----------
+    states : dict or str
+             arrays of a sweep output tagged by ``tag_configs``,
+             or the ``.npz`` file holding them
+
+    Returns
+    -------
+    groups : list
+             one dict per configuration, in order, holding its ``config_name``,
+             its slots and its exit records
+    """
+    if isinstance(states, str):
+        with np.load(states) as data:
+            states = dict((key, data[key]) for key in data.files)
+
+    num_slots = states['config'].size
+    num_exits = states['exit_config'].size
+    groups = []
+    for (i, name) in enumerate(states['config_name']):
+        slots = (states['config'] == i)
+        exits = (states['exit_config'] == i)
+        group = {'config_name': str(name)}
+        for (key, value) in states.items():
+            if key in ('config', 'exit_config', 'config_name'):
+                continue
+            value = np.asarray(value)
+            if key.startswith('exit_') and value.ndim > 0 and value.shape[0] == num_exits:
+                group[key] = value[exits]
+            elif value.ndim > 0 and value.shape[0] == num_slots:
+                group[key] = value[slots]
+        groups.append(group)
+    return groups
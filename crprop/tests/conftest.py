@@ -0,0 +1,40 @@
+import pytest
+
+
+@pytest.fixture(scope='session')
+def cl_context():
+    """ OpenCL context on the first available device,
+        skipping the test when no OpenCL runtime exists.
+    """
+    cl = pytest.importorskip('pyopencl')
+    try:
+        platforms = cl.get_platforms()
+    except cl.Error:
+        platforms = []
+    if len(platforms) == 0:
+        pytest.skip('No OpenCL platform available')
+
+    from crprop.cl_utils import init_device
+    dev, context = init_device(gl_sharing=False)
+    return context
+
+
+@pytest.fixture(autouse=True)
+def cache_dirs(tmp_path, monkeypatch):
+    """ Keep the program binary and field grid caches
+        of every test in its temporary directory.
+    """
+    import importlib
+    import importlib.util
+    if importlib.util.find_spec('pyopencl') is None:
+        return
+    cache_dir = tmp_path / 'cache'
+    # Modules are loaded both from the package and as siblings of each other
+    for (name, attr, sub_dir) in (('cl_utils', 'PROGRAM_CACHE_DIR', 'kernels'),
+                                  ('field_grid_utils', 'FIELD_GRID_CACHE_DIR', 'field_grids')):
+        for module_name in (name, 'crprop.' + name):
+            try:
+                module = importlib.import_module(module_name)
+            except ImportError:
+                continue
+            monkeypatch.setattr(module, attr, str(cache_dir / sub_dir))
@@ -0,0 +1,79 @@
+import os
+import numpy as np
+
+from crprop.batch_utils import (shard_seed, shard_counts, shard_energy_range, exit_histograms,
+                                merge_shards, run_shards)
+
+
+def test_shard_seeds_and_counts():
+    children = np.random.SeedSequence(5).spawn(3)
+    assert all(np.array_equal(shard_seed(5, i).generate_state(4), children[i].generate_state(4))
+               for i in range(3))
+    assert list(shard_counts(10, 3)) == [4, 3, 3]
+    assert shard_counts(10**9, 7).sum() == 10**9
+    assert np.allclose(shard_energy_range(1., 1e3, 4, 2, 1), (100., 1e3))
+
+
+def fake_shard(filename, shard, num_particles, num_refills):
+    """ Shard output of num_particles slots, whose first
+        num_refills particles died and were refilled.
+    """
+    rng = np.random.default_rng(shard)
+    particle_id = np.arange(num_particles)
+    particle_id[:num_refills] += num_particles
+    exit_position = rng.normal(size=(num_refills, 3))
+    lifecycle = {'status': np.zeros(num_particles, dtype=np.int32), 'particle_id': particle_id,
+                 'exit_id': np.arange(num_refills),
+                 'exit_time': np.ones(num_refills, dtype=np.float32),
+                 'exit_position': exit_position, 'exit_direction': exit_position,
+                 'exit_reason': np.arange(num_refills) % 2 + 1}
+    lifecycle.update(exit_histograms(lifecycle), shard=shard, num_shards=3,
+                     shard_particles=num_particles)
+    np.savez(filename, position=np.full((num_particles, 4), shard, dtype=np.float32),
+             velocity=np.zeros((num_particles, 4)), zmel=np.zeros((num_particles, 4)), **lifecycle)
+    return lifecycle
+
+
+def test_merge_shards(tmpdir):
+    sizes = [(5, 2), (4, 0), (6, 3)]
+    filenames = [str(tmpdir.join('shard_%i.npz'%i)) for i in range(3)]
+    lifecycles = [fake_shard(f, i, n, r) for (i, (f, (n, r))) in enumerate(zip(filenames, sizes))]
+
+    output = str(tmpdir.join('merged.npz'))
+    merged = merge_shards(filenames[::-1], output=output, processes=2)
+    assert os.path.exists(output)
+    serial = merge_shards(filenames, processes=1)
+    assert np.array_equal(serial['particle_id'], merged['particle_id'])
+
+    # Slots in shard order, starting particles first, then the refills of all shards
+    assert np.array_equal(merged['position'][:,0], np.repeat([0, 1, 2], [5, 4, 6]))
+    assert np.array_equal(merged['particle_id'],
+                          [15, 16, 2, 3, 4, 5, 6, 7, 8, 17, 18, 19, 12, 13, 14])
+    assert np.array_equal(merged['exit_id'], [0, 1, 9, 10, 11])
+    assert np.array_equal(merged['exit_shard'], [0, 0, 2, 2, 2])
+    assert merged['earth_hist'].sum() == 3 and merged['escape_hist'].sum() == 2
+    assert np.array_equal(merged['earth_hist'], sum(l['earth_hist'] for l in lifecycles))
+    assert merged['earth_hist'].shape == (36, 72) and merged['hist_lat_edges'].size == 37
+
+
+def test_run_shards(tmpdir):
+    run_args = ['--headless', '--backend', 'numpy', '--num_steps', '5', '-n', '30', '--seed', '3']
+    shard_dir = str(tmpdir.join('shards'))
+    filenames = run_shards(run_args, 2, shard_dir, processes=2)
+    merged = merge_shards(filenames, processes=1)
+    assert merged['status'].size == 30 and list(merged['num_shards'].flat) == [2]
+    assert np.array_equal(merged['particle_id'], np.arange(30))
+
+    # Shards are reproducible from the job seed and their id alone
+    again = run_shards(run_args, 2, str(tmpdir.join('again')), processes=1)
+    for (a, b) in zip(filenames, again):
+        assert np.array_equal(np.load(a)['velocity'], np.load(b)['velocity'])
+    assert not np.array_equal(np.load(filenames[0])['velocity'], np.load(filenames[1])['velocity'])
+    # Together the shards hold the log-spaced energies of a single run
+    assert np.allclose(merged['zmel'][:,2], np.logspace(7, 8, 30), rtol=1e-5)
+
+    # A job of a single shard merges as well
+    single = run_shards(run_args, 1, str(tmpdir.join('single')), processes=1)
+    merged = merge_shards(single, processes=1)
+    assert np.array_equal(merged['particle_id'], np.arange(30))
+    assert np.allclose(merged['zmel'][:,2], np.logspace(7, 8, 30), rtol=1e-5)
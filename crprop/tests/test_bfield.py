@@ -0,0 +1,117 @@
+import os
+import numpy as np
+
+from crprop.definitions import CL_SRC_PATH
+from crprop.field_utils import igrf_coefficients
+
+
+igrf_test_src = """
+#include "particle_props.cl"
+
+__kernel void eval_igrf(__global float4 *pos,
+                        __global float4 *B_direct,
+                        __global float4 *B_recurrence,
+                        __constant float *igrf_coeffs)
+{
+    unsigned int gid = get_global_id(0);
+    struct field_struct field;
+    field.igrf_coeffs = igrf_coeffs;
+    B_direct[gid] = igrf(pos[gid], &field);
+    B_recurrence[gid] = igrf_recurrence(pos[gid], &field);
+}
+"""
+
+
+def test_igrf_recurrence_matches_direct(cl_context):
+    import pyopencl as cl
+    mf = cl.mem_flags
+
+    # Random positions between 1 and 10 Earth radii
+    rng = np.random.RandomState(0)
+    num_points = 4096
+    r = rng.uniform(1., 10., num_points)*6378137.
+    cos_theta = rng.uniform(-1., 1., num_points)
+    phi = rng.uniform(0., 2.*np.pi, num_points)
+    sin_theta = np.sqrt(1.-cos_theta**2)
+    pos = np.zeros((num_points, 4), dtype=np.float32)
+    pos[:,0] = r*sin_theta*np.cos(phi)
+    pos[:,1] = r*sin_theta*np.sin(phi)
+    pos[:,2] = r*cos_theta
+
+    queue = cl.CommandQueue(cl_context)
+    program = cl.Program(cl_context, igrf_test_src).build(options="-I %s"%CL_SRC_PATH)
+    cl_pos = cl.Buffer(cl_context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=pos)
+    cl_direct = cl.Buffer(cl_context, mf.WRITE_ONLY, pos.nbytes)
+    cl_recurrence = cl.Buffer(cl_context, mf.WRITE_ONLY, pos.nbytes)
+    cl_igrf_coeffs = cl.Buffer(cl_context, mf.READ_ONLY | mf.COPY_HOST_PTR,
+                               hostbuf=igrf_coefficients(0.))
+    program.eval_igrf(queue, (num_points,), None, cl_pos, cl_direct, cl_recurrence, cl_igrf_coeffs)
+
+    B_direct = np.empty_like(pos)
+    B_recurrence = np.empty_like(pos)
+    cl.enqueue_copy(queue, B_direct, cl_direct)
+    cl.enqueue_copy(queue, B_recurrence, cl_recurrence)
+
+    # Agreement to float tolerance relative to the field magnitude
+    diff = np.abs(B_recurrence[:,:3]-B_direct[:,:3]).max(axis=1)
+    assert np.all(diff <= 1e-5*B_direct[:,3])
+
+
+def test_field_grid_interpolation_error(cl_context):
+    import pyopencl as cl
+    from crprop.field_grid_utils import build_grid_program, field_grid_error
+
+    queue = cl.CommandQueue(cl_context)
+    program, grid = build_grid_program(queue, cl_context.devices, model='igrf',
+                                       shape=(32, 46, 90), use_cache=False)
+    assert grid.shape == (32*46*90, 4)
+
+    # The grid program also holds the analytic sample_field kernel
+    error = field_grid_error(queue, program, program, grid, model='igrf', num_points=10000)
+    assert error['mean'] < 5e-3
+    assert error['max'] < 5e-2
+
+
+def test_field_grid_cache(cl_context, tmp_path, monkeypatch):
+    import pyopencl as cl
+    from crprop import field_grid_utils
+    from crprop.cl_utils import build_program
+
+    monkeypatch.setattr(field_grid_utils, 'FIELD_GRID_CACHE_DIR', str(tmp_path))
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices, use_cache=False)
+    shape = (4, 5, 6)
+    grid = field_grid_utils.field_grid(queue, program, model='dipole', shape=shape)
+    cache_file = field_grid_utils.grid_cache_file('dipole', 0., shape)
+    assert os.listdir(str(tmp_path)) == [os.path.basename(cache_file)]
+    assert np.array_equal(np.load(cache_file), grid)
+
+    # A truncated cache file is resampled and replaced
+    with open(cache_file, 'wb') as handle:
+        handle.write(b'\x93NUMPY')
+    reloaded = field_grid_utils.field_grid(queue, program, model='dipole', shape=shape)
+    assert np.array_equal(reloaded, grid)
+    assert np.array_equal(np.load(cache_file), grid)
+
+
+def test_field_grid_error_cache(cl_context, tmp_path, monkeypatch):
+    import pyopencl as cl
+    from crprop import field_grid_utils
+
+    monkeypatch.setattr(field_grid_utils, 'FIELD_GRID_CACHE_DIR', str(tmp_path))
+    queue = cl.CommandQueue(cl_context)
+    shape = (4, 5, 6)
+    program, grid = field_grid_utils.build_grid_program(queue, cl_context.devices,
+                                                        model='dipole', shape=shape)
+    cache_file = field_grid_utils.grid_cache_file('dipole', 0., shape)
+    error = field_grid_utils.load_grid_error(field_grid_utils.grid_error_file(cache_file))
+    assert sorted(error) == ['max', 'mean', 'rms']
+
+    # A cached grid and error are reused without sampling the analytic field
+    def fail(*args, **kwargs):
+        raise AssertionError('cached grid was resampled')
+    monkeypatch.setattr(field_grid_utils, 'sample_field', fail)
+    monkeypatch.setattr(field_grid_utils, 'field_grid_error', fail)
+    program, reloaded = field_grid_utils.build_grid_program(queue, cl_context.devices,
+                                                            model='dipole', shape=shape)
+    assert np.array_equal(reloaded, grid)
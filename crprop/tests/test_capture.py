@@ -0,0 +1,124 @@
+import os
+import ctypes
+import pytest
+import numpy as np
+
+pytest.importorskip('PIL')
+os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+pytest.importorskip('OpenGL.GL')
+
+
+@pytest.fixture(scope='module')
+def gl_context():
+    """ Offscreen EGL context of 64x48 pixels, skipping
+        the test when EGL is not available.
+    """
+    try:
+        from OpenGL import EGL
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise RuntimeError
+        attribs = [EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT, EGL.EGL_RED_SIZE, 8,
+                   EGL.EGL_GREEN_SIZE, 8, EGL.EGL_BLUE_SIZE, 8, EGL.EGL_ALPHA_SIZE, 8,
+                   EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE]
+        config, num = EGL.EGLConfig(), EGL.EGLint()
+        EGL.eglChooseConfig(display, (EGL.EGLint*len(attribs))(*attribs), ctypes.pointer(config),
+                            1, ctypes.pointer(num))
+        if num.value == 0:
+            raise RuntimeError
+        size = (EGL.EGLint*5)(EGL.EGL_WIDTH, 64, EGL.EGL_HEIGHT, 48, EGL.EGL_NONE)
+        surface = EGL.eglCreatePbufferSurface(display, config, size)
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+        if not EGL.eglMakeCurrent(display, surface, surface, context):
+            raise RuntimeError
+    except Exception:
+        pytest.skip('No EGL display available')
+    yield
+    EGL.eglTerminate(display)
+
+
+def draw(shade, width, height):
+    """ Clear to a shade of red, with the top half green.
+    """
+    from OpenGL.GL import (glClearColor, glClear, glEnable, glDisable, glScissor,
+                           GL_COLOR_BUFFER_BIT, GL_SCISSOR_TEST)
+    glClearColor(shade/255., 0., 0., 1.)
+    glClear(GL_COLOR_BUFFER_BIT)
+    glEnable(GL_SCISSOR_TEST)
+    glScissor(0, height//2, width, height - height//2)
+    glClearColor(0., 1., 0., 1.)
+    glClear(GL_COLOR_BUFFER_BIT)
+    glDisable(GL_SCISSOR_TEST)
+
+
+def test_frame_capture(gl_context, tmpdir):
+    from PIL import Image
+    from crprop.capture_utils import FrameCapture
+
+    prefix = str(tmpdir.join('frames', 'particle'))
+    capture = FrameCapture(prefix, num_buffers=3, num_writers=2, max_pending=2)
+    sizes = [(64, 48)]*5 + [(32, 24)]*2
+    for (i, (width, height)) in enumerate(sizes):
+        draw(10*i, width, height)
+        capture.capture(width, height)
+    capture.close()
+
+    for (i, (width, height)) in enumerate(sizes):
+        im = np.asarray(Image.open('%s%05i.png'%(prefix, i)))
+        assert im.shape == (height, width, 4)
+        # First image row is the top of the frame
+        assert list(im[0,0]) == [0, 255, 0, 255]
+        assert list(im[-1,-1]) == [10*i, 0, 0, 255]
+
+
+def test_frame_capture_writer_error(gl_context, tmpdir):
+    from crprop.capture_utils import FrameCapture
+
+    def write_frame(number, data, width, height):
+        raise IOError('disk full')
+
+    capture = FrameCapture(str(tmpdir.join('particle')), num_buffers=2, write_frame=write_frame)
+    for i in range(3):
+        draw(0, 64, 48)
+        capture.capture(64, 48)
+    with pytest.raises(IOError):
+        capture.close()
+
+
+def frames(num, width, height):
+    return [bytes(bytearray([i])*(4*width*height)) for i in range(num)]
+
+
+def test_video_writer_raw_fallback(tmpdir, monkeypatch):
+    from crprop import capture_utils
+    monkeypatch.setattr(capture_utils, 'which', lambda name: None)
+
+    writer = capture_utils.VideoWriter(str(tmpdir.join('movie.mp4')), fps=30)
+    for (i, data) in enumerate(frames(3, 8, 6) + frames(2, 4, 2)):
+        writer(i, data, *((8, 6) if i < 3 else (4, 2)))
+    writer.close()
+
+    assert [o[1:] for o in writer.outputs] == [(8, 6), (4, 2)]
+    assert tmpdir.join('movie.rgba').read_binary() == b''.join(frames(3, 8, 6))
+    assert tmpdir.join('movie_01.rgba').read_binary() == b''.join(frames(2, 4, 2))
+    command = writer.command(8, 6, source='movie.rgba')
+    assert command[command.index('-s')+1] == '8x6' and command[-1].endswith('movie.mp4')
+
+
+def test_video_writer_pipes_to_ffmpeg(tmpdir):
+    import sys
+    from crprop.capture_utils import VideoWriter
+
+    # Stand-in for ffmpeg copying its standard input to the output file
+    ffmpeg = tmpdir.join('ffmpeg')
+    ffmpeg.write('#!%s\nimport sys, shutil\n'
+                 'shutil.copyfileobj(sys.stdin.buffer, open(sys.argv[-1], "wb"))\n'%sys.executable)
+    ffmpeg.chmod(0o755)
+
+    writer = VideoWriter(str(tmpdir.join('movie.mp4')), ffmpeg=str(ffmpeg))
+    for (i, data) in enumerate(frames(4, 8, 6)):
+        writer(i, data, 8, 6)
+    writer.close()
+    assert tmpdir.join('movie.mp4').read_binary() == b''.join(frames(4, 8, 6))
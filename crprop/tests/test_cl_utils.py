@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+cl_utils = pytest.importorskip('crprop.cl_utils')
+
+
+def test_kernel_source_include_tree():
+    (source, included) = cl_utils.kernel_source('run_prop.cl')
+    assert 'particle_prop_batch' in source
+    # Every included file contributes to the cache key
+    assert 'GetDipoleField' in included
+    assert 'PropStepBoris' in included
+    assert 'speed_of_light' in included
+
+
+def test_evict_program_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cl_utils, 'PROGRAM_CACHE_DIR', str(tmp_path))
+    for i in range(4):
+        path = tmp_path/('%i.bin'%i)
+        path.write_bytes(b'0'*100)
+        os.utime(str(path), (1000+i, 1000+i))
+
+    cl_utils.evict_program_cache(max_bytes=250)
+    assert sorted(os.listdir(str(tmp_path))) == ['2.bin', '3.bin']
+
+
+def test_build_program_cache(cl_context, tmp_path, monkeypatch):
+    monkeypatch.setattr(cl_utils, 'PROGRAM_CACHE_DIR', str(tmp_path))
+    devices = cl_context.devices
+
+    program = cl_utils.build_program(cl_context, devices, options='-D CACHE_TEST')
+    assert len(os.listdir(str(tmp_path))) == len(devices)
+
+    # Programs of the run are kept with their context
+    assert cl_utils.build_program(cl_context, devices, options='-D CACHE_TEST') is program
+
+    # Without them, the binaries are loaded from disk and marked as recently used
+    cl_utils.context_programs(cl_context).clear()
+    cache_files = [os.path.join(str(tmp_path), f) for f in os.listdir(str(tmp_path))]
+    for f in cache_files:
+        os.utime(f, (0, 0))
+    cached = cl_utils.build_program(cl_context, devices, options='-D CACHE_TEST')
+    assert cached is not program
+    assert cached.kernel_names == program.kernel_names
+    assert all(os.path.getmtime(f) > 0 for f in cache_files)
+    assert len(os.listdir(str(tmp_path))) == len(devices)
+
+    # Different options are a different program
+    cl_utils.build_program(cl_context, devices, options='-D CACHE_TEST -D IGRF_DIRECT')
+    assert len(os.listdir(str(tmp_path))) == 2*len(devices)
+
+
+def test_kernel_build_options():
+    assert cl_utils.kernel_build_options() == ''
+    options = cl_utils.kernel_build_options(eom_integrator=4, field_model='uniform',
+                                            precision='fast', igrf_eval='direct')
+    assert '-D EOM_INTEGRATOR=4' in options
+    assert '-D FIELD_MODEL=3' in options
+    assert '-D IGRF_DIRECT' in options
+    assert '-cl-fast-relaxed-math' in options
+
+
+def test_specialized_field_model(cl_context):
+    import numpy as np
+    import pyopencl as cl
+    from crprop.particle_utils import initial_buffers
+    from crprop.headless_utils import run_headless
+    from crprop.numpy_backend import run_numpy
+
+    queue = cl.CommandQueue(cl_context)
+    (position, velocity, zmel) = initial_buffers('proton', 32, 1e7, 1e9,
+                                                 lat=18.99, lon=-97.308, height=3)
+    run_options = np.array([0.0005, 9., 2., 3], dtype=np.float32)
+    for field_model in ('uniform', 'igrf'):
+        options = cl_utils.kernel_build_options(eom_integrator=3, field_model=field_model)
+        program = cl_utils.build_program(cl_context, cl_context.devices, options=options)
+        cl_state = run_headless(queue, program, position, velocity, zmel, run_options, num_steps=50)
+        np_state = run_numpy(position, velocity, zmel, run_options, num_steps=50,
+                             field_model=field_model)
+        assert np.abs(cl_state[0][:,0:3]-np_state[0][:,0:3]).max() < 1e-4
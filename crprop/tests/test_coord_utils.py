@@ -0,0 +1,54 @@
+import pytest
+import numpy as np
+
+from crprop.coord_utils import geodetic_to_geocentric, geocentric_to_geodetic
+from crprop.definitions import EARTH_RADIUS_M
+
+
+def random_geodetic(num, seed=0):
+    rng = np.random.default_rng(seed)
+    lat = np.degrees(np.arcsin(rng.uniform(-1., 1., num)))
+    lon = rng.uniform(-180., 180., num)
+    height = rng.uniform(-0.01, 10., num)
+    # Poles and the equator
+    lat[:3] = [90., -90., 0.]
+    return lat, lon, height
+
+
+def test_geodetic_round_trip():
+    lat, lon, height = random_geodetic(100000)
+    x, y, z = geodetic_to_geocentric(lat, lon, height)
+    lat2, lon2, height2 = geocentric_to_geodetic(x, y, z)
+    assert np.allclose(lat2, lat, rtol=0., atol=1e-9)
+    assert np.allclose(height2*EARTH_RADIUS_M, height*EARTH_RADIUS_M, rtol=0., atol=1e-6)
+    # Longitude is undefined at the poles
+    dlon = (lon2 - lon + 180.)%360. - 180.
+    assert np.allclose(dlon[2:], 0., atol=1e-9)
+
+
+def test_geodetic_against_astropy():
+    coords = pytest.importorskip('astropy.coordinates')
+    u = pytest.importorskip('astropy.units')
+
+    lat, lon, height = random_geodetic(1000, seed=1)
+    loc = coords.EarthLocation.from_geodetic(lat=lat*u.deg, lon=lon*u.deg,
+                                             height=height*EARTH_RADIUS_M*u.m,
+                                             ellipsoid='WGS84')
+    x, y, z = geodetic_to_geocentric(lat, lon, height)
+    for (ours, theirs) in zip((x, y, z), (loc.x, loc.y, loc.z)):
+        # Positions agree to a micrometre
+        assert np.allclose(ours*EARTH_RADIUS_M, theirs.to(u.m).value, rtol=0., atol=1e-6)
+
+    lat2, lon2, height2 = geocentric_to_geodetic(loc.x.to(u.m).value/EARTH_RADIUS_M,
+                                                 loc.y.to(u.m).value/EARTH_RADIUS_M,
+                                                 loc.z.to(u.m).value/EARTH_RADIUS_M)
+    geo = loc.to_geodetic('WGS84')
+    assert np.allclose(lat2, geo.lat.deg, rtol=0., atol=1e-8)
+    assert np.allclose(height2*EARTH_RADIUS_M, geo.height.to(u.m).value, rtol=0., atol=1e-6)
+
+
+def test_geodetic_surface_radius():
+    # Equatorial and polar radii of the WGS84 ellipsoid
+    assert np.allclose(geodetic_to_geocentric(0., 90., 0.), (0., 1., 0.))
+    x, y, z = geodetic_to_geocentric(90., 0., 0.)
+    assert np.isclose(z*EARTH_RADIUS_M, 6356752.314245, atol=1e-6)
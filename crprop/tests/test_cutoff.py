@@ -0,0 +1,44 @@
+import pytest
+import numpy as np
+
+pytest.importorskip('pyopencl')
+
+from crprop.cutoff_utils import (effective_cutoff, skip_converged, antiparticle_zmel,
+                                 TRAJ_RUNNING, TRAJ_ALLOWED, TRAJ_FORBIDDEN, TRAJ_SKIPPED)
+
+
+def test_effective_cutoff_penumbra():
+    rigidity = np.arange(1., 11.)
+    F, A = TRAJ_FORBIDDEN, TRAJ_ALLOWED
+    # Forbidden up to 3 GV, penumbra with 2 allowed bands, forbidden at 7 GV
+    status = np.array([F, F, F, A, F, A, F, A, A, A])
+    cutoff, upper, lower = effective_cutoff(rigidity, status)
+    assert upper == 7.
+    assert lower == 4.
+    assert cutoff == 5.
+
+
+def test_effective_cutoff_all_allowed_or_forbidden():
+    rigidity = np.arange(1., 4.)
+    cutoff, upper, lower = effective_cutoff(rigidity, np.full((2, 3), TRAJ_ALLOWED))
+    assert np.all(cutoff == 1.)
+    cutoff, upper, lower = effective_cutoff(rigidity, np.full(3, TRAJ_FORBIDDEN))
+    assert cutoff == 3.
+
+
+def test_skip_converged():
+    R, F, A = TRAJ_RUNNING, TRAJ_FORBIDDEN, TRAJ_ALLOWED
+    status = np.array([[R, R, R, F, F, A, A],
+                       [R, R, F, R, F, A, A]])
+    num_skipped = skip_converged(status, forbidden_run=2)
+    assert num_skipped == 3
+    assert np.all(status[0,:3] == TRAJ_SKIPPED)
+    # Not converged while a rigidity above the forbidden run is unfinished
+    assert np.all(status[1,:2] == TRAJ_RUNNING)
+
+
+def test_antiparticle_zmel():
+    zmel = antiparticle_zmel([1., 10.], 'proton')
+    assert np.all(zmel[:,0] < 0)
+    # 1 GV proton has a kinetic energy of ~433 MeV
+    assert np.isclose(zmel[0,2], 433.3e6, rtol=1e-3)
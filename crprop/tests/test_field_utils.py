@@ -0,0 +1,22 @@
+import numpy as np
+
+from crprop.field_utils import igrf_coefficients, igrf_epoch_days
+
+
+def test_igrf_coefficients_shape():
+    table = igrf_coefficients()
+    assert table.shape == (2, 13, 14)
+    assert table.dtype == np.float32
+
+
+def test_igrf_coefficients_secular_variation():
+    # g(n=1, m=0) = -29442 nT at the epoch, varying by 10.3 nT/yr
+    assert igrf_coefficients(0.)[0, 0, 0] == -29442.
+    assert np.isclose(igrf_coefficients(365.)[0, 0, 0], -29442.+10.3)
+    # Only m <= n terms are populated
+    assert np.all(igrf_coefficients()[:, 0, 2:] == 0)
+
+
+def test_igrf_epoch_days():
+    assert igrf_epoch_days(2015.) == 0.
+    assert igrf_epoch_days(2016.) == 365.
@@ -0,0 +1,123 @@
+import numpy as np
+
+from crprop.particle_utils import initial_buffers
+
+
+def test_run_headless_num_steps(cl_context):
+    import pyopencl as cl
+    from crprop.cl_utils import build_program
+    from crprop.headless_utils import run_headless
+
+    (position, velocity, zmel) = initial_buffers('proton', 64, 1e7, 1e8,
+                                                 lat=18.99, lon=-97.308, height=3)
+    run_options = np.array([0.0005, 8., 1., 3], dtype=np.float32)
+
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+    (position, velocity, zmel, lifecycle) = run_headless(queue, program, position, velocity, zmel,
+                                                         run_options, num_steps=10)
+
+    assert position.shape == (64, 4)
+    assert np.allclose(velocity[:,3], 10*0.0005, rtol=1e-4)
+    assert (lifecycle['status'] == 0).all()
+
+
+def test_run_headless_lifecycle(cl_context):
+    import pyopencl as cl
+    from crprop.cl_utils import build_program
+    from crprop.headless_utils import run_headless, LIFE_ALIVE, LIFE_ESCAPED
+
+    # Particles starting just inside 10 Earth radii, half of them heading out
+    num_particles = 64
+    position = np.zeros((num_particles, 4), dtype=np.float32)
+    position[:,0] = 9.99
+    position[:,3] = 1.
+    velocity = np.zeros((num_particles, 4), dtype=np.float32)
+    velocity[:,0] = np.where(np.arange(num_particles) % 2 == 0, 1., -1.)
+    zmel = np.tile(np.array([1.602176462e-19, 1.67262161e-27, 1e9, 2.0658], dtype=np.float32),
+                   (num_particles, 1))
+    run_options = np.array([0.0005, 9., 1., 3], dtype=np.float32)
+
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+    refill = lambda n: (position[:n], -np.abs(velocity[:n]), zmel[:n])
+    (position_out, velocity_out, _, lifecycle) = run_headless(
+        queue, program, position, velocity, zmel, run_options, num_steps=20, substeps=5,
+        check_interval=1, refill=refill)
+
+    escaped = (np.arange(num_particles) % 2 == 0)
+    assert (lifecycle['exit_reason'] == LIFE_ESCAPED).all()
+    assert np.array_equal(np.sort(lifecycle['exit_id']), np.flatnonzero(escaped))
+    assert (np.linalg.norm(lifecycle['exit_position'], axis=1) > 10.).all()
+    assert (lifecycle['status'] == LIFE_ALIVE).all()
+    assert lifecycle['particle_id'].max() == num_particles + escaped.sum() - 1
+    # Refills start at the clock of the live particles
+    assert np.allclose(velocity_out[:,3], 20*0.0005, rtol=1e-4)
+
+
+def test_run_headless_dead_particles_stop(cl_context):
+    import pyopencl as cl
+    from crprop.cl_utils import build_program
+    from crprop.headless_utils import run_headless, LIFE_ESCAPED
+
+    # Particles just inside 10 Earth radii heading out, dead after the first step
+    num_particles = 16
+    position = np.zeros((num_particles, 4), dtype=np.float32)
+    position[:,0] = 9.99
+    position[:,3] = 1.
+    velocity = np.zeros((num_particles, 4), dtype=np.float32)
+    velocity[:,0] = 1.
+    zmel = np.tile(np.array([1.602176462e-19, 1.67262161e-27, 1e9, 2.0658], dtype=np.float32),
+                   (num_particles, 1))
+    run_options = np.array([0.0005, 9., 1., 3], dtype=np.float32)
+
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+    # Compactions are left to the default check interval
+    (position_out, _, _, lifecycle) = run_headless(queue, program, position, velocity, zmel,
+                                                   run_options, num_steps=100, substeps=5)
+
+    assert (lifecycle['exit_reason'] == LIFE_ESCAPED).all()
+    assert np.allclose(lifecycle['exit_time'], 0.0005, rtol=1e-4)
+    radius = np.linalg.norm(lifecycle['exit_position'], axis=1)
+    assert (radius > 10.).all() and (radius < 10.1).all()
+    order = np.argsort(lifecycle['exit_id'])
+    assert np.allclose(position_out[:,0:3], lifecycle['exit_position'][order])
+
+
+def test_run_headless_sim_time(cl_context):
+    import pyopencl as cl
+    from crprop.cl_utils import build_program
+    from crprop.headless_utils import run_headless
+
+    (position, velocity, zmel) = initial_buffers('proton', 64, 1e7, 1e8,
+                                                 lat=18.99, lon=-97.308, height=3)
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+    # A whole and a fractional number of steps, with fixed and adaptive steps
+    for (sim_time, eom_integrator) in ((0.002, 3), (0.0021, 3), (0.002, 4)):
+        run_options = np.array([0.0005, 8., 1., eom_integrator], dtype=np.float32)
+        (_, velocity_out, _, lifecycle) = run_headless(queue, program, position, velocity, zmel,
+                                                       run_options, sim_time=sim_time)
+        assert (lifecycle['status'] == 0).all()
+        assert np.allclose(velocity_out[:,3], sim_time, rtol=1e-3)
+
+
+def test_run_headless_substeps_budget(cl_context):
+    import pyopencl as cl
+    from crprop.cl_utils import build_program
+    from crprop.headless_utils import run_headless
+
+    (position, velocity, zmel) = initial_buffers('proton', 16, 1e7, 1e8,
+                                                 lat=18.99, lon=-97.308, height=3)
+    run_options = np.array([0.0005, 8., 1., 3], dtype=np.float32)
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+
+    # Launches longer than the run take only the steps left
+    (_, velocity_out, _, _) = run_headless(queue, program, position, velocity, zmel,
+                                           run_options, num_steps=7, substeps=1000)
+    assert np.allclose(velocity_out[:,3], 7*0.0005, rtol=1e-4)
+    (_, velocity_out, _, _) = run_headless(queue, program, position, velocity, zmel,
+                                           run_options, sim_time=0.003, substeps=1000)
+    assert np.allclose(velocity_out[:,3], 0.003, rtol=1e-3)
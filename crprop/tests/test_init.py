@@ -40,3 +40,34 @@ def test_coord_utils_sph2cart_exists():
 
 def test_coord_utils_geodetic_to_geocentric_exists():
     assert hasattr(crprop, 'geodetic_to_geocentric')
+
+
+def test_field_utils_exists():
+    assert hasattr(crprop, 'field_utils')
+
+
+def test_field_utils_igrf_coefficients_exists():
+    assert hasattr(crprop, 'igrf_coefficients')
+
+
+def test_coord_utils_local_sky_direction_exists():
+    assert hasattr(crprop, 'local_sky_direction')
+
+
+def test_import_is_numpy_only():
+    import subprocess
+    import sys
+    code = ("import sys, crprop; "
+            "print(','.join(m for m in ('astropy', 'pyopencl', 'OpenGL', 'pygame', 'PIL') "
+            "if m in sys.modules))")
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert output.strip() == b''
+
+
+def test_load_trajectory_is_numpy_only():
+    assert hasattr(crprop, 'load_trajectory')
+
+
+def test_lazy_module_access():
+    assert hasattr(crprop, 'numpy_backend')
+    assert hasattr(crprop.numpy_backend, 'run_numpy')
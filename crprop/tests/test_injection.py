@@ -0,0 +1,91 @@
+import pytest
+import numpy as np
+
+from crprop.injection_utils import (load_sources, source_counts, inject_particles,
+                                    injected_buffers, tag_sources)
+from crprop.coord_utils import geodetic_to_geocentric, geocentric_to_geodetic
+
+
+sources = [{'name': 'site', 'lat': 18.99, 'lon': -97.308, 'alt': 0.01, 'zenith_max': 30.},
+           {'name': 'box', 'lat': [-40., -10.], 'lon': [170., -170.], 'alt': 0.5},
+           {'name': 'shell', 'alt': 3., 'weight': 2.},
+           {'name': 'beam', 'alt': 2., 'axis': [0., 0., -2.], 'half_angle': 5.}]
+
+
+def test_source_counts():
+    rng = np.random.default_rng(0)
+    assert list(source_counts(sources, 1000, rng)) == [200, 200, 400, 200]
+    counts = source_counts([{'weight': 1.}]*3, 10, rng)
+    assert counts.sum() == 10
+    assert sorted(counts) == [3, 3, 4]
+    # Single particle batches are spread over the sources
+    counts = sum(source_counts(sources, 1, rng) for i in range(5000))
+    assert np.allclose(counts/5000., [0.2, 0.2, 0.4, 0.2], atol=0.03)
+
+
+def test_inject_particles_positions():
+    position, direction, source_id = inject_particles(sources, 10000, seed=1)
+    assert position.shape == (10000, 4) and direction.shape == (10000, 4)
+    assert np.all(position[:,3] == 1.)
+    lat, lon, alt = geocentric_to_geodetic(*position[:,0:3].T.astype(np.float64))
+
+    site = (source_id == 0)
+    assert np.allclose(position[site,0:3], geodetic_to_geocentric(18.99, -97.308, 0.01), atol=1e-6)
+
+    box = (source_id == 1)
+    assert np.all((lat[box] > -40.-1e-4) & (lat[box] < -10.+1e-4))
+    # The box straddles the antimeridian
+    assert np.all(np.abs(lon[box]) > 170.-1e-4)
+    assert np.allclose(alt[box], 0.5, atol=1e-6)
+
+    shell = (source_id == 2)
+    assert np.allclose(alt[shell], 3., atol=1e-6)
+    # Uniform in area: half of the shell lies in the northern hemisphere
+    assert abs(np.mean(lat[shell] > 0.) - 0.5) < 0.05
+
+
+def test_inject_particles_directions():
+    position, direction, source_id = inject_particles(sources, 10000, seed=2)
+    assert np.allclose(np.sum(direction[:,0:3]**2, axis=1), 1., atol=1e-6)
+
+    # Site particles head down within 30 degrees of the local vertical
+    site = (source_id == 0)
+    up = position[site,0:3]/np.sqrt(np.sum(position[site,0:3]**2, axis=1))[:,np.newaxis]
+    cos_zenith = -np.sum(direction[site,0:3]*up, axis=1)
+    assert np.all(cos_zenith > np.cos(np.radians(30.5)))
+
+    beam = (source_id == 3)
+    assert np.all(-direction[beam,2] > np.cos(np.radians(5.)) - 1e-6)
+
+    # Isotropic directions average out
+    box = (source_id == 1)
+    assert np.all(np.abs(direction[box,0:3].mean(axis=0)) < 0.1)
+
+
+def test_inject_particles_seed():
+    first = inject_particles(sources, 100, seed=3)
+    second = inject_particles(sources, 100, seed=3)
+    for (a, b) in zip(first, second):
+        assert np.array_equal(a, b)
+
+
+def test_injected_buffers_and_tags():
+    position, velocity, zmel, source_id = injected_buffers('proton', 100, 1e7, 1e8, sources, seed=4)
+    assert zmel.shape == (100, 4)
+    assert np.all(zmel[:,2] >= 1e7)
+
+    lifecycle = {'particle_id': np.arange(100), 'exit_id': np.array([0, 99])}
+    tag_sources(lifecycle, source_id, sources)
+    assert np.array_equal(lifecycle['source'], source_id)
+    assert list(lifecycle['exit_source']) == [0, 3]
+    assert list(lifecycle['source_name']) == ['site', 'box', 'shell', 'beam']
+
+
+def test_load_sources(tmp_path):
+    filename = tmp_path/'sources.json'
+    filename.write_text('[{"lat": 0, "lon": 0, "alt": 1}]')
+    assert load_sources(str(filename)) == [{'lat': 0, 'lon': 0, 'alt': 1}]
+    with pytest.raises(ValueError):
+        load_sources([{'lat': 0., 'lon': 0.}])
+    with pytest.raises(ValueError):
+        load_sources([{'alt': 1., 'axis': [1., 0., 0.]}])
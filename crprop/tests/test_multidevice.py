@@ -0,0 +1,71 @@
+import pytest
+import numpy as np
+
+pytest.importorskip('pyopencl')
+
+from crprop.multidevice_utils import DeviceScheduler
+
+
+def test_multidevice_matches_single(cl_context):
+    import pyopencl as cl
+    from crprop.cl_utils import build_program
+    from crprop.headless_utils import run_headless
+    from crprop.particle_utils import initial_buffers
+
+    def build(queue, device):
+        return build_program(queue.context, device), None
+
+    # The same device twice stands in for two devices
+    device = cl_context.devices[0]
+    scheduler = DeviceScheduler([device, device], build, min_chunk=64)
+    # Particles starting low above the ground, so that some hit the Earth
+    (position, velocity, zmel) = initial_buffers('proton', 1000, 1e8, 1e10, 0., 0., 0.02, seed=2)
+    run_options = np.array([1e-4, 10., 2., 3], dtype=np.float32)
+    result = scheduler.run(position, velocity, zmel, run_options, num_steps=300, check_interval=5)
+
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+    expected = run_headless(queue, program, position, velocity, zmel, run_options,
+                            num_steps=300, check_interval=5)
+    for i in range(3):
+        assert np.array_equal(result[i], expected[i])
+    assert np.array_equal(result[3]['particle_id'], np.arange(1000))
+    assert np.array_equal(result[3]['status'], expected[3]['status'])
+    assert expected[3]['exit_id'].size > 0
+    order = np.argsort(result[3]['exit_id'])
+    assert np.array_equal(result[3]['exit_id'][order], np.sort(expected[3]['exit_id']))
+
+    # Both devices took part, and every particle was run once
+    assert np.all(scheduler.particles > 0) and scheduler.particles.sum() == 1000
+    assert np.array_equal(np.bincount(result[3]['device']), scheduler.particles)
+
+    with pytest.raises(ValueError):
+        scheduler.run(position, velocity, zmel, run_options, num_steps=10, refill=lambda n: None)
+
+
+def test_run_without_particles():
+    scheduler = DeviceScheduler([], None)
+    empty = np.zeros((0, 4), dtype=np.float32)
+    run_options = np.array([1e-4, 10., 2., 3], dtype=np.float32)
+    with pytest.raises(ValueError):
+        scheduler.run(empty, empty, empty, run_options, num_steps=10)
+
+
+def test_chunk_size():
+    scheduler = DeviceScheduler([], None, min_chunk=10)
+    scheduler.devices = [None]*3
+    scheduler.particles = np.array([0, 0, 0])
+    scheduler.busy_time = np.zeros(3)
+    # Calibration chunks first
+    assert scheduler.chunk_size(0, 1200) == 100
+    # Then shares of the measured throughput, halved
+    scheduler.particles[:] = [300, 100, 0]
+    scheduler.busy_time[:] = [1., 1., 0.]
+    assert scheduler.chunk_size(0, 1200) == 300
+    assert scheduler.chunk_size(1, 1200) == 100
+    # Unmeasured devices still calibrate, and count as average meanwhile
+    assert scheduler.chunk_size(2, 1200) == 100
+    scheduler.particles[2] = 600
+    scheduler.busy_time[2] = 1.
+    assert scheduler.chunk_size(0, 1200) == 180
+    assert scheduler.chunk_size(0, 15) == 15
@@ -0,0 +1,85 @@
+import numpy as np
+
+from crprop.definitions import EARTH_RADIUS_M, SPEED_OF_LIGHT
+from crprop.field_utils import igrf_coefficients
+from crprop.particle_utils import initial_buffers
+from crprop.numpy_backend import (dipole_field, igrf_field, NumpyPropagator, run_numpy)
+
+
+def random_positions(num_points, seed=0):
+    rng = np.random.RandomState(seed)
+    r = np.exp(rng.uniform(0., np.log(10.), num_points))
+    direction = rng.normal(size=(num_points, 3))
+    direction /= np.linalg.norm(direction, axis=1)[:,np.newaxis]
+    return direction*(r*EARTH_RADIUS_M)[:,np.newaxis]
+
+
+def test_igrf_dipole_limit():
+    # Near 10 Earth radii the IGRF is dominated by its dipole terms
+    pos = np.array([[10.*EARTH_RADIUS_M, 0., 0.]])
+    B = igrf_field(pos, igrf_coefficients().astype(np.float64))
+    g10 = igrf_coefficients()[0, 0, 0]*1e-9
+    assert np.isclose(B[0, 2], -g10/1000., rtol=0.05)
+
+
+def test_boris_preserves_speed():
+    (position, velocity, zmel) = initial_buffers('proton', 100, 1e7, 1e9,
+                                                 lat=18.99, lon=-97.308, height=3)
+    propagator = NumpyPropagator(position, velocity, zmel, eom_integrator=3)
+    speed = np.linalg.norm(propagator.vel, axis=1)
+    for i in range(100):
+        propagator.step(0.0005)
+    assert np.allclose(np.linalg.norm(propagator.vel, axis=1), speed, rtol=1e-12)
+    assert np.allclose(propagator.time, 100*0.0005)
+    assert speed.max() < SPEED_OF_LIGHT
+
+
+def test_run_numpy_exits():
+    # Particles just inside 10 Earth radii heading out escape
+    position = np.array([[9.99, 0., 0., 1.], [2., 0., 0., 1.]], dtype=np.float32)
+    velocity = np.array([[1., 0., 0., 0.], [0., 0., 1., 0.]], dtype=np.float32)
+    zmel = np.tile(np.array([1.602176462e-19, 1.67262161e-27, 1e9, 2.0658], dtype=np.float32),
+                   (2, 1))
+    run_options = np.array([0.0005, 9., 1., 3], dtype=np.float32)
+    (position, velocity, zmel, lifecycle) = run_numpy(position, velocity, zmel, run_options,
+                                                      num_steps=20)
+    assert list(lifecycle['status']) == [2, 0]
+    assert list(lifecycle['exit_id']) == [0]
+    assert np.linalg.norm(lifecycle['exit_position'][0]) > 10.
+
+
+def test_fields_match_opencl(cl_context):
+    import pyopencl as cl
+    from crprop.cl_utils import build_program
+    from crprop.field_grid_utils import sample_field
+
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+    pos = random_positions(2000)
+    position = np.zeros((pos.shape[0], 4), dtype=np.float32)
+    position[:,0:3] = pos
+
+    for (model, B) in (('dipole', dipole_field(position[:,0:3].astype(np.float64))),
+                       ('igrf', igrf_field(position[:,0:3].astype(np.float64),
+                                           igrf_coefficients().astype(np.float64)))):
+        B_cl = sample_field(queue, program, position, model=model)
+        rel = np.linalg.norm(B_cl[:,0:3]-B[:,0:3], axis=1)/B[:,3]
+        assert rel.max() < 1e-4
+
+
+def test_propagation_matches_opencl(cl_context):
+    import pyopencl as cl
+    from crprop.cl_utils import build_program
+    from crprop.headless_utils import run_headless
+
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+    (position, velocity, zmel) = initial_buffers('proton', 64, 1e7, 1e9,
+                                                 lat=18.99, lon=-97.308, height=3)
+    for eom_integrator in (3, 4):
+        run_options = np.array([0.0005, 9., 2., eom_integrator], dtype=np.float32)
+        cl_state = run_headless(queue, program, position, velocity, zmel, run_options,
+                                num_steps=100)
+        np_state = run_numpy(position, velocity, zmel, run_options, num_steps=100)
+        assert np.abs(cl_state[0][:,0:3]-np_state[0][:,0:3]).max() < 1e-4
+        assert np.allclose(cl_state[1][:,3], np_state[1][:,3], rtol=1e-5)
@@ -0,0 +1,97 @@
+import os
+import pytest
+import numpy as np
+
+pytest.importorskip('pyopencl')
+pytest.importorskip('PIL')
+os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+pytest.importorskip('OpenGL.GL')
+
+from crprop.offscreen_utils import frame_steps, OffscreenContext
+from crprop.render_utils import sphere_mesh
+
+
+@pytest.fixture(scope='module')
+def gl_context():
+    """ Offscreen OpenGL context of 64x48 pixels, skipping
+        the test when no headless platform is available.
+    """
+    try:
+        gl_context = OffscreenContext(64, 48)
+    except Exception:
+        pytest.skip('No headless OpenGL context available')
+    yield gl_context
+    gl_context.close()
+
+
+def test_frame_steps():
+    assert frame_steps(0.002, 0.0005) == (4, 0.0005)
+    (steps, dt) = frame_steps(0.0021, 0.0005)
+    assert steps == 5 and np.isclose(steps*dt, 0.0021)
+    assert frame_steps(1e-5, 0.0005) == (1, 1e-5)
+
+
+def test_render_offscreen_rejects_adaboris():
+    from crprop.offscreen_utils import render_offscreen
+    run_options = np.array([0.0005, 8., 1., 4], dtype=np.float32)
+    with pytest.raises(ValueError):
+        render_offscreen(None, None, None, None, None, None, None, run_options, 1, 0.001,
+                         None, None)
+
+
+def test_sphere_mesh():
+    (vertices, indices) = sphere_mesh(8, 16)
+    assert vertices.shape == (9*17, 5) and indices.size == 6*8*16
+    assert np.allclose(np.sum(vertices[:,0:3]**2, axis=1), 1., atol=1e-6)
+    assert vertices[:,3:5].min() == 0. and vertices[:,3:5].max() == 1.
+    # Triangles face outwards, except those collapsed at the poles
+    (a, b, c) = vertices[indices.reshape(-1, 3),0:3].transpose(1, 0, 2)
+    outward = np.sum(np.cross(b-a, c-a)*(a+b+c), axis=1)
+    assert np.all(outward > -1e-6) and np.sum(outward > 1e-6) == 2*8*16 - 2*16
+
+
+def test_text_overlay(gl_context):
+    from OpenGL.GL import glClear, glReadPixels, GL_COLOR_BUFFER_BIT, GL_RGBA, GL_UNSIGNED_BYTE
+    from crprop.render_utils import TextOverlay
+
+    glClear(GL_COLOR_BUFFER_BIT)
+    overlay = TextOverlay(['p', '', 'q'])
+    assert overlay.size[1] == 36
+    overlay.draw(64, 48, x=0., y=0.)
+    pixels = np.frombuffer(glReadPixels(0, 0, 64, 48, GL_RGBA, GL_UNSIGNED_BYTE), dtype=np.uint8)
+    # Text on the first and third lines only, from the top
+    lit = pixels.reshape(48, 64, 4)[::-1,:,0].any(axis=1)
+    assert lit[0:12].any() and not lit[12:24].any() and lit[24:36].any() and not lit[36:].any()
+
+
+def test_render_offscreen(cl_context, gl_context):
+    import pyopencl as cl
+    from crprop.offscreen_utils import render_offscreen
+    from crprop.capture_utils import FrameCapture
+    from crprop.cl_utils import build_program
+    from crprop.headless_utils import field_grid_buffer
+    from crprop.particle_utils import initial_buffers
+    from crprop.field_utils import igrf_coefficients
+
+    frames = []
+    def write_frame(number, data, width, height):
+        frames.append((number, np.frombuffer(data, dtype=np.uint8).reshape(height, width, 4)))
+
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+    (position, velocity, zmel) = initial_buffers('proton', 64, 1e8, 1e9, 18.99, -97.308, 3., seed=1)
+    run_options = np.array([5e-4, 9., 1., 3], dtype=np.float32)
+    capture = FrameCapture('unused', num_writers=1, write_frame=write_frame,
+                           read_buffer=gl_context.read_buffer)
+    igrf = cl.Buffer(cl_context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                     hostbuf=igrf_coefficients(0.))
+    result = render_offscreen(queue, program, gl_context, capture, position, velocity, zmel,
+                              run_options, 3, 2e-3, igrf, field_grid_buffer(cl_context),
+                              camera_rotation=10.)
+
+    assert [f[0] for f in frames] == [0, 1, 2]
+    # Frames show the Earth, and the particles move between them
+    assert all(f[1].any() for f in frames)
+    assert not np.array_equal(frames[0][1], frames[2][1])
+    # Two frames of four steps each
+    assert np.allclose(result[1][:,3], velocity[:,3] + 4e-3, atol=1e-6)
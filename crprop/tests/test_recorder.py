@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from crprop.particle_utils import initial_buffers
+
+
+def test_recorder_matches_final_state(cl_context, tmp_path):
+    import pyopencl as cl
+    from crprop.cl_utils import build_program
+    from crprop.headless_utils import run_headless
+    from crprop.recorder_utils import TrajectoryRecorder
+    from crprop.trajectory_utils import load_trajectory
+
+    (position, velocity, zmel) = initial_buffers('proton', 64, 1e7, 1e8,
+                                                 lat=18.99, lon=-97.308, height=3)
+    run_options = np.array([0.0005, 8., 1., 3], dtype=np.float32)
+
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+    recorder = TrajectoryRecorder(queue, 64, str(tmp_path), record_every=5, chunk_samples=3)
+    (final_position, final_velocity, _, _) = run_headless(queue, program, position, velocity, zmel,
+                                                          run_options, num_steps=50, substeps=10,
+                                                          recorder=recorder)
+
+    (time, traj_position, traj_velocity) = load_trajectory(str(tmp_path))
+    assert len(recorder.shards) == 4
+    assert time.shape == (10, 64)
+    assert np.allclose(time[:,0], 0.0005*5*np.arange(1, 11), rtol=1e-4)
+    assert np.array_equal(traj_position[-1], final_position[:,0:3])
+    assert np.array_equal(traj_velocity[-1], final_velocity[:,0:3])
+
+
+def test_recorder_rejects_refill(cl_context, tmp_path):
+    import pyopencl as cl
+    from crprop.headless_utils import run_headless
+    from crprop.recorder_utils import TrajectoryRecorder
+
+    (position, velocity, zmel) = initial_buffers('proton', 8, 1e7, 1e8,
+                                                 lat=18.99, lon=-97.308, height=3)
+    run_options = np.array([0.0005, 8., 1., 3], dtype=np.float32)
+
+    queue = cl.CommandQueue(cl_context)
+    recorder = TrajectoryRecorder(queue, 8, str(tmp_path), record_every=5)
+    refill = lambda n: (position[:n], velocity[:n], zmel[:n])
+    with pytest.raises(ValueError):
+        run_headless(queue, None, position, velocity, zmel, run_options, num_steps=10,
+                     recorder=recorder, refill=refill)
@@ -0,0 +1,107 @@
+import pytest
+import numpy as np
+
+pytest.importorskip('pyopencl')
+
+from crprop.rng_utils import philox4x32, seed_key, DeviceInitializer
+
+
+def test_philox4x32_known_answers():
+    # Known answer tests of the Random123 distribution
+    assert (list(philox4x32([0, 0, 0, 0], [0, 0])[0])
+            == [0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8])
+    assert (list(philox4x32([0xffffffff]*4, [0xffffffff]*2)[0])
+            == [0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd])
+    assert (list(philox4x32([0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344],
+                            [0xa4093822, 0x299f31d0])[0])
+            == [0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1])
+
+
+def test_seed_key():
+    assert np.array_equal(seed_key(1), seed_key(1))
+    assert not np.array_equal(seed_key(1), seed_key(2))
+
+
+def read_states(queue, buffers, num):
+    import pyopencl as cl
+    states = [np.empty((num, 4), dtype=np.float32) for b in buffers]
+    for (state, buf) in zip(states, buffers):
+        cl.enqueue_copy(queue, state, buf)
+    return states
+
+
+def test_device_init_matches_host(cl_context):
+    import pyopencl as cl
+    from crprop.cl_utils import build_program
+
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+    num = 4096
+    init = DeviceInitializer(program, num, 'proton', 1e7, 1e9, 18.99, -97.308, 3., alpha=2.7,
+                             seed=11)
+    buffers = init.buffers(queue)
+    (position, velocity, zmel) = read_states(queue, buffers, num)
+
+    (host_position, host_velocity, host_zmel) = init.host_states(np.arange(num))
+    assert np.allclose(position, host_position, atol=1e-6)
+    assert np.allclose(velocity, host_velocity, atol=1e-5)
+    assert np.allclose(zmel, host_zmel, rtol=1e-4)
+    assert np.allclose(np.sum(velocity[:,0:3]**2, axis=1), 1., atol=1e-5)
+    assert zmel[:,2].min() >= 1e7*(1.-1e-5) and zmel[:,2].max() <= 1e9*(1.+1e-5)
+
+    # Refilling slots with ids 7 to 9 draws the same particles again
+    init.init(queue, *buffers, num=3, first_id=7, slots=np.array([100, 200, 300]), t0=0.5)
+    (position2, velocity2, zmel2) = read_states(queue, buffers, num)
+    assert np.array_equal(velocity2[[100, 200, 300],0:3], velocity[7:10,0:3])
+    assert np.all(velocity2[[100, 200, 300],3] == 0.5)
+    assert np.array_equal(zmel2[[100, 200, 300]], zmel[7:10])
+
+
+def test_run_headless_device_init(cl_context):
+    import pyopencl as cl
+    from crprop.cl_utils import build_program
+    from crprop.headless_utils import run_headless
+
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+    # Particles starting low above the ground, so that many hit the Earth
+    init = DeviceInitializer(program, 256, 'proton', 1e8, 1e10, 0., 0., 0.02, seed=3)
+    run_options = np.array([1e-4, 10., 2., 3], dtype=np.float32)
+    (position, velocity, zmel, lifecycle) = run_headless(
+        queue, program, None, None, None, run_options, num_steps=2000, check_interval=10,
+        refill=init, initializer=init)
+
+    assert lifecycle['exit_id'].size > 0
+    # Refilled slots hold the particles of their ids
+    refilled = lifecycle['particle_id'] >= 256
+    assert refilled.any()
+    (host_position, host_velocity, host_zmel) = init.host_states(lifecycle['particle_id'][refilled])
+    assert np.allclose(zmel[refilled,0:3], host_zmel[:,0:3], rtol=1e-4)
+
+
+def test_device_init_composition(cl_context):
+    import pyopencl as cl
+    from crprop.cl_utils import build_program
+    from crprop.spectrum_utils import spectrum_components
+
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+    num = 8192
+    components = spectrum_components(1e8, 1e10, alpha=2.7,
+                                     composition='proton:0.7,helium:0.2,iron:0.1')
+    init = DeviceInitializer(program, num, None, 1e8, 1e10, 18.99, -97.308, 3., seed=5,
+                             components=components)
+    assert init.species_names == ['helium', 'iron', 'proton']
+    (position, velocity, zmel) = read_states(queue, init.buffers(queue), num)
+
+    (host_position, host_velocity, host_zmel) = init.host_states(np.arange(num))
+    assert np.allclose(zmel, host_zmel, rtol=1e-4)
+    # All species drawn in one launch, at their fractions
+    species_id = init.species_ids(np.arange(num))
+    assert np.allclose(np.bincount(species_id)/float(num), [0.2, 0.1, 0.7], atol=0.02)
+    assert np.array_equal(np.unique(zmel[:,0]/1.602e-19).round(), [1., 2., 26.])
+    assert np.all(zmel[species_id == 1,0] == zmel[species_id == 1,0][0])
+
+    with pytest.raises(ValueError):
+        DeviceInitializer(program, num, 'proton', 1e8, 1e10, 0., 0., 1., seed=5,
+                          components=spectrum_components(1e8, 1e10, alpha=[2.7, 3.1], breaks=[1e9]))
@@ -0,0 +1,65 @@
+import time
+import pytest
+import numpy as np
+
+pytest.importorskip('pyopencl')
+
+from crprop.simulation_utils import SimulationThread
+
+
+def read(queue, buf, num):
+    import pyopencl as cl
+    out = np.empty((num, 4), dtype=np.float32)
+    cl.enqueue_copy(queue, out, buf)
+    return out
+
+
+def test_simulation_thread(cl_context):
+    import pyopencl as cl
+    from crprop.cl_utils import build_program
+    from crprop.headless_utils import field_grid_buffer
+    from crprop.particle_utils import initial_buffers
+    from crprop.field_utils import igrf_coefficients
+
+    mf = cl.mem_flags
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+    num = 128
+    (position, velocity, zmel) = initial_buffers('proton', num, 1e8, 1e9, 18.99, -97.308, 3.,
+                                                 seed=1)
+    buffers = [cl.Buffer(cl_context, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=a)
+               for a in (position, velocity, zmel)]
+    # Plain buffers standing in for the OpenGL-shared ones
+    draw_positions = [cl.Buffer(cl_context, mf.READ_WRITE, size=position.nbytes) for i in range(2)]
+    draw_colors = [cl.Buffer(cl_context, mf.READ_WRITE, size=position.nbytes) for i in range(2)]
+    igrf = cl.Buffer(cl_context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=igrf_coefficients(0.))
+    run_options = np.array([1e-4, 9., 1., 3], dtype=np.float32)
+
+    simulation = SimulationThread(cl_context, program, buffers[0], buffers[1], buffers[2],
+                                  draw_positions, draw_colors, igrf, field_grid_buffer(cl_context),
+                                  run_options, num, sim_rate=200*1e-4, max_steps=5)
+    # Starting state, with its colors, and nothing more while paused
+    index = simulation.acquire()
+    assert index == 0
+    assert np.array_equal(read(queue, draw_positions[0], num), position)
+    assert np.all(read(queue, draw_colors[0], num)[:,3] > 0.)
+    simulation.release()
+    time.sleep(0.1)
+    assert simulation.sim_time == 0.
+
+    simulation.toggle_pause()
+    time.sleep(0.3)
+    index = simulation.acquire()
+    drawn = read(queue, draw_positions[index], num)
+    # The pair being drawn is left alone while the other one is refilled
+    time.sleep(0.2)
+    assert np.array_equal(read(queue, draw_positions[index], num), drawn)
+    assert simulation.latest != index
+    simulation.release()
+    assert not np.array_equal(drawn, position)
+
+    # Simulated time follows the clock, but for the time spent waiting on the drawn pair
+    simulation.stop()
+    sim_time = simulation.sim_time
+    assert 0.2*200*1e-4 < sim_time < 0.6*200*1e-4
+    assert np.isclose(read(queue, buffers[1], num)[0,3], sim_time, rtol=1e-4)
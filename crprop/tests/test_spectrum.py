@@ -0,0 +1,103 @@
+import pytest
+import numpy as np
+
+from crprop.spectrum_utils import (power_law_quantile, broken_power_law_quantile,
+                                   broken_power_law_weights, spectrum_components,
+                                   sample_spectrum, spectrum_zmel)
+from crprop.particle_utils import energy_distribution, get_particle_props
+
+
+def power_law_cdf(E, Emin, Emax, alpha):
+    if alpha == 1.:
+        return np.log(E/Emin)/np.log(Emax/Emin)
+    g = 1. - alpha
+    return (E**g - Emin**g)/(Emax**g - Emin**g)
+
+
+def test_power_law_quantile_inverts_cdf():
+    u = np.linspace(0., 1., 101)
+    for alpha in (0.5, 1., 2., 2.7):
+        E = power_law_quantile(u, 1e7, 1e12, alpha)
+        assert np.isclose(E[0], 1e7) and np.isclose(E[-1], 1e12)
+        assert np.allclose(power_law_cdf(E, 1e7, 1e12, alpha), u, atol=1e-9)
+    # Indices next to 1 are as well behaved as 1 itself
+    assert np.allclose(power_law_quantile(u, 1e7, 1e12, 1.+1e-12),
+                       power_law_quantile(u, 1e7, 1e12, 1.))
+
+
+def test_energy_distribution_seeded():
+    E = energy_distribution(1e7, 1e9, 100000, alpha=2., seed=1)
+    assert np.array_equal(E, energy_distribution(1e7, 1e9, 100000, alpha=2., seed=1))
+    assert E.min() >= 1e7 and E.max() <= 1e9
+    # Energies are not quantized to a grid
+    assert np.unique(E).size == E.size
+    # Kolmogorov-Smirnov distance to the exact distribution
+    cdf = power_law_cdf(np.sort(E), 1e7, 1e9, 2.)
+    assert np.max(np.abs(cdf - np.arange(1, E.size+1)/E.size)) < 0.01
+
+
+def test_broken_power_law():
+    edges = np.array([1e7, 1e8, 1e10])
+    alpha = np.array([2., 3.])
+    weights = broken_power_law_weights(edges, alpha)
+    # Continuous flux E^-2 below the break and 1e8*E^-3 above it
+    below = 1e-7 - 1e-8
+    above = 1e8*(1e-16 - 1e-20)/2.
+    assert np.allclose(weights, np.array([below, above])/(below+above))
+
+    u = np.random.default_rng(2).random(200000)
+    E = broken_power_law_quantile(u, edges, alpha)
+    assert E.min() >= 1e7 and E.max() <= 1e10
+    assert abs(np.mean(E < 1e8) - weights[0]) < 0.01
+
+
+def test_sample_spectrum_chunks_reproducible():
+    components = spectrum_components(1e7, 1e9, alpha=2.7)
+    whole = np.concatenate([e for (s, e) in sample_spectrum(components, 1000, seed=7,
+                                                            chunk_size=64)])
+    # Any split of the run draws the same particles
+    parts = [np.concatenate([e for (s, e) in sample_spectrum(components, n, seed=7, first=first,
+                                                             chunk_size=64)])
+             for (first, n) in ((0, 100), (100, 1), (101, 899))]
+    assert np.array_equal(whole, np.concatenate(parts))
+    other = np.concatenate([e for (s, e) in sample_spectrum(components, 1000, seed=8,
+                                                            chunk_size=64)])
+    assert not np.array_equal(whole, other)
+
+
+def test_composition_zmel():
+    composition = {'proton': {'fraction': 3.}, 'helium': {'fraction': 1., 'alpha': [2., 3.],
+                                                          'breaks': [1e8]}}
+    components = spectrum_components(1e7, 1e9, alpha=2.7, composition=composition)
+    assert [c['species'] for c in components] == ['helium', 'proton']
+    assert np.isclose(components[0]['fraction'], 0.25)
+    assert list(components[1]['alpha']) == [2.7]
+
+    zmel, species_id = spectrum_zmel(components, 20000, seed=3, chunk_size=4096)
+    assert zmel.dtype == np.float32 and zmel.shape == (20000, 4)
+    assert abs(np.mean(species_id == 0) - 0.25) < 0.02
+    helium = (species_id == 0)
+    # Helium carries twice the proton charge
+    assert np.allclose(zmel[helium,0], 2.*zmel[~helium,0][0])
+    assert np.all((zmel[:,2] >= 1e7*(1.-1e-6)) & (zmel[:,2] <= 1e9*(1.+1e-6)))
+    assert np.all(zmel[:,3] > 1.)
+
+
+def test_inline_composition():
+    components = spectrum_components(1e7, 1e9, alpha=2.7, composition='proton:0.9, helium:0.1')
+    assert [c['species'] for c in components] == ['helium', 'proton']
+    assert np.allclose([c['fraction'] for c in components], [0.1, 0.9])
+    assert all(list(c['alpha']) == [2.7] for c in components)
+
+    with pytest.raises(ValueError):
+        spectrum_components(1e7, 1e9, composition='proton:0.9,unobtainium:0.1')
+
+
+def test_particle_species_names():
+    assert get_particle_props('magnesium')['isotope'] == 'Mg24'
+    # The former misspelled key is still accepted
+    assert get_particle_props('magensium') is get_particle_props('magnesium')
+
+    with pytest.raises(ValueError, match='magnesium') as info:
+        get_particle_props('unobtainium')
+    assert 'magensium' not in str(info.value)
@@ -0,0 +1,73 @@
+import pytest
+import numpy as np
+
+from crprop.sweep_utils import (expand_sweep, config_label, sweep_buffers, tag_configs,
+                                group_by_config)
+
+
+base = {'particle_type': 'proton', 'energy_lims': [1e8, 1e10], 'alpha': None,
+        'lat_lon_alt': [0., 0., 0.02], 'eom_step': 'boris', 'time_step': 1e-4}
+
+
+def test_expand_sweep():
+    sweep = {'grid': {'time_step': [1e-4, 2e-4], 'particle_type': ['proton', 'helium']},
+             'configs': [{'eom_step': 'rk4'}]}
+    configs = expand_sweep(sweep, base)
+    assert len(configs) == 5
+    assert [(c['particle_type'], c['time_step']) for c in configs[:4]] == [
+        ('proton', 1e-4), ('proton', 2e-4), ('helium', 1e-4), ('helium', 2e-4)]
+    assert configs[4]['eom_step'] == 'rk4' and configs[4]['particle_type'] == 'proton'
+    assert config_label(configs[3], base) == '{"particle_type": "helium", "time_step": 0.0002}'
+
+    with pytest.raises(ValueError):
+        expand_sweep({'grid': {'num_particles': [1, 2]}}, base)
+    with pytest.raises(ValueError):
+        expand_sweep({}, base)
+
+
+def test_group_by_config():
+    configs = expand_sweep({'grid': {'particle_type': ['proton', 'helium', 'iron']}}, base)
+    (position, velocity, zmel, config_id, config_options) = sweep_buffers(configs, 4, seed=1)
+    assert position.shape == (12, 4) and list(config_id) == [0]*4 + [1]*4 + [2]*4
+    assert np.allclose(config_options[:,0:2], [1e-4, 3])
+
+    lifecycle = {'status': np.zeros(12, dtype=np.int32), 'particle_id': np.arange(12),
+                 'exit_id': np.array([5, 9]), 'exit_time': np.array([1., 2.])}
+    tag_configs(lifecycle, config_id, [config_label(c, base) for c in configs])
+    lifecycle.update(position=position, zmel=zmel)
+    groups = group_by_config(lifecycle)
+    assert [g['config_name'] for g in groups] == ['{}', '{"particle_type": "helium"}',
+                                                  '{"particle_type": "iron"}']
+    assert all(g['position'].shape == (4, 4) for g in groups)
+    assert [list(g['exit_id']) for g in groups] == [[], [5], [9]]
+    # Heavier nuclei carry more charge
+    assert groups[0]['zmel'][0,0] < groups[1]['zmel'][0,0] < groups[2]['zmel'][0,0]
+
+
+def test_sweep_matches_separate_runs(cl_context):
+    import pyopencl as cl
+    from crprop.cl_utils import build_program
+    from crprop.headless_utils import run_headless
+
+    queue = cl.CommandQueue(cl_context)
+    program = build_program(cl_context, cl_context.devices)
+    sweep = {'grid': {'eom_step': ['boris', 'rk4'], 'time_step': [1e-4, 3e-4]}}
+    configs = expand_sweep(sweep, base)
+    (position, velocity, zmel, config_id, config_options) = sweep_buffers(configs, 64, seed=4)
+    run_options = np.array([1e-4, 10., 2., 3], dtype=np.float32)
+    result = run_headless(queue, program, position, velocity, zmel, run_options, num_steps=200,
+                          check_interval=5, sweep=(config_id, config_options))
+
+    # One launch per step batch reproduces each configuration run on its own
+    for (i, options) in enumerate(config_options):
+        sel = (config_id == i)
+        alone = run_headless(queue, program, position[sel], velocity[sel], zmel[sel],
+                             np.array([options[0], 10., 2., options[1]], dtype=np.float32),
+                             num_steps=200, check_interval=5)
+        assert np.array_equal(result[0][sel], alone[0])
+        assert np.array_equal(result[3]['status'][sel], alone[3]['status'])
+        assert np.allclose(result[1][sel,3][alone[3]['status'] == 0], 200*options[0], rtol=1e-4)
+
+    with pytest.raises(ValueError):
+        run_headless(queue, program, position, velocity, zmel, run_options, num_steps=10,
+                     sweep=(config_id, config_options), refill=lambda n: None)
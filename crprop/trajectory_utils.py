@@ -0,0 +1,54 @@
+from __future__ import absolute_import
+
+try:
+    import os
+    import json
+    import numpy as np
+
+except ImportError as e:
+    print(e)
+    raise ImportError
+
+# Name of the shard index written next to the shards
+trajectory_index_file = 'trajectory_index.json'
+
+
+def load_trajectory(out_dir, particles=None):
+    """
+    Load recorded trajectories from their shards.
+
+    Shards are memory-mapped, so only the selected
+    particles are read from disk.
+
+    Parameters
+    ----------
+    out_dir   : str
+                directory holding the shards and their index
+    particles : array_like, optional
+                indices of the particles to load, all by default
+
+    Returns
+    -------
+    time     : array_like
+               SxN times (s)
+    position : array_like
+               SxNx3 positions in Earth radii
+    velocity : array_like
+               SxNx3 velocities in m/s
+    """
+    with open(os.path.join(out_dir, trajectory_index_file)) as handle:
+        index = json.load(handle)
+
+    if particles is None:
+        particles = slice(None)
+    samples = []
+    for shard in index['shards']:
+        data = np.load(os.path.join(out_dir, shard['file']), mmap_mode='r')
+        samples.append(np.array(data[:,particles]))
+
+    if samples:
+        samples = np.concatenate(samples)
+    else:
+        samples = np.zeros((0, index['num_particles'], 2, 4), dtype=np.float32)[:,particles]
+
+    return samples[...,0,3], samples[...,0,0:3], samples[...,1,0:3]
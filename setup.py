@@ -98,6 +98,7 @@ setup(
     setup_requires=['setuptools>=38.6.0'],
     scripts=[
              'crprop/run.py',
+             'crprop/batch.py',
             ],
     # $ setup.py publish support.
     cmdclass={